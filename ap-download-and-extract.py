@@ -1,24 +1,214 @@
+"""
+Download the ActivePapers of this project from Zenodo, and extract them.
+
+The downloads are streamed to disk in chunks, into a <filename>.part file
+that is renamed when the download is complete. An interrupted download
+is resumed with an HTTP range request when the script is run again. The
+ActivePapers are downloaded concurrently. After download, the size and
+the MD5 checksum of each file are verified. The expected checksums are
+the ones published with the Zenodo records (retrieved from the Zenodo
+API), or those in the --checksums file. A download that cannot be
+verified is an error, unless --no-verify is given.
+
+For testing, --base-url replaces "https://zenodo.org" in the URLs, e.g.
+with the address of the local stand-in server ap-download-test-server.py.
+"""
+
 import requests
 import os
+import sys
+import time
+import re
+import base64
+import hashlib
+import argparse
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+zenodo_url = "https://zenodo.org"
 
 active_papers = {
-    "scripts": "https://zenodo.org/record/162171/files/bayesian_inference_fbm.ap?download=1",
-    "traj1": "https://zenodo.org/record/61742/files/POPC_martini_nvt_cm_300ps.ap?download=1",
-    "traj2": "https://zenodo.org/record/61743/files/POPC_martini_nvt_cm_600ns.ap?download=1",
+    "scripts": "/record/162171/files/bayesian_inference_fbm.ap?download=1",
+    "traj1": "/record/61742/files/POPC_martini_nvt_cm_300ps.ap?download=1",
+    "traj2": "/record/61743/files/POPC_martini_nvt_cm_600ns.ap?download=1",
 }
 
-for active_paper, url in active_papers.items():
-    filename = os.path.split(url)[1].split("?")[0]
-    if os.path.exists(filename):
-        print("Already exists:", filename)
-        continue
-    print("Download", filename)
-    r = requests.get(url)
-    with open(filename , 'wb') as f:
-        f.write(r.content)
-
-subprocess.run("""
+chunk_size = 1024 * 1024
+print_lock = threading.Lock()
+
+def report(*args):
+    with print_lock:
+        print(*args)
+        sys.stdout.flush()
+
+def md5sum(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(16 * chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# The checksums published by Zenodo, from the API record of each file:
+#  {"files": [{"key": <filename>, "checksum": "md5:<md5>"}, ...]}
+
+def published_checksums(base_url, retries):
+    checksums = {}
+    records = {re.match(r"/record/(\d+)/", path).group(1)
+               for path in active_papers.values()}
+    for record in sorted(records):
+        url = "%s/api/records/%s" % (base_url, record)
+        for attempt in range(retries + 1):
+            try:
+                r = requests.get(url, timeout=60)
+                if r.status_code >= 500 and attempt < retries:
+                    raise requests.HTTPError("HTTP %d" % r.status_code)
+                r.raise_for_status()
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.HTTPError) as exc:
+                if attempt == retries:
+                    raise
+                report("Retrieving checksums failed, retrying:", exc)
+                time.sleep(2 ** attempt)
+        for entry in r.json().get("files", []):
+            filename = entry.get("key", entry.get("filename"))
+            algorithm, _, checksum = entry.get("checksum", "").rpartition(":")
+            if filename and checksum and algorithm in ("", "md5"):
+                checksums[filename] = checksum.lower()
+    return checksums
+
+# Expected checksums, in the format of the md5sum tool: "<md5> <filename>"
+
+def read_checksums(checksum_file):
+    checksums = {}
+    with open(checksum_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                checksums[fields[1].lstrip("*")] = fields[0].lower()
+    return checksums
+
+# Download one file, resuming from <filename>.part if it exists.
+# If the server ignores the range request (status 200 instead of 206),
+#  the download restarts from the beginning.
+# Returns the expected size and the expected MD5 checksum: expected_md5
+#  if it is known, otherwise the Content-MD5 header of the server, if any.
+#  The Content-MD5 of a partial (206) response is that of the part, not of
+#  the file, so it is only used for complete (200) responses.
+# With verify, a download without any expected checksum is refused as soon
+#  as the response headers have arrived, before the body is downloaded.
+#  The .part file is then left unchanged, so that a later run with
+#  --checksums or --no-verify can resume it.
+
+def download_once(url, filename, expected_md5, verify, progress_interval):
+    partfile = filename + ".part"
+    offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes=%d-" % offset
+    with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:  # range not satisfiable: start over
+            os.remove(partfile)
+            return download_once(url, filename, expected_md5, verify,
+                                 progress_interval)
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset = 0
+        length = r.headers.get("Content-Length")
+        total = offset + int(length) if length is not None else None
+        content_md5 = None
+        if r.status_code == 200:
+            content_md5 = r.headers.get("Content-MD5")
+        if content_md5 is not None:
+            content_md5 = base64.b64decode(content_md5).hex()
+        if expected_md5 is None:
+            expected_md5 = content_md5
+        if expected_md5 is None and verify:
+            raise IOError("%s: no checksum to verify the download against "
+                          "(use --checksums, or --no-verify)" % filename)
+        if offset:
+            report("Resume", filename, "at %.1f MB" % (offset / 1e6))
+        else:
+            report("Download", filename)
+        done = offset
+        last_report = time.time()
+        with open(partfile, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                done += len(chunk)
+                if time.time() - last_report > progress_interval:
+                    last_report = time.time()
+                    if total:
+                        report("  %s: %.1f / %.1f MB (%d %%)" % (
+                            filename, done / 1e6, total / 1e6, 100 * done // total))
+                    else:
+                        report("  %s: %.1f MB" % (filename, done / 1e6))
+    return total, expected_md5
+
+# Server errors (5xx) and rate limiting (429) are retried like network
+#  errors; other HTTP errors (e.g. 404) are not.
+
+def retryable(exc):
+    if isinstance(exc, requests.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+        return status is None or status >= 500 or status == 429
+    return True
+
+def download(url, filename, expected_md5, retries, progress_interval, verify):
+    for attempt in range(retries + 1):
+        try:
+            total, expected_md5 = download_once(url, filename, expected_md5,
+                                                verify, progress_interval)
+            break
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                requests.HTTPError) as exc:
+            if attempt == retries or not retryable(exc):
+                raise
+            report("Download of", filename, "interrupted, retrying:", exc)
+            time.sleep(2 ** attempt)
+
+    partfile = filename + ".part"
+    size = os.path.getsize(partfile)
+    if total is not None and size != total:
+        raise IOError("%s: size %d, expected %d" % (filename, size, total))
+    checksum = md5sum(partfile)
+    if expected_md5 is not None and checksum != expected_md5:
+        os.remove(partfile)
+        raise IOError("%s: MD5 checksum %s, expected %s" % (filename, checksum, expected_md5))
+    os.rename(partfile, filename)
+    report("Downloaded", filename, "md5:", checksum,
+           "(verified)" if expected_md5 is not None else "")
+
+def download_all(base_url, checksums, workers, retries, progress_interval,
+                 verify=True):
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for active_paper, path in active_papers.items():
+            url = base_url + path
+            filename = os.path.split(url)[1].split("?")[0]
+            if os.path.exists(filename):
+                print("Already exists:", filename)
+                continue
+            jobs[filename] = executor.submit(
+                download, url, filename, checksums.get(filename),
+                retries, progress_interval, verify
+            )
+    ok = True
+    for filename, job in jobs.items():
+        try:
+            job.result()
+        except Exception as exc:
+            print("Download FAILED:", filename, exc, file=sys.stderr)
+            ok = False
+    return ok
+
+def extract():
+    subprocess.run("""
 for d in TEMP data code-ORIGINAL documentation-ORIGINAL; do
     rm -rf $d
     mkdir $d
@@ -50,3 +240,43 @@ rmdir code data documentation
 cd ..
 rmdir TEMP
 """, shell=True, check=False,executable="bash")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--base-url", default=zenodo_url)
+    parser.add_argument("--checksums",
+                        help="File with expected MD5 checksums, in md5sum format "
+                             "(default: the checksums published on Zenodo)")
+    parser.add_argument("--no-verify", action="store_true",
+                        help="Accept downloads without a known checksum")
+    parser.add_argument("--workers", type=int, default=len(active_papers),
+                        help="Number of concurrent downloads")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--progress-interval", type=float, default=5,
+                        help="Seconds between progress reports")
+    parser.add_argument("--download-only", action="store_true")
+    args = parser.parse_args()
+
+    base_url = args.base_url.rstrip("/")
+    if args.checksums:
+        checksums = read_checksums(args.checksums)
+    else:
+        try:
+            checksums = published_checksums(base_url, args.retries)
+        except (requests.RequestException, ValueError, AttributeError) as exc:
+            print("Cannot retrieve the published checksums:", exc, file=sys.stderr)
+            checksums = {}
+    ok = download_all(
+        base_url, checksums,
+        args.workers, args.retries, args.progress_interval,
+        verify=not args.no_verify
+    )
+    if not ok:
+        sys.exit(1)
+    if not args.download_only:
+        extract()
+
+if __name__ == "__main__":
+    main()
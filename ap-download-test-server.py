@@ -0,0 +1,216 @@
+"""
+Local stand-in for Zenodo, for testing ap-download-and-extract.py.
+
+Serves the files in DIRECTORY as /record/<id>/files/<filename>, for any
+record id, with support for HTTP range requests (206 and 416 responses),
+and publishes their MD5 checksums at /api/records/<id>, like the Zenodo
+API. Every response carries a Content-MD5 header, which for a partial
+(206) response is the checksum of the part only.
+
+Faults can be injected to exercise the resume and retry logic: with
+--fail N, the first N requests for each file are answered with HTTP 503,
+and with --cut BYTES, the first download of each file is interrupted
+after BYTES bytes.
+
+With --self-test, random files are created in a temporary directory and
+served with both kinds of faults, and ap-download-and-extract.py
+--download-only is run against the server three times: once to completion
+(which needs retries and a resumed download), once with a wrong
+expected checksum, which must be rejected, and once resuming without any
+expected checksum, which must be refused before the download.
+
+Example:
+
+  python3 ap-download-test-server.py --self-test
+  python3 ap-download-test-server.py downloads/ --port 8000 --cut 100000
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import os
+import re
+import sys
+import json
+import base64
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+currdir = os.path.dirname(os.path.abspath(__file__))
+
+def md5(filename):
+    with open(filename, "rb") as f:
+        return hashlib.md5(f.read()).digest()
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        if re.fullmatch(r"/api/records/\d+", path):
+            return self._json({"files": [
+                {"key": name, "checksum": "md5:" + md5(os.path.join(
+                    server.directory, name)).hex()}
+                for name in sorted(os.listdir(server.directory))]})
+        match = re.fullmatch(r"/record/\d+/files/([^/]+)", path)
+        filename = match and os.path.join(server.directory, match.group(1))
+        if filename is None or not os.path.isfile(filename):
+            return self.send_error(404)
+        with server.lock:
+            server.requests[filename] += 1
+            attempt = server.requests[filename]
+        if attempt <= server.fail:
+            return self.send_error(503)
+        with open(filename, "rb") as f:
+            data = f.read()
+        start, status = 0, 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            start = int(re.fullmatch(r"bytes=(\d+)-", range_header).group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(data))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        body = data[start:]
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d"
+                             % (start, len(data) - 1, len(data)))
+        self.send_header("Content-MD5",
+                         base64.b64encode(hashlib.md5(body).digest()).decode())
+        self.end_headers()
+        if server.cut is not None and attempt == server.fail + 1:
+            body = body[:server.cut]
+            self.wfile.write(body)
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up, e.g. after checking the headers
+
+def make_server(directory, port=0, fail=0, cut=None):
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.directory = directory
+    server.fail = fail
+    server.cut = cut
+    server.requests = defaultdict(int)
+    server.lock = threading.Lock()
+    return server
+
+# The self-test serves files with the names of the ActivePapers, so that
+# the download script can be run unchanged with --base-url.
+
+active_paper_files = ["bayesian_inference_fbm.ap",
+                      "POPC_martini_nvt_cm_300ps.ap",
+                      "POPC_martini_nvt_cm_600ns.ap"]
+
+def self_test(size):
+    script = os.path.join(currdir, "ap-download-and-extract.py")
+    with tempfile.TemporaryDirectory() as served, \
+         tempfile.TemporaryDirectory() as target:
+        for name in active_paper_files:
+            with open(os.path.join(served, name), "wb") as f:
+                f.write(os.urandom(size))
+        server = make_server(served, fail=1, cut=size // 3)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = "http://127.0.0.1:%d" % server.server_address[1]
+        command = [sys.executable, script, "--base-url", base_url,
+                   "--download-only", "--retries", "3",
+                   "--progress-interval", "1000"]
+
+        # Every file first fails with 503, then is cut off, then resumed.
+        run = subprocess.run(command, cwd=target)
+        ok = run.returncode == 0
+        for name in active_paper_files:
+            downloaded = os.path.join(target, name)
+            same = os.path.exists(downloaded) and \
+                md5(downloaded) == md5(os.path.join(served, name))
+            print("%-32s %s" % (name, "OK" if same else "FAILED"))
+            ok = ok and same
+
+        # A wrong expected checksum must be rejected.
+        for name in active_paper_files:
+            os.remove(os.path.join(target, name))
+        checksums = os.path.join(target, "checksums.md5")
+        with open(checksums, "w") as f:
+            for name in active_paper_files:
+                f.write("%s  %s\n" % ("0" * 32, name))
+        server.requests.clear()
+        server.fail, server.cut = 0, None
+        run = subprocess.run(command + ["--checksums", checksums], cwd=target,
+                             stderr=subprocess.DEVNULL)
+        rejected = run.returncode != 0 and not any(
+            os.path.exists(os.path.join(target, name)) for name in active_paper_files)
+        print("%-32s %s" % ("wrong checksum rejected", "OK" if rejected else "FAILED"))
+
+        # A resumed download has no Content-MD5 of the whole file. Without
+        # any other checksum, it must be refused before the body is
+        # downloaded, and the .part file must be left as it was.
+        with open(checksums, "w") as f:
+            pass
+        parts = {}
+        for name in active_paper_files:
+            parts[name] = os.path.join(target, name + ".part")
+            with open(os.path.join(served, name), "rb") as src, \
+                 open(parts[name], "wb") as dest:
+                dest.write(src.read(size // 2))
+        run = subprocess.run(command + ["--checksums", checksums], cwd=target,
+                             stderr=subprocess.DEVNULL)
+        refused = run.returncode != 0 and all(
+            os.path.getsize(part) == size // 2 for part in parts.values())
+        print("%-32s %s" % ("unverifiable download refused", "OK" if refused else "FAILED"))
+        server.shutdown()
+        return ok and rejected and refused
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("directory", nargs="?", help="Directory of the files to serve")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fail", type=int, default=0,
+                        help="Answer the first N requests for each file with 503")
+    parser.add_argument("--cut", type=int,
+                        help="Interrupt the first download of each file after BYTES")
+    parser.add_argument("--self-test", action="store_true")
+    parser.add_argument("--size", type=int, default=3*1024*1024 + 17,
+                        help="File size for --self-test")
+    args = parser.parse_args()
+    if args.self_test:
+        sys.exit(0 if self_test(args.size) else 1)
+    if args.directory is None:
+        parser.error("DIRECTORY is required unless --self-test is given")
+    server = make_server(args.directory, args.port, args.fail, args.cut)
+    print("Serving %s on http://127.0.0.1:%d" % (args.directory, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
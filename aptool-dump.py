@@ -1,70 +1,190 @@
 # Author: Sjoerd de Vries, CNRS
 # license: public domain
 
+# Dump all datasets in the "data" group of an ActivePaper (HDF5) file
+#  as .npy files, mirroring the group hierarchy.
+#
+# Datasets are converted in a streaming manner: each dataset is read in
+#  slabs along its first axis, aligned with its HDF5 chunks, and each slab
+#  is written directly into a memory-mapped .npy file. Therefore, memory use
+#  is bounded by the slab size, not by the dataset size.
+# Variable-length byte fields in structured datasets are converted to
+#  fixed-length byte strings, one field and one slab at a time, which avoids
+#  the h5py bug with reading structured data containing them.
+# Independent datasets are converted in parallel, in separate processes.
+# While a dataset is written, two checksums are computed: one of the slabs
+#  as they were read from the HDF5 file, and one of the same slabs in the
+#  memory-mapped .npy file, after flushing them. The slabs are still in the
+#  page cache at that point, so this costs no extra disk reads. A mismatch
+#  is an error. With --verify, the complete .npy file is also read back
+#  (again streaming) and checked against the source checksum. This doubles
+#  the I/O, so it is off by default.
+# If any dataset fails, the exit status is 1.
+#
+# Usage: python3 aptool-dump.py ACTIVE_PAPER_FILE TARGET_DIRECTORY [--workers N] [--slab-mb M] [--verify]
+
 import sys
 import os
+import argparse
+import hashlib
 import h5py
 import numpy as np
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 
-active_paper_file = sys.argv[1]
-target_directory = sys.argv[2]
-ap = h5py.File(active_paper_file)
-apdata = ap["data"]
-assert isinstance(apdata, h5py.Group)
-datadir = os.path.join(target_directory, "data")
-os.makedirs(datadir, exist_ok=True)
-
-def dump(datagroup, targetdir):
+def find_datasets(datagroup, targetdir, datasets):
     for childname, child in datagroup.items():
         child_target = os.path.join(targetdir, childname)
         if isinstance(child, h5py.Group):
             os.makedirs(child_target, exist_ok=True)
-            dump(child, child_target)
+            find_datasets(child, child_target, datasets)
+        else:
+            datasets.append((child.name, child_target))
+
+def is_vlen_bytes(dtype):
+    return dtype == "O"
+
+# Rows per slab: a multiple of the chunk size along the first axis,
+#  and about slab_bytes in size.
+
+def slab_rows(child, slab_bytes):
+    row_bytes = max(1, child.dtype.itemsize * int(np.prod(child.shape[1:])))
+    rows = max(1, slab_bytes // row_bytes)
+    if child.chunks is not None:
+        chunk_rows = child.chunks[0]
+        rows = max(chunk_rows, rows - rows % chunk_rows)
+    return rows
+
+def slabs(length, rows):
+    for start in range(0, length, rows):
+        yield start, min(start + rows, length)
+
+# Variable-length byte strings (vlen) become fixed-length byte strings,
+#  long enough for the longest one (this requires a first pass over the field).
+
+def vlen_dtype(child, fieldname, rows):
+    maxlen = 1
+    for start, stop in slabs(len(child), rows):
+        if fieldname is None:
+            values = child[start:stop]
         else:
+            values = child[start:stop, fieldname]
+        lengths = np.frompyfunc(len, 1, 1)(values)
+        if len(lengths):
+            maxlen = max(maxlen, int(lengths.max()))
+    return np.dtype("S%d" % maxlen)
+
+def target_dtype(child, rows):
+    dtype = child.dtype
+    if dtype.fields:
+        fields = []
+        for fieldname in dtype.names:
+            subdtype = dtype.fields[fieldname][0]
+            if is_vlen_bytes(subdtype):
+                subdtype = vlen_dtype(child, fieldname, rows)
+            fields.append((fieldname, subdtype))
+        return np.dtype(fields)
+    if is_vlen_bytes(dtype):
+        return vlen_dtype(child, None, rows)
+    return dtype
+
+def read_slab(child, start, stop, dtype):
+    if child.dtype.fields:
+        slab = np.empty(stop - start, dtype)
+        for fieldname in dtype.names:
+            slab[fieldname] = child[start:stop, fieldname]
+        return slab
+    return np.asarray(child[start:stop]).astype(dtype, copy=False)
+
+def checksum_npy(filename, rows):
+    arr = np.load(filename, mmap_mode="r", allow_pickle=False)
+    checksum = hashlib.sha256()
+    for start, stop in slabs(len(arr), rows):
+        checksum.update(np.ascontiguousarray(arr[start:stop]).tobytes())
+    return checksum.hexdigest()
+
+def dump_dataset(active_paper_file, dataset_name, child_target, slab_bytes,
+                 verify=False):
+    filename = child_target + ".npy"
+    with h5py.File(active_paper_file, "r") as ap:
+        child = ap[dataset_name]
+        if child.ndim == 0:  # scalars are small, no streaming needed
+            value = np.empty(1, child.dtype)
+            value[0] = child[()]
+            if is_vlen_bytes(child.dtype):
+                value = np.array([bytes(value[0])])
+            np.save(filename, value[0])
+            arr = np.load(filename, allow_pickle=False)
+            if arr.tobytes() != np.ascontiguousarray(value[0]).tobytes():
+                raise IOError("Checksum mismatch after writing %s" % filename)
+            return filename, hashlib.sha256(arr.tobytes()).hexdigest()
+
+        rows = slab_rows(child, slab_bytes)
+        dtype = target_dtype(child, rows)
+        if child.size == 0:
+            np.save(filename, np.empty(child.shape, dtype))
+            return filename, checksum_npy(filename, rows)
+
+        target = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=dtype, shape=child.shape
+        )
+        checksum = hashlib.sha256()
+        written = hashlib.sha256()
+        for start, stop in slabs(len(child), rows):
+            slab = read_slab(child, start, stop, dtype)
+            checksum.update(np.ascontiguousarray(slab).tobytes())
+            target[start:stop] = slab
+            target.flush()
+            written.update(np.ascontiguousarray(target[start:stop]).tobytes())
+        del target
+
+    # Check integrity
+    if written.hexdigest() != checksum.hexdigest():
+        raise IOError("Checksum mismatch after writing %s" % filename)
+    if verify and checksum_npy(filename, rows) != checksum.hexdigest():
+        raise IOError("Checksum mismatch after reading back %s" % filename)
+    return filename, checksum.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("active_paper_file")
+    parser.add_argument("target_directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--slab-mb", type=int, default=64,
+                        help="Approximate size of each slab that is read and written")
+    parser.add_argument("--verify", action="store_true",
+                        help="Read each .npy file back and verify its checksum")
+    args = parser.parse_args()
+
+    datadir = os.path.join(args.target_directory, "data")
+    os.makedirs(datadir, exist_ok=True)
+    datasets = []
+    with h5py.File(args.active_paper_file, "r") as ap:
+        apdata = ap["data"]
+        assert isinstance(apdata, h5py.Group)
+        find_datasets(apdata, datadir, datasets)
+
+    slab_bytes = args.slab_mb * 1024 * 1024
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        jobs = []
+        for dataset_name, child_target in datasets:
             print("dump", child_target)
-            scalar = False
-            if child.ndim == 0:
-                scalar = True
-                child2 = np.empty(1, child.dtype)
-                child2[0] = child[()]
-            elif not child.dtype.shape:
-                child2 = np.empty(child.shape, child.dtype)
-                child2[:] = child[:]
-            else: #structured data, bugged in h5py
-                child2 = np.empty(child.shape, child.dtype)
-                for n in range(len(child)):
-                    child2[n] = child[n]
-
-            child = child2        
-            if child.dtype.fields:
-                has_o = False
-                dtype = []
-                for fieldname, (subdtype, subshape) in child.dtype.fields.items():
-                    if subdtype == "O":  # variable byte strings (vlen)
-                        has_o = True
-                        for n in range(len(child)):
-                            assert isinstance(child[n][fieldname], bytes), (n, fieldname) # Python objects must be bytes
-                        subdtype = np.array([obj for obj in child[fieldname]]).dtype
-                        subshape = ()                    
-                    dtype.append((fieldname, (subdtype, subshape)))
-                if has_o:
-                    newchild = np.empty(child.shape, np.dtype(dtype))
-                    for fieldname, (subdtype, subshape) in child.dtype.fields.items():
-                        if subdtype == "O":
-                            newchild[fieldname] = np.array([obj for obj in child[fieldname]])
-                        else:
-                            newchild[fieldname] = child[fieldname]
-                    child = newchild
-            if scalar:
-                child = child[0]
-            np.save(child_target + ".npy", child)
-  
-            # Check integrity
+            jobs.append(executor.submit(
+                dump_dataset, args.active_paper_file, dataset_name,
+                child_target, slab_bytes, args.verify
+            ))
+        failed = 0
+        for (dataset_name, child_target), job in zip(datasets, jobs):
             try:
-                arr = np.load(child_target + ".npy", allow_pickle=False)
+                filename, checksum = job.result()
+                print("OK", filename, checksum)
             except Exception:
-                print("Integrity check FAILED", file=sys.stderr)
+                print("FAILED", child_target + ".npy", file=sys.stderr)
                 traceback.print_exc()
-  
-dump(apdata, datadir)
\ No newline at end of file
+                failed += 1
+    if failed:
+        print("%d of %d datasets FAILED" % (failed, len(datasets)), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Benchmark the likelihood computations of the inference code on synthetic
+fBM trajectories, for several trajectory lengths L.
+
+For each L, the quadratic forms and log-determinants on an alpha grid are
+computed with each likelihood method: "dense" (factorization of the
+position covariance matrix), "levinson" (Toeplitz recursion on the
+increments), the latter with each available kernel backend (NumPy, and
+Numba if it is installed), "pcg" (preconditioned conjugate gradients,
+with --tolerance) and "whittle" (spectral approximation, whose deviation
+is that of the approximation itself). The best time of --repeat runs is
+reported, together with the largest relative deviation from the dense
+results. For large L, the dense method can be skipped with --methods;
+the first method is then the reference.
+
+Before that, the import time of each numerical module is measured in a
+fresh interpreter (best of --repeat), excluding the interpreter start-up.
+The numerical modules must not load plotting, ActivePapers or Numba code,
+nor take more than --import-budget seconds to import (including NumPy).
+If they do, the benchmark exits with status 1 after the timings.
+
+Example:
+
+  python3 benchmark-inference.py --lengths 10 50 100 200 500 --n 256
+  python3 benchmark-inference.py --lengths 1000 4000 --methods levinson pcg
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import sys
+import os
+import json
+import time
+import argparse
+import importlib
+import subprocess
+import numpy as np
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code")
+sys.path.insert(0, code_dir)
+fbm = importlib.import_module("python-packages.fbm")
+inference = importlib.import_module("python-packages.inference")
+toeplitz = importlib.import_module("python-packages.toeplitz")
+gaussian_processes = importlib.import_module("python-packages.gaussian_processes")
+
+compute_modules = ["fbm", "gaussian_processes", "toeplitz", "inference",
+                   "lipid_analysis_common_code", "plotting"]
+heavy_modules = ["matplotlib", "activepapers", "numba"]
+
+import_script = '''
+import sys, time, json, importlib
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+importlib.import_module("python-packages." + sys.argv[2])
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds,
+                  "heavy": [m for m in sys.argv[3:] if m in sys.modules]}))
+'''
+
+def import_time(module, repeat):
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", import_script, code_dir, module] + heavy_modules)
+        result = json.loads(output)
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+def check_imports(budget, repeat):
+    ok = True
+    print("%-28s %10s  %s" % ("module", "seconds", "heavy imports"))
+    for module in compute_modules:
+        result = import_time(module, repeat)
+        heavy = ", ".join(result["heavy"])
+        status = ""
+        if result["heavy"]:
+            status = "  HEAVY IMPORT"
+        elif result["seconds"] > budget:
+            status = "  OVER BUDGET"
+        ok = ok and not status
+        print("%-28s %10.4f  %s%s" % (module, result["seconds"], heavy or "-", status))
+    print()
+    sys.stdout.flush()
+    return ok
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def make_trajectories(alpha, l, n):
+    increments = gaussian_processes.make_stationary_trajectories(
+        fbm.sigma_i_acov(alpha)(l), n
+    )
+    return np.cumsum(increments, axis=1)
+
+def relative_deviation(reference, result):
+    q_ref, log_det_ref = reference
+    q, log_det = result
+    return max(np.abs(q - q_ref).max()/np.abs(q_ref).max(),
+               np.abs(log_det - log_det_ref).max()/max(1., np.abs(log_det_ref).max()))
+
+def benchmark(lengths, n, grid_points, repeat, alpha, method_names, tolerance):
+    grid = np.linspace(0.05, 1.95, grid_points)
+    methods = []
+    for method in method_names:
+        if method == "levinson":
+            for backend in toeplitz.backends:
+                methods.append(("levinson", backend))
+        else:
+            methods.append((method, None))
+
+    # Compile the Numba kernels before timing them
+    if "numba" in toeplitz.backends:
+        toeplitz.set_backend("numba")
+        inference.quadratic_forms_toeplitz(np.zeros((1, 3)), fbm.sigma_i_acov, [0.5])
+
+    print("%6s %6s  %-16s %10s %10s %12s" % (
+        "L", "n", "method", "seconds", "speedup", "deviation"))
+    for l in lengths:
+        trajectories = make_trajectories(alpha, l, n)
+        reference_time = None
+        reference = None
+        for method, backend in methods:
+            if method == "dense":
+                fn = lambda: inference.quadratic_forms(trajectories, fbm.sigma_p, grid)
+                label = "dense"
+            elif method == "pcg":
+                fn = lambda: inference.quadratic_forms_pcg(
+                    trajectories, fbm.sigma_i_acov, grid, tolerance=tolerance)[:2]
+                label = "pcg"
+            elif method == "whittle":
+                fn = lambda: inference.quadratic_forms_whittle(
+                    trajectories, fbm.sigma_i_spectrum, grid)
+                label = "whittle"
+            else:
+                toeplitz.set_backend(backend)
+                fn = lambda: inference.quadratic_forms_toeplitz(
+                    trajectories, fbm.sigma_i_acov, grid)
+                label = "levinson/%s" % backend
+            seconds, result = best_time(fn, repeat)
+            if reference is None:
+                reference_time, reference = seconds, result
+            print("%6d %6d  %-16s %10.4f %10.2f %12.2e" % (
+                l, n, label, seconds, reference_time/seconds,
+                relative_deviation(reference, result)))
+            sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 50, 100, 200, 500])
+    parser.add_argument("--n", type=int, default=256, help="Number of trajectories")
+    parser.add_argument("--grid-points", type=int, default=20,
+                        help="Number of alpha values")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--alpha", type=float, default=0.55)
+    parser.add_argument("--methods", nargs="+", default=["dense", "levinson", "pcg"],
+                        choices=["dense", "levinson", "pcg", "whittle"])
+    parser.add_argument("--tolerance", type=float, default=1.e-10,
+                        help="Relative residual of the conjugate gradients")
+    parser.add_argument("--import-budget", type=float, default=0.5,
+                        help="Largest acceptable import time of a module, in seconds")
+    args = parser.parse_args()
+    imports_ok = check_imports(args.import_budget, args.repeat)
+    benchmark(args.lengths, args.n, args.grid_points, args.repeat, args.alpha,
+              args.methods, args.tolerance)
+    if not imports_ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
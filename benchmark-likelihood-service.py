@@ -0,0 +1,129 @@
+"""
+Benchmark the resident likelihood service under concurrent requests.
+
+A service is started in a separate process (likelihood-service.py) on a
+free local port. For each L, the factors are first warmed with a single
+request; then --clients threads each send --requests blocks of --n
+synthetic fBM trajectories, as trajectories or, with --scatter, as
+scatter matrices. The throughput (requests per second) and the median
+and 95th percentile latencies are reported, together with the time of a
+cold inference.log_likelihood call on the same block, and the largest
+deviation of the service results from it.
+
+Example:
+
+  python3 benchmark-likelihood-service.py --lengths 10 50 100 --clients 1 4 16
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import sys
+import os
+import time
+import socket
+import argparse
+import importlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+currdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(currdir, "code"))
+fbm = importlib.import_module("python-packages.fbm")
+inference = importlib.import_module("python-packages.inference")
+gaussian_processes = importlib.import_module("python-packages.gaussian_processes")
+lipid_analysis_common_code = importlib.import_module(
+    "python-packages.lipid_analysis_common_code")
+likelihood_service = importlib.import_module("python-packages.likelihood_service")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_service(port, max_mb):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(currdir, "likelihood-service.py"),
+         "--port", str(port), "--max-mb", str(max_mb)])
+    client = likelihood_service.LikelihoodClient(port=port)
+    for _ in range(100):
+        try:
+            client.status()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("The likelihood service did not start")
+
+def make_blocks(alpha, l, n, count):
+    sigma = fbm.sigma_p(alpha)(l)
+    return [gaussian_processes.make_trajectories(sigma, n) for _ in range(count)]
+
+def run_clients(client, blocks, grid, clients, scatter):
+    def request(block):
+        start = time.perf_counter()
+        if scatter:
+            log_lh = client.log_likelihood_scatter(
+                np.dot(block.T, block), len(block), fbm.sigma_p, grid)
+        else:
+            log_lh = client.log_likelihood(block, fbm.sigma_p, grid)
+        return time.perf_counter() - start, log_lh
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        results = list(executor.map(request, blocks))
+    return time.perf_counter() - start, results
+
+def benchmark(port, lengths, n, clients_list, requests, alpha, scatter):
+    grid = lipid_analysis_common_code.alpha_grid
+    client = likelihood_service.LikelihoodClient(port=port)
+    print("%6s %6s %8s  %10s %10s %10s  %10s %12s" % (
+        "L", "n", "clients", "req/s", "median ms", "p95 ms", "cold ms",
+        "deviation"))
+    for l in lengths:
+        start = time.perf_counter()
+        client.log_likelihood(np.zeros((1, l)), fbm.sigma_p, grid)
+        warmup = time.perf_counter() - start
+        print("%6d: factors for %d alpha values built in %.2f s"
+              % (l, len(grid), warmup))
+        for clients in clients_list:
+            blocks = make_blocks(alpha, l, n, clients*requests)
+            seconds, results = run_clients(client, blocks, grid, clients, scatter)
+            latencies = np.array([latency for latency, _ in results])*1000.
+            start = time.perf_counter()
+            reference = inference.log_likelihood(blocks[0], fbm.sigma_p, grid)
+            cold = (time.perf_counter() - start)*1000.
+            deviation = np.abs(results[0][1] - reference).max() \
+                        / np.abs(reference).max()
+            print("%6d %6d %8d  %10.1f %10.2f %10.2f  %10.1f %12.2e" % (
+                l, n, clients, len(blocks)/seconds, np.median(latencies),
+                np.percentile(latencies, 95), cold, deviation))
+            sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--n", type=int, default=64,
+                        help="Number of trajectories per request")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16],
+                        help="Numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=20,
+                        help="Number of requests per client")
+    parser.add_argument("--alpha", type=float, default=0.55)
+    parser.add_argument("--scatter", action="store_true",
+                        help="Send scatter matrices instead of trajectories")
+    parser.add_argument("--max-mb", type=int, default=2048)
+    args = parser.parse_args()
+    port = free_port()
+    process = start_service(port, args.max_mb)
+    try:
+        benchmark(port, args.lengths, args.n, args.clients, args.requests,
+                  args.alpha, args.scatter)
+    finally:
+        process.terminate()
+        process.wait()
+
+if __name__ == "__main__":
+    main()
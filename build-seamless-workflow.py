@@ -1,4 +1,5 @@
 import os
+import sys
 import seamless
 seamless.database_cache.connect()
 seamless.database_sink.connect()
@@ -49,6 +50,120 @@ ctx.parameters2 = ctx.parameters
 ctx.parameters3 = ctx.parameters2
 ctx.translate()
 
+#########################################################
+# Core-aware scheduling
+#########################################################
+
+# As of Seamless 0.11, meta["ncores"] is not taken into account:
+#  all transformers whose inputs are available are run at once, which would
+#  flood the local machine. Therefore, the (long-running) transformers are
+#  registered with a scheduler, which withholds their code. A transformer
+#  receives its code, and is thereby launched by Seamless, only when the
+#  transformers it depends on have finished and enough cores are free,
+#  according to its meta["ncores"] (-1 means: all cores of the machine).
+#  Independent transformers are packed onto the free cores in the order in
+#  which they were registered.
+#
+# Set the WORKFLOW_NCORES environment variable to change the core budget,
+#  e.g. to a large number if a Seamless job manager has been set up.
+
+class CoreScheduler:
+    def __init__(self, ctx, ncores, poll_interval=10):
+        self.ctx = ctx
+        self.ncores = ncores
+        self.poll_interval = poll_interval
+        self.jobs = {}
+
+    def add(self, name, tf, code, *, after=(), on_done=None):
+        ncores = (tf.meta or {}).get("ncores", 1)
+        if ncores is None or ncores <= 0 or ncores > self.ncores:
+            ncores = self.ncores
+        self.jobs[name] = {
+            "tf": tf,
+            "code": code,
+            "ncores": ncores,
+            "after": list(after),
+            "on_done": on_done,
+        }
+
+    @staticmethod
+    def _state(tf):
+        if tf.exception is not None:
+            return "failed"
+        if tf.status == "Status: OK":
+            return "done"
+        return "running"
+
+    def run(self):
+        pending = list(self.jobs)
+        running = []
+        done, failed = set(), set()
+        free = self.ncores
+        while pending or running:
+            launched = []
+            for name in pending:
+                job = self.jobs[name]
+                if any(dep in failed for dep in job["after"]):
+                    print("SKIPPED: {} (upstream failure)".format(name), file=sys.stderr)
+                    failed.add(name)
+                    launched.append(name)
+                    continue
+                if not all(dep in done for dep in job["after"]):
+                    continue
+                if job["ncores"] > free:
+                    continue
+                job["tf"].code = job["code"]
+                free -= job["ncores"]
+                running.append(name)
+                launched.append(name)
+                print("Launch {} ({} cores, {} free)".format(name, job["ncores"], free))
+            for name in launched:
+                pending.remove(name)
+            if launched:
+                self.ctx.translate()
+            if not running:
+                if pending:
+                    raise RuntimeError("Unsatisfiable dependencies: {}".format(pending))
+                break
+
+            self.ctx.compute(timeout=self.poll_interval)
+
+            for name in list(running):
+                job = self.jobs[name]
+                state = self._state(job["tf"])
+                if state == "running":
+                    continue
+                running.remove(name)
+                free += job["ncores"]
+                if state == "failed":
+                    failed.add(name)
+                    print("FAILED: {}".format(name), file=sys.stderr)
+                    print(job["tf"].exception, file=sys.stderr)
+                    continue
+                done.add(name)
+                print("Finished {}".format(name))
+                if job["on_done"] is not None:
+                    job["on_done"]()
+        self.ctx.compute()
+        return done, failed
+
+ncores = int(os.environ.get("WORKFLOW_NCORES", os.cpu_count()))
+direct_print = os.environ.get("WORKFLOW_DIRECT_PRINT", "0") == "1"
+scheduler = CoreScheduler(ctx, ncores)
+
+def mount_result(attr, tf, print_logs=False):
+    def on_done():
+        if print_logs:
+            print(tf.logs)
+            print()
+        result_dir = os.path.join("results", attr)
+        os.makedirs(result_dir, exist_ok=True)
+        ctx.results[attr] = FolderCell()
+        ctx.results[attr] = tf.result
+        ctx.results[attr].mount(result_dir, "w")
+        ctx.translate()
+    return on_done
+
 #########################################################
 # Organize workflow
 #########################################################
@@ -65,11 +180,24 @@ ctx.results = Context()
 
 #########################################################
 # make_alphagrid (previously: set_parameters)
+#   runs instantly, not scheduled
 #########################################################
 
+ctx.modules.instrumentation = Module()
+ctx.modules.instrumentation.mount("code/python-packages/instrumentation.py")
+
+ctx.modules.toeplitz = Module()
+ctx.modules.toeplitz.mount("code/python-packages/toeplitz.py")
+
 ctx.modules.inference = Module()
 ctx.modules.inference.mount("code/python-packages/inference.py")
 
+ctx.modules.plotting = Module()
+ctx.modules.plotting.mount("code/python-packages/plotting.py")
+
+ctx.modules.result_store = Module()
+ctx.modules.result_store.mount("code/python-packages/result_store.py")
+
 ctx.code.make_alphagrid = Cell("code")
 ctx.code.make_alphagrid.mount("code/make_alphagrid.py")
 
@@ -77,6 +205,8 @@ tf = ctx.transformers.make_alphagrid = Transformer()
 tf.code = ctx.code.make_alphagrid
 
 tf.inference = ctx.modules.inference
+tf.toeplitz = ctx.modules.toeplitz
+tf.instrumentation = ctx.modules.instrumentation
 
 tf.alpha_in = ctx.parameters3.alpha_in
 
@@ -93,9 +223,10 @@ ctx.code.inference_convergence = Cell("code")
 ctx.code.inference_convergence.mount("code/inference_convergence.py")
 
 tf = ctx.transformers.inference_convergence = Transformer()
-tf.code = ctx.code.inference_convergence
 
 tf.inference = ctx.modules.inference
+tf.toeplitz = ctx.modules.toeplitz
+tf.instrumentation = ctx.modules.instrumentation
 
 ctx.modules.gaussian_processes = Module()
 ctx.modules.gaussian_processes.mount("code/python-packages/gaussian_processes.py")
@@ -113,19 +244,17 @@ tf.alpha_in = ctx.parameters3.alpha_in
 tf.alpha_grid = ctx.alpha_grid
 tf.trajectory_lengths = ctx.parameters3.trajectory_lengths
 tf.n_traj_convergence = ctx.parameters3.n_traj_convergence
-tf.meta = {"ncores": -1} # uses all cores of the machine. Not used in Seamless at the moment.
-
-ctx.translate()
-
-# Seamless can run computations in parallel, but that would flood the local machine
-# Disable if a Seamless job manager has been set up
-ctx.compute(report=30)
-
-os.makedirs("results/inference_convergence", exist_ok=True)
-ctx.results.inference_convergence = FolderCell()
-ctx.results.inference_convergence = tf.result
-ctx.results.inference_convergence.mount("results/inference_convergence", "w")
-ctx.compute()
+tf.adaptive_trajectories = ctx.parameters3.adaptive_trajectories
+tf.profiling = ctx.parameters3.profiling
+tf.plotting = ctx.modules.plotting
+tf.result_store = ctx.modules.result_store
+tf.plots = ctx.parameters3.plots
+tf.meta = {"ncores": 1} # a single-threaded loop over small matrices
+
+scheduler.add(
+    "inference_convergence", tf, ctx.code.inference_convergence,
+    on_done=mount_result("inference_convergence", tf)
+)
 
 #########################################################
 # short_time_modification
@@ -136,44 +265,115 @@ ctx.code.short_time_modification = Cell("code")
 ctx.code.short_time_modification.mount("code/short_time_modification.py")
 
 tf = ctx.transformers.short_time_modification = Transformer()
-tf.code = ctx.code.short_time_modification
 
 tf.fbm = ctx.modules.fbm
 tf.inference = ctx.modules.inference
+tf.toeplitz = ctx.modules.toeplitz
 tf.gaussian_processes = ctx.modules.gaussian_processes
 tf.reproducible_random_numbers = ctx.modules.reproducible_random_numbers
+tf.instrumentation = ctx.modules.instrumentation
 
 tf.alpha_in = ctx.parameters3.alpha_in
 tf.alpha_grid = ctx.alpha_grid
 tf.trajectory_lengths = ctx.parameters3.trajectory_lengths
 tf.n_traj_convergence = ctx.parameters3.n_traj_convergence
 tf.n_traj_ml_estimate = ctx.parameters3.n_traj_ml_estimate
-tf.meta = {"ncores": -1} # uses all cores of the machine. Not used in Seamless at the moment.
-
-ctx.translate()
-
-# Seamless can run computations in parallel, but that would flood the local machine
-# Disable if a Seamless job manager has been set up
-ctx.compute(report=30)
-
-os.makedirs("results/short_time_modification", exist_ok=True)
-ctx.results.short_time_modification = FolderCell()
-ctx.results.short_time_modification = tf.result
-ctx.results.short_time_modification.mount("results/short_time_modification", "w")
-ctx.compute()
+tf.adaptive_trajectories = ctx.parameters3.adaptive_trajectories
+tf.profiling = ctx.parameters3.profiling
+tf.plotting = ctx.modules.plotting
+tf.result_store = ctx.modules.result_store
+tf.plots = ctx.parameters3.plots
+tf.meta = {"ncores": 1} # a single-threaded loop over small matrices
+
+scheduler.add(
+    "short_time_modification", tf, ctx.code.short_time_modification,
+    on_done=mount_result("short_time_modification", tf)
+)
 
 #########################################################
 # lipid analysis
 #########################################################
 
+ctx.modules.likelihood_cache = Module()
+ctx.modules.likelihood_cache.mount("code/python-packages/likelihood_cache.py")
+
+ctx.modules.lipid_analysis_common_code = Module()
+ctx.modules.lipid_analysis_common_code.mount("code/python-packages/lipid_analysis_common_code.py")
+
+ctx.code.lipid_estimate = Cell("code")
+ctx.code.lipid_estimate.mount("code/lipid_estimate.py")
+ctx.code.lipid_convergence = Cell("code")
+ctx.code.lipid_convergence.mount("code/lipid_convergence.py")
 ctx.code.lipid_analysis = Cell("code")
 ctx.code.lipid_analysis.mount("code/lipid_analysis.py")
+ctx.code.lipid_msd = Cell("code")
+ctx.code.lipid_msd.mount("code/lipid_msd.py")
+ctx.code.lipid_time_resolved = Cell("code")
+ctx.code.lipid_time_resolved.mount("code/lipid_time_resolved.py")
+ctx.code.lipid_options = Cell("code")
+ctx.code.lipid_options.mount("code/lipid_options.py")
+
+# The options of the lipid estimates are reduced to those that affect
+#  the results (see lipid_options.py). Runs instantly, not scheduled.
+
+tf = ctx.transformers.lipid_options = Transformer()
+tf.code = ctx.code.lipid_options
+tf.lipid_estimator = ctx.parameters3.lipid_estimator
+tf.likelihood_method = ctx.parameters3.likelihood_method
+tf.pcg_tolerance = ctx.parameters3.pcg_tolerance
+tf.n_bootstrap = ctx.parameters3.n_bootstrap
+tf.lipid_heterogeneity = ctx.parameters3.lipid_heterogeneity
+ctx.lipid_options = tf.result
+ctx.lipid_options.celltype = "plain"
+
+ctx.modules.msd = Module()
+ctx.modules.msd.mount("code/python-packages/msd.py")
 
 ctx.short_time_trajectory_times = ctx.data["data/short_time_trajectory/particles/universe/position/time.npy"]
 ctx.short_time_trajectory_positions = ctx.data["data/short_time_trajectory/particles/universe/position/value.npy"]
 ctx.long_time_trajectory_times = ctx.data["data/long_time_trajectory/particles/universe/position/time.npy"]
 ctx.long_time_trajectory_positions = ctx.data["data/long_time_trajectory/particles/universe/position/value.npy"]
 
+lipid_trajectories = {
+    "st": ("short_time", ctx.short_time_trajectory_times, ctx.short_time_trajectory_positions),
+    "lt": ("long_time", ctx.long_time_trajectory_times, ctx.long_time_trajectory_positions),
+}
+
+# The lipid analysis is split into one transformer per
+#  (trajectory, L, sampling step) estimate, and one per (trajectory, L, sampling step)
+#  convergence plot. Each of them is cached individually, so that changing
+#  one entry in parameters.yaml only recomputes that entry, and each of them
+#  can be delegated as a separate job.
+# L and s are set as constants, rather than being connected to parameters.yaml.
+#  Therefore, the build script must be re-run after adding sampling steps;
+#  all existing estimates will be retrieved from cache.
+
+ctx.lipid_estimates = Context()
+ctx.lipid_convergences = Context()
+
+def lipid_transformer(label, l, s):
+    _, times, positions = lipid_trajectories[label]
+    tf = Transformer()
+    tf.fbm = ctx.modules.fbm
+    tf.inference = ctx.modules.inference
+    tf.toeplitz = ctx.modules.toeplitz
+    tf.instrumentation = ctx.modules.instrumentation
+    tf.lipid_analysis_common_code = ctx.modules.lipid_analysis_common_code
+    tf.trajectory_times = times
+    tf.trajectory_positions = positions
+    tf.l = l
+    tf.s = s
+    tf.profiling = ctx.parameters3.profiling
+    tf.meta = {"ncores": 1}
+
+    # Set WORKFLOW_DIRECT_PRINT=1 to print the progress of the calculation.
+    #   This forces local execution (no job delegation to a cluster), so it
+    #   is off by default.
+    # Note that debug settings are not stored in the workflow
+    if direct_print:
+        tf.debug.direct_print = True
+    return tf
+
 #########################################################
 # lipid analysis, l=10
 #   runs in ~30 mins on a laptop
@@ -189,42 +389,110 @@ ctx.long_time_trajectory_positions = ctx.data["data/long_time_trajectory/particl
 #
 #########################################################
 
+# The MSD and increment autocovariance for all lags do not depend on L,
+#  and are computed once per trajectory.
+
+ctx.lipid_msds = Cell()
+for label, (_, times, positions) in lipid_trajectories.items():
+    tf_attr = "lipid_msd_{}".format(label)
+    tf = ctx.transformers[tf_attr] = Transformer()
+    tf.msd = ctx.modules.msd
+    tf.instrumentation = ctx.modules.instrumentation
+    tf.trajectory_times = times
+    tf.trajectory_positions = positions
+    tf.profiling = ctx.parameters3.profiling
+    tf.meta = {"ncores": 1}
+    setattr(ctx.lipid_msds, label, tf.result)
+    scheduler.add(tf_attr, tf, ctx.code.lipid_msd)
+
+ctx.compute()
+lipid_analysis_parameters = ctx.parameters2.value["lipid_analysis"]
+
 # By default, only l=10 and l=50 are run because of CPU time
 # Remove the [:2] in the next line to enable them.
 for analysis_index, l in enumerate([10, 50, 100, 200][:2]):
+    params = lipid_analysis_parameters[analysis_index]
+    assert params["l"] == l, (params["l"], l)
     attr = "lipid_analysis_l_{}".format(l)
+    ctx.lipid_estimates[attr] = Cell()
+    ctx.lipid_convergences[attr] = Cell()
+    estimates = ctx.lipid_estimates[attr]
+    convergences = ctx.lipid_convergences[attr]
+    dependencies = ["lipid_msd_{}".format(label) for label in lipid_trajectories]
+
+    for label, (trajectory_name, _, _) in lipid_trajectories.items():
+        for s in params["sampling_step_size"][trajectory_name]:
+            key = "{}_s_{}".format(label, s)
+            tf_attr = "lipid_estimate_{}_l_{}_s_{}".format(label, l, s)
+            tf = ctx.transformers[tf_attr] = lipid_transformer(label, l, s)
+            tf.lipid_options = ctx.lipid_options
+            tf.likelihood_cache = ctx.modules.likelihood_cache
+            setattr(estimates, key, tf.result)
+            scheduler.add(tf_attr, tf, ctx.code.lipid_estimate)
+            dependencies.append(tf_attr)
+
+        for s in params["convergence_timesteps"][trajectory_name]:
+            key = "{}_s_{}".format(label, s)
+            tf_attr = "lipid_convergence_{}_l_{}_s_{}".format(label, l, s)
+            tf = ctx.transformers[tf_attr] = lipid_transformer(label, l, s)
+            setattr(convergences, key, tf.result)
+            scheduler.add(tf_attr, tf, ctx.code.lipid_convergence)
+            dependencies.append(tf_attr)
+
+    # Light-weight aggregation: table and plots for this L
+
     tf = ctx.transformers[attr] = Transformer()
-    tf.code = ctx.code.lipid_analysis
 
-    tf.fbm = ctx.modules.fbm
-    tf.inference = ctx.modules.inference
+    tf.instrumentation = ctx.modules.instrumentation
+    tf.plotting = ctx.modules.plotting
+    tf.result_store = ctx.modules.result_store
+    tf.msd = ctx.modules.msd
     tf.lipid_analysis_parameters = ctx.parameters3.lipid_analysis[analysis_index]
-    tf.short_time_trajectory_times = ctx.short_time_trajectory_times
-    tf.short_time_trajectory_positions = ctx.short_time_trajectory_positions
-    tf.long_time_trajectory_times = ctx.long_time_trajectory_times
-    tf.long_time_trajectory_positions = ctx.long_time_trajectory_positions
+    tf.estimates = estimates
+    tf.convergences = convergences
+    tf.msds = ctx.lipid_msds
+    tf.profiling = ctx.parameters3.profiling
+    tf.plots = ctx.parameters3.plots
 
-    tf.meta = {"ncores": -1} # uses all cores of the machine. Not used in Seamless at the moment.
+    tf.meta = {"ncores": 1}
 
-    # This will print the progress of the calculation, but it will also force 
-    #   local execution (no job delegation to a cluster)
-    # Note that debug settings are not stored in the workflow
-    tf.debug.direct_print = True 
-
-    ctx.translate()
-
-    # Seamless can run computations in parallel, but that would flood the local machine
-    # Disable if a Seamless job manager has been set up
-    print(attr)
-    ctx.compute(report=30)
-    print(tf.logs)
-    print()
-    
-    result_dir = os.path.join("results", attr)
-    os.makedirs(result_dir, exist_ok=True)
-    ctx.results[attr] = FolderCell()
-    ctx.results[attr] = tf.result
-    ctx.results[attr].mount(result_dir, "w")
-    ctx.translate()
+    scheduler.add(
+        attr, tf, ctx.code.lipid_analysis, after=dependencies,
+        on_done=mount_result(attr, tf, print_logs=True)
+    )
+
+#########################################################
+# time-resolved lipid analysis
+#   DISABLED by default (time_resolved in parameters.yaml)
+#########################################################
+
+# Like L and s above, the time-resolved (L, s) combinations are set as
+#  constants, and their results are stored directly.
+
+time_resolved_parameters = ctx.parameters2.value["time_resolved"]
+if time_resolved_parameters["enabled"]:
+    for l in time_resolved_parameters["l"]:
+        for label, (trajectory_name, _, _) in lipid_trajectories.items():
+            for s in time_resolved_parameters["sampling_step_size"][trajectory_name]:
+                tf_attr = "lipid_time_resolved_{}_l_{}_s_{}".format(label, l, s)
+                tf = ctx.transformers[tf_attr] = lipid_transformer(label, l, s)
+                tf.label = label
+                tf.stride = ctx.parameters3.time_resolved.stride
+                tf.lipid_options = ctx.lipid_options
+                tf.plotting = ctx.modules.plotting
+                tf.result_store = ctx.modules.result_store
+                tf.plots = ctx.parameters3.plots
+                scheduler.add(
+                    tf_attr, tf, ctx.code.lipid_time_resolved,
+                    on_done=mount_result(tf_attr, tf)
+                )
+
+ctx.translate()
+
+#########################################################
+# Run all scheduled transformers
+#########################################################
+
+scheduler.run()
 
 ctx.save_graph("bayesian_inference_fbm.seamless")
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+Convert an MD trajectory directory, i.e.
+
+  <source_directory>/particles/universe/position/value.npy  (frames, lipids, 3)
+  <source_directory>/particles/universe/position/time.npy   (frames,)
+
+into a lipid-major trajectory store with decimated levels (see
+code/python-packages/trajectory_store.py). By default, the levels are the
+sampling step sizes in parameters.yaml for the given trajectory
+(short_time or long_time), for all values of L.
+
+The store is optional: it does not change any result, it only makes the
+reads by read_trajectory sequential and proportional to the data used.
+
+Example:
+
+  python3 build-trajectory-store.py data/long_time_trajectory \\
+      data/long_time_trajectory_store --trajectory long_time
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import sys
+import os
+import argparse
+import importlib
+import numpy as np
+import yaml
+
+currdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(currdir, "code"))
+trajectory_store = importlib.import_module("python-packages.trajectory_store")
+
+def parameter_levels(trajectory_name):
+    with open(os.path.join(currdir, "parameters.yaml")) as f:
+        parameters = yaml.safe_load(f)
+    levels = set()
+    for analysis in parameters["lipid_analysis"]:
+        levels.update(analysis["sampling_step_size"][trajectory_name])
+        levels.update(analysis["convergence_timesteps"][trajectory_name])
+    return sorted(levels)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("source_directory")
+    parser.add_argument("target_directory")
+    parser.add_argument("--trajectory", choices=["short_time", "long_time"],
+                        help="Take the levels from parameters.yaml for this trajectory")
+    parser.add_argument("--levels", type=int, nargs="+",
+                        help="Explicit decimation levels")
+    parser.add_argument("--block-frames", type=int, default=4096,
+                        help="Number of frames read at once")
+    args = parser.parse_args()
+    if args.levels:
+        levels = args.levels
+    elif args.trajectory:
+        levels = parameter_levels(args.trajectory)
+    else:
+        parser.error("either --trajectory or --levels is required")
+
+    posdir = os.path.join(args.source_directory, "particles", "universe", "position")
+    time = np.load(os.path.join(posdir, "time.npy"))
+    positions = np.load(os.path.join(posdir, "value.npy"), mmap_mode="r")
+    print("Build trajectory store, levels:", levels, file=sys.stderr)
+    trajectory_store.build(
+        args.target_directory, time, positions, levels,
+        block_frames=args.block_frames
+    )
+
+if __name__ == "__main__":
+    main()
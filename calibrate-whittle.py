@@ -0,0 +1,100 @@
+"""
+Calibrate the Whittle approximation of the likelihood against the exact
+likelihood, on synthetic fBM trajectories of small length L.
+
+For each L and each true alpha, --samples sets of --n trajectories are
+generated. For each set, alpha is estimated on an alpha grid from the
+exact log-likelihood (inference.log_likelihood) and from the Whittle
+approximation (inference.quadratic_forms_whittle). The report lists the
+mean estimates, the mean and root-mean-square difference between the
+Whittle and the exact estimates, and the mean widths of the
+log-likelihood peaks (at half maximum, as in the plots). The difference
+in the log-likelihood curves themselves is reported as the largest
+deviation, after aligning the maxima, over the grid points whose exact
+log-likelihood is within --window of the maximum.
+
+Example:
+
+  python3 calibrate-whittle.py --lengths 10 20 50 100 200 --alphas 0.3 0.55 1.0 1.5
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import sys
+import os
+import argparse
+import importlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "code"))
+fbm = importlib.import_module("python-packages.fbm")
+inference = importlib.import_module("python-packages.inference")
+gaussian_processes = importlib.import_module("python-packages.gaussian_processes")
+
+def make_trajectories(alpha, l, n):
+    increments = gaussian_processes.make_stationary_trajectories(
+        fbm.sigma_i_acov(alpha)(l), n
+    )
+    return np.cumsum(increments, axis=1)
+
+def whittle_log_likelihood(trajectories, grid):
+    q, log_det = inference.quadratic_forms_whittle(
+        trajectories, fbm.sigma_i_spectrum, grid)
+    return -0.5*(q.sum(axis=0) + len(trajectories)*log_det)
+
+def peak_width(grid, log_lh):
+    _, low, high = inference.spread(grid, log_lh)
+    return high - low
+
+def calibrate(l, alpha, n, samples, grid, window):
+    exact = []
+    whittle = []
+    widths = []
+    deviation = 0.
+    for _ in range(samples):
+        trajectories = make_trajectories(alpha, l, n)
+        log_lh_exact = inference.log_likelihood(trajectories, fbm.sigma_p, grid)
+        log_lh_whittle = whittle_log_likelihood(trajectories, grid)
+        exact.append(grid[np.argmax(log_lh_exact)])
+        whittle.append(grid[np.argmax(log_lh_whittle)])
+        widths.append((peak_width(grid, log_lh_exact),
+                       peak_width(grid, log_lh_whittle)))
+        near_peak = log_lh_exact >= log_lh_exact.max() - window
+        difference = (log_lh_whittle - log_lh_whittle.max()) \
+                   - (log_lh_exact - log_lh_exact.max())
+        deviation = max(deviation, np.abs(difference[near_peak]).max())
+    exact = np.array(exact)
+    whittle = np.array(whittle)
+    widths = np.array(widths).mean(axis=0)
+    return (exact.mean(), whittle.mean(), (whittle-exact).mean(),
+            np.sqrt(((whittle-exact)**2).mean()), widths[0], widths[1], deviation)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 20, 50, 100, 200])
+    parser.add_argument("--alphas", type=float, nargs="+", default=[0.3, 0.55, 1.0, 1.5])
+    parser.add_argument("--n", type=int, default=64, help="Number of trajectories")
+    parser.add_argument("--samples", type=int, default=20,
+                        help="Number of trajectory sets for each L and alpha")
+    parser.add_argument("--grid-points", type=int, default=200,
+                        help="Number of alpha values")
+    parser.add_argument("--window", type=float, default=10.,
+                        help="Log-likelihood range below the maximum that is compared")
+    args = parser.parse_args()
+
+    grid = np.linspace(0.01, 1.99, args.grid_points)
+    print("%6s %6s  %8s %8s %8s %8s  %8s %8s  %10s" % (
+        "L", "alpha", "exact", "whittle", "bias", "rms", "width", "width_w",
+        "deviation"))
+    for l in args.lengths:
+        for alpha in args.alphas:
+            print("%6d %6.2f  %8.4f %8.4f %8.4f %8.4f  %8.4f %8.4f  %10.3f" % (
+                (l, alpha) + calibrate(l, alpha, args.n, args.samples, grid,
+                                       args.window)))
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
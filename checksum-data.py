@@ -0,0 +1,115 @@
+"""
+Compute the Seamless checksums (SHA3-256) of all files in data/, write
+them to data-checksums.list ("<path> <checksum>" per line, as before) and
+hard-link each file into seamless-db/buffers/<checksum>.
+
+Files are hashed in parallel, with large buffered reads. The checksums
+are cached in a JSON file, keyed by path, size, modification time and
+inode, so that only new or modified files are hashed again.
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+read_size = 16 * 1024 * 1024
+
+def sha3_checksum(filename):
+    checksum = hashlib.sha3_256()
+    buffer = bytearray(read_size)
+    view = memoryview(buffer)
+    with open(filename, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            checksum.update(view[:n])
+    return checksum.hexdigest()
+
+def find_files(directory):
+    filenames = []
+    for dirpath, dirnames, files in os.walk(directory):
+        for filename in files:
+            filenames.append(os.path.join(dirpath, filename))
+    return sorted(filenames)
+
+def file_key(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+def load_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as f:
+        return json.load(f)
+
+def save_cache(cache, cache_file):
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+
+# Return the checksums of all files, hashing only those whose
+#  (size, mtime, inode) are not in the cache. The cache is updated in place.
+
+def checksum_files(filenames, cache, workers):
+    keys = {filename: file_key(filename) for filename in filenames}
+    todo = [filename for filename in filenames
+            if filename not in cache or cache[filename]["key"] != keys[filename]]
+    print("%d files, %d cached, %d to checksum" % (
+        len(filenames), len(filenames) - len(todo), len(todo)), file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filename, checksum in zip(todo, executor.map(sha3_checksum, todo)):
+            cache[filename] = {"key": keys[filename], "checksum": checksum}
+            print(filename, checksum)
+    for filename in list(cache):
+        if filename not in keys:
+            del cache[filename]
+    return {filename: cache[filename]["checksum"] for filename in filenames}
+
+# Equivalent to "ln -f", but a link that is already in place is kept.
+
+def link_buffer(filename, buffer_dir, checksum):
+    target = os.path.join(buffer_dir, checksum)
+    if os.path.exists(target):
+        if os.path.samefile(filename, target):
+            return
+        os.remove(target)
+    os.link(filename, target)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--buffer-dir", default="seamless-db/buffers",
+                        help="Directory where hard links are created. Use '' to disable")
+    parser.add_argument("--checksum-list", default="data-checksums.list")
+    parser.add_argument("--cache", default="data-checksums.cache.json")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    filenames = find_files(args.data_dir)
+    cache = load_cache(args.cache)
+    try:
+        checksums = checksum_files(filenames, cache, args.workers)
+    finally:
+        save_cache(cache, args.cache)
+
+    with open(args.checksum_list, "w") as f:
+        for filename in filenames:
+            f.write("%s %s\n" % (filename, checksums[filename]))
+
+    if args.buffer_dir:
+        os.makedirs(args.buffer_dir, exist_ok=True)
+        for filename in filenames:
+            link_buffer(filename, args.buffer_dir, checksums[filename])
+
+if __name__ == "__main__":
+    main()
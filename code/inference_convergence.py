@@ -2,32 +2,87 @@
 
 # Import common scientific libraries
 
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
-from io import BytesIO
 
 # Import modules from this ActivePaper
 
 from .gaussian_processes import make_trajectories
 from .fbm import sigma_p, mod_sigma_p, subsample_sigma
-from .inference import merge_grids, max_lh_estimate, plot_convergence
+from .inference import merge_grids, max_lh_estimate, convergence, \
+    adaptive_convergence
+from .instrumentation import enable, reset, dump_json
+from .toeplitz import limit_threads
+from .plotting import Renderer, render_convergence
+from .result_store import pack, convergence_arrays
+
+# Instrumentation is switched on from `parameters.yaml`.
+
+enable(profiling)
+reset()
+
+# The build script reserves a single core for this transformer
+# (`meta["ncores"]`) and runs others on the remaining cores, so the
+# computation itself must use a single thread.
+
+limit_threads(1)
+
+# Plots are rendered in the background, or not at all if `plots`
+# is false in `parameters.yaml`.
+
+renderer = Renderer(enabled=plots)
 
 ### Convergence for different lengths of input trajectories
 
 # Produce a convergence plot for 1000 trajectories for each trajectory
-# length.
+# length. In the adaptive mode (see `parameters.yaml`), trajectories
+# are only generated until the cumulative estimate has converged, and
+# the number used is stored with the results.
+
+adaptive = adaptive_trajectories["enabled"]
+tolerances = {
+    "width_tolerance": adaptive_trajectories["width_tolerance"],
+    "mle_tolerance": adaptive_trajectories["mle_tolerance"],
+    "mle_batches": adaptive_trajectories["mle_batches"],
+}
 
 result = {}
+arrays = {}
 for l in trajectory_lengths:
-    plot_convergence(make_trajectories(sigma_p(alpha_in)(l),
-                                       n_traj_convergence),
-                     sigma_p, alpha_grid, r"$\alpha$", alpha_in)
-    plt.suptitle(r"fBM trajectories, $L = %d$" % l, fontsize=20)
+    sigma = sigma_p(alpha_in)(l)
+    if adaptive:
+        peak_and_limits, cumulative_peak_and_limits = \
+            adaptive_convergence(lambda n: make_trajectories(sigma, n),
+                                 sigma_p, alpha_grid, n_traj_convergence,
+                                 adaptive_trajectories["batch_size"],
+                                 **tolerances)
+        print("Convergence, L = %d: %d of %d trajectories used"
+              % (l, len(peak_and_limits), n_traj_convergence), file=sys.stderr)
+    else:
+        peak_and_limits, cumulative_peak_and_limits = \
+            convergence(make_trajectories(sigma, n_traj_convergence),
+                        sigma_p, alpha_grid)
+    arrays.update(convergence_arrays("l=%d" % l, peak_and_limits,
+                                     cumulative_peak_and_limits))
+    arrays["l=%d/n_trajectories" % l] = len(peak_and_limits)
     fname = 'inference_convergence/convergence_fbm_l=%d.png' % l
-    png = BytesIO()
-    plt.savefig(png)
-    #result[fname] = png.getvalue() # bug in Seamless
-    result[fname] = np.array(png.getvalue()) # workaround
+    renderer.submit(fname, render_convergence,
+                    peak_and_limits, cumulative_peak_and_limits,
+                    r"$\alpha$", alpha_in,
+                    title=r"fBM trajectories, $L = %d$" % l)
+
+# The numerical results are stored in an .npz archive (see `result_store`).
+
+npz = pack(alpha_in=alpha_in, alpha_grid=alpha_grid,
+           trajectory_lengths=np.array(trajectory_lengths), **arrays)
+result['inference_convergence/results.npz'] = np.array(npz) # workaround
+
+for fname, png in renderer.collect().items():
+    #result[fname] = png # bug in Seamless
+    result[fname] = np.array(png) # workaround
+
+if profiling:
+    result['inference_convergence/profile.json'] = dump_json()
 
 #@image inference_convergence/convergence_fbm_l=10.png
 
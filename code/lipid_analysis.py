@@ -1,111 +1,30 @@
 # ## %T %n: Center-of-mass diffusion of lipids in a membrane
 
-# ### Use the common code for all $L$.
+# The estimates and convergence data for each (trajectory, $L$, $s$)
+# are computed by separate transformers (`lipid_estimate.py` and
+# `lipid_convergence.py`), and the mean squared displacement of each
+# trajectory by `lipid_msd.py`. Here, they are collected for one value
+# of $L$, tabulated and plotted.
 
-import sys
-from io import StringIO, BytesIO
+from io import StringIO
 
 # Import common scientific libraries
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 # Import modules from this ActivePaper
 
-from .fbm import sigma_p
-from .inference import merge_grids, max_lh_estimate, plot_convergence
+from .instrumentation import merge_profiles, dump_json
+from .result_store import pack, convergence_arrays
+from .msd import local_exponent
+from .plotting import Renderer, new_figure, figure_to_png, render_convergence
 
-# ### I/O and preprocessing
+# Plots are rendered in the background, or not at all if `plots`
+# is false in `parameters.yaml`.
 
-# The trajectories contain the $x$, $y$, $z$ coordinates of the lipid
-# centers of masses at each time step. We read only the $x$ and $y$
-# coordinates, $z$ being the direction perpendicular to the membrane
-# plane. More over, we shift $x$ and $y$ to 0 at $t=0$ and then
-# discard the first point, which is no longer of interest. Finally,
-# because the $x$ and $y$ trajectories are equivalent, we fuse the
-# "molecule number" and "xyz" array axes, returning a 2d array with $2
-# N$ single-coordinate trajectories for a system containing $N$
-# lipids. We also retrieve the sampling timestep from the trajectory.
+renderer = Renderer(enabled=plots)
 
-def read_trajectory(time_trajectory, position_trajectory, max_steps, sample):
-    time = time_trajectory[0:2*sample:sample]
-    positions = position_trajectory[0:sample*(max_steps+1):sample, :, :2]
-    data = positions[1:] - positions[0]
-    data.shape = (data.shape[0], 2*data.shape[1])
-    return time[1]-time[0], data.T
-
-# The fBM inference procedure assumes $2 D_\alpha \Delta t^\alpha=1$
-# for simplicity. Therefore we estimate this quantity from the
-# increments and divide all coordinates by its square root. Note that
-# the variable `D` actually represents $2 D_\alpha \Delta t^\alpha$,
-# as everywhere else in the code.
-
-def estimate_d_and_normalize(ts):
-    increments = ts[:, 1:] - ts[:, :-1]
-    cov = (increments[:, np.newaxis, :]*increments[:, :, np.newaxis]) \
-          .mean(axis=0)
-    d = cov.diagonal().mean()
-    return d, ts/np.sqrt(d)
-
-# ### Data
-
-# We have two trajectories for the same system: a short-time trajectory
-# of 300 ps, sampled every 0.03 ps, and a long-time trajectory of 600 ns,
-# sampled every 18 ps.
-
-short_time = short_time_trajectory_times, short_time_trajectory_positions
-long_time = long_time_trajectory_times, long_time_trajectory_positions
-
-# ### Probability densities as a function of $\alpha$
-
-# We construct a grid of the $\alpha$ values that will be used in the
-# inference procedure. It covers the whole range $0..2$ but it is
-# denser around `alpha_focus`, where the most interesting data will be
-# seen. Note that there is no bias towards this `alpha_focus` in the
-# inference procedure, the denser grid only makes for more detailed plots
-# in this region.
-
-alpha_focus = 0.55
-
-alpha_grid = merge_grids(np.linspace(0.01, 2.-0.01, 200),
-                         np.linspace(alpha_focus-0.3, alpha_focus+0.3, 200))
-
-# ### Estimation of $\alpha$
-
-# We compute estimates for $2 D_\alpha \Delta t^{alpha}$, normalize the
-# trajectories to $2 D_\alpha \Delta t^{alpha} \to 1$, and then compute
-# a maximum-likelihood estimate of $\alpha$. This is done for several
-# input trajectories and several sampling step sizes.
-
-def estimate_parameters(trajectories, l):
-
-    output = StringIO()
-
-    output.write("dt, alpha, 2 * D * dt^alpha\n")
-
-    dts = []
-    alphas = []
-    ds = []
-    for trajectory, ss in trajectories:
-        print("Estimate parameters, sampling steps:", ss, file=sys.stderr)
-        for s in ss:
-            print("Estimate parameters, sampling step:", s, file=sys.stderr)
-            dt, tr = read_trajectory(*trajectory, l, s)
-            # Make sure we actually got $L$ steps - it might be less.
-            # NOTE: this will fail if the provided trajectory is too short!
-            assert tr.shape[1] == l, (tr.shape, l)
-            d, tr = estimate_d_and_normalize(tr)
-            alpha = max_lh_estimate(tr, sigma_p, alpha_grid)
-            dts.append(dt)
-            alphas.append(alpha)
-            ds.append(d)
-            output.write("%f, %f, %f\n" % (dts[-1], alphas[-1], ds[-1]))
-
-    dts = np.array(dts)
-    alphas = np.array(alphas)
-    ds = np.array(ds)
-
-    return dts, alphas, ds, output.getvalue()
+# ### Plots
 
 # For comparison, we show fBM with the three parameter fits from
 # [Stachura & Kneller 2015](http://dx.doi.org/10.1063/1.4936129)
@@ -137,21 +56,32 @@ m = 936.  # g/mol
 d_2 = 0.5*kT/m
 
 
-def plot_parameters(dts, alphas, ds, t_max):
-
-# First, some final computations:
-#  - $\alpha$ and $D$ averaged over the asymptoti regime, which 
-#    correponds to $\Delta t > 10$
-#  - the characteristic diffusion time $\tau$, computed from $D$,
-#    $\alpha$, and the diffusion constant of ballistic motion.
+# The plots show $\alpha$ and $D$ averaged over the asymptotic regime,
+# which correponds to $\Delta t > 10$, and the characteristic
+# diffusion time $\tau$, computed from $D$, $\alpha$, and the
+# diffusion constant of ballistic motion.
 
+def asymptotic_parameters(dts, alphas, ds):
     alpha_mean = alphas.repeat(dts > 10.).mean()
     d_mean = (0.5*ds.repeat(dts > 10.)/(dts.repeat(dts > 10.)**alpha_mean)).mean()
     tau = (d_mean/d_2)**(1./(2.-alpha_mean))
+    return alpha_mean, d_mean, tau
+
+# The curves from the time-averaged MSD of the full trajectories
+# (see `lipid_msd.py`), if given, are added as thin lines. Each curve
+# is a tuple of the lag times, the local exponent of the MSD, and the
+# MSD itself.
+
+def render_parameters(dts, alphas, ds, t_max, msd_curves=()):
+
+# First, the final computations.
+
+    alpha_mean, d_mean, tau = asymptotic_parameters(dts, alphas, ds)
 
 # We prepare the plot...
 
-    fig, axs = plt.subplots(2, 1, sharex=True, sharey=False)
+    fig = new_figure()
+    axs = fig.subplots(2, 1, sharex=True, sharey=False)
     dash_style = [10, 3, 3, 3]
 
 # and first plot the estimate for $\alpha$...
@@ -161,6 +91,8 @@ def plot_parameters(dts, alphas, ds, t_max):
              marker="o", markersize=10,
              linestyle='--')
     axs[0].set_ylabel(r"$\alpha_{ML}$")
+    for lag_times, msd_alphas, _ in msd_curves:
+        axs[0].plot(lag_times, msd_alphas, color='gray', linewidth=1)
 
 # next, the asymptotic fBM...
 
@@ -202,6 +134,8 @@ def plot_parameters(dts, alphas, ds, t_max):
                 marker="s", markersize=10,
                 linestyle='--')
     axs[1].set_ylabel(r"$2 D_\alpha \Delta t^{\alpha}$ [nm$^2$]")
+    for lag_times, _, msd_values in msd_curves:
+        axs[1].plot(lag_times, msd_values, color='gray', linewidth=1)
 
 # plus the asymptotic fBM...
 
@@ -238,9 +172,7 @@ def plot_parameters(dts, alphas, ds, t_max):
 
     axs[1].legend(loc='lower right')
 
-    png = BytesIO()
-    plt.savefig(png)
-    return png.getvalue()
+    return figure_to_png(fig)
 
 
 # Another plot shows $D_\alpha$ directly, rather than the combination
@@ -250,52 +182,52 @@ def plot_parameters(dts, alphas, ds, t_max):
 # from a computational point of view. Note also that the units of
 # $D_\alpha$ depend on $\alpha$ and thus vary across the plot!
 
-def plot_D(dts, alphas, ds, t_max):
+def render_D(dts, alphas, ds, t_max, msd_curves=()):
 
-# We need to re-do the computation of the averages.
+# We need the averages again.
 
-    alpha_mean = alphas.repeat(dts > 10.).mean()
-    d_mean = (0.5*ds.repeat(dts > 10.)/(dts.repeat(dts > 10.)**alpha_mean)).mean()
-    tau = (d_mean/d_2)**(1./(2.-alpha_mean))
+    alpha_mean, d_mean, tau = asymptotic_parameters(dts, alphas, ds)
 
 # We start the plot with the valued of $D_\alpha$
 
     dash_style = [10, 3, 3, 3]
-    plt.figure()
-    plt.plot(dts, 0.5*ds/(dts**alphas),
-             marker="o", markersize=10,
-             linestyle='--')
-    plt.xscale('log')
-    plt.xlabel(r"$\Delta t$ [ps]")
-    plt.ylabel(r"$D_\alpha$ [nm$^2$/ps$^\alpha$]")
+    fig = new_figure()
+    ax = fig.subplots()
+    ax.plot(dts, 0.5*ds/(dts**alphas),
+            marker="o", markersize=10,
+            linestyle='--')
+    ax.set_xscale('log')
+    ax.set_xlabel(r"$\Delta t$ [ps]")
+    ax.set_ylabel(r"$D_\alpha$ [nm$^2$/ps$^\alpha$]")
+    for lag_times, msd_alphas, msd_values in msd_curves:
+        ax.plot(lag_times, 0.5*msd_values/(lag_times**msd_alphas),
+                color='gray', linewidth=1)
 
 # Again we add the asymptotic and short-time regimes plus the
 # fits from the literature.
 
     dt_values = np.array([10., t_max])
-    plt.plot(dt_values, d_mean*np.ones(dt_values.shape),
-             label=r"$D_{%.2f} = %.5f$" % (alpha_mean, d_mean),
-             color='black',
-             linestyle='--', linewidth=2) \
+    ax.plot(dt_values, d_mean*np.ones(dt_values.shape),
+            label=r"$D_{%.2f} = %.5f$" % (alpha_mean, d_mean),
+            color='black',
+            linestyle='--', linewidth=2) \
        [0].set_dashes(dash_style)
 
     dt_values = np.array([0.01, 0.05])
-    plt.plot(dt_values, d_2*np.ones(dt_values.shape),
-             label="ballistic", color='darkred',
-             linestyle='--', linewidth=2) \
+    ax.plot(dt_values, d_2*np.ones(dt_values.shape),
+            label="ballistic", color='darkred',
+            linestyle='--', linewidth=2) \
        [0].set_dashes(dash_style)
 
     dt_values = np.array([1000., t_max])
     for label, color, alpha_fit, d_alpha_fit in earlier_fits:
-        plt.plot(dt_values, np.ones(dt_values.shape)*d_alpha_fit,
-                 label=label, color=color, linestyle='--', linewidth=2) \
+        ax.plot(dt_values, np.ones(dt_values.shape)*d_alpha_fit,
+                label=label, color=color, linestyle='--', linewidth=2) \
         [0].set_dashes(dash_style)
 
-    plt.legend(loc="upper right")
+    ax.legend(loc="upper right")
 
-    png = BytesIO()
-    plt.savefig(png)
-    return png.getvalue()
+    return figure_to_png(fig)
 
 # / common code
 
@@ -309,21 +241,21 @@ result = {}
 # sampling timesteps for each of the two trajectories.
 
 timesteps = lipid_analysis_parameters["convergence_timesteps"]
-for label, trajectory, ss in [('st', short_time, timesteps["short_time"]),
-                              ('lt', long_time, timesteps["long_time"])]:
-    print("Convergence analysis, sampling steps:", ss, file=sys.stderr)
+convergence_results = {}
+for label, ss in [('st', timesteps["short_time"]),
+                  ('lt', timesteps["long_time"])]:
     for s in ss:
-        print("Convergence analysis, sampling step:", s, file=sys.stderr)
-        dt, tr = read_trajectory(*trajectory, l, s)
-        d, tr = estimate_d_and_normalize(tr)
-        plot_convergence(tr, sigma_p, alpha_grid, r"$\alpha$")
-        plt.suptitle(r"lipid trajectories, $\Delta t = %.2f$ ps" % dt, fontsize=20)
+        conv = convergences["%s_s_%d" % (label, s)]
+        convergence_results.update(convergence_arrays(
+            "convergence_%s_s=%d" % (label, s),
+            np.asarray(conv["peak_and_limits"]),
+            np.asarray(conv["cumulative_peak_and_limits"])))
         fname = 'lipid_analysis/convergence_%s_l=%d_s=%d.png' % (label, l, s)
-        png = BytesIO()
-        plt.savefig(png)
-        plot = png.getvalue()
-        plot = np.array(plot) # bug in Seamless, workaround
-        result[fname] = plot
+        renderer.submit(fname, render_convergence,
+                        np.asarray(conv["peak_and_limits"]),
+                        np.asarray(conv["cumulative_peak_and_limits"]),
+                        r"$\alpha$",
+                        title=r"lipid trajectories, $\Delta t = %.2f$ ps" % conv["dt"])
 
 # #### Short-time trajectory
 #
@@ -342,31 +274,176 @@ for label, trajectory, ss in [('st', short_time, timesteps["short_time"]),
 # ### Parameter estimation
 
 # For each of the two trajectories, and for several values of the
-# sampling step size, we estimate the parameters $\alpha$ and
-# $2 D_\alpha \Delta t^{alpha}$. The results are returned and also
-# written to a text-format table for easy access.
+# sampling step size, we have estimated the parameters $\alpha$ and
+# $2 D_\alpha \Delta t^{alpha}$. The results are collected and
+# written to a text-format table for easy access. All numerical
+# results, including the full log-likelihood curves and the
+# convergence data, are stored in an .npz archive (see `result_store`).
 
 sampling_step_size = lipid_analysis_parameters["sampling_step_size"]
-dts, alphas, ds, estimate_parameters_log = estimate_parameters(
-    trajectories = [(short_time, sampling_step_size["short_time"]),
-                    (long_time, sampling_step_size["long_time"]),
-                   ],
-    l = l,
-    )
-result['lipid_analysis/sampling_timestep_l=%d.txt' % l] = estimate_parameters_log
+
+# If confidence intervals were computed (`n_bootstrap` > 0 in
+# `parameters.yaml`), they are added to the table, and stored with
+# the other results.
+
+with_intervals = all("intervals" in est for est in estimates.values())
+
+output = StringIO()
+if with_intervals:
+    output.write("dt, alpha, 2 * D * dt^alpha, "
+                 "alpha_low, alpha_high, D_low, D_high\n")
+else:
+    output.write("dt, alpha, 2 * D * dt^alpha\n")
+labels = []
+steps = []
+dts = []
+alphas = []
+ds = []
+log_lhs = []
+d_profiles = []
+intervals = []
+for label, ss in [('st', sampling_step_size["short_time"]),
+                  ('lt', sampling_step_size["long_time"])]:
+    for s in ss:
+        est = estimates["%s_s_%d" % (label, s)]
+        labels.append(label)
+        steps.append(s)
+        dts.append(est["dt"])
+        alphas.append(est["alpha"])
+        ds.append(est["d"])
+        log_lhs.append(est["log_likelihood"])
+        if "d_profile" in est:
+            d_profiles.append(est["d_profile"])
+        output.write("%f, %f, %f" % (dts[-1], alphas[-1], ds[-1]))
+        if with_intervals:
+            intervals.append(est["intervals"])
+            output.write(", %f, %f, %f, %f"
+                         % (tuple(est["intervals"]["alpha_interval"])
+                            + tuple(est["intervals"]["d_interval"])))
+        output.write("\n")
+
+dts = np.array(dts)
+alphas = np.array(alphas)
+ds = np.array(ds)
+result['lipid_analysis/sampling_timestep_l=%d.txt' % l] = output.getvalue()
+
+# With the profile-likelihood estimator, the estimates of
+# $2 D_\alpha \Delta t^{alpha}$ as a function of $\alpha$ are stored
+# as well, and so are the confidence intervals, if any, and the
+# residuals of the conjugate gradients with `likelihood_method: pcg`.
+
+extra_results = {}
+if d_profiles:
+    extra_results["d_profile"] = np.array(d_profiles)
+if with_intervals:
+    for name in intervals[0]:
+        extra_results[name] = np.array([item[name] for item in intervals])
+if all("pcg_residual" in est for est in estimates.values()):
+    extra_results["pcg_residual"] = np.array(
+        [estimates["%s_s_%d" % (label, s)]["pcg_residual"]
+         for label, s in zip(labels, steps)])
+
+# If the distribution of $\alpha$ over the lipids was estimated
+# (`lipid_heterogeneity` in `parameters.yaml`), the mixture weights on
+# `alpha_grid` and the $\alpha$ values of the individual lipids are
+# stored for each sampling step size, under prefixed names such as
+# `heterogeneity_st_s=10/alpha_weights`. The number of lipids can
+# differ between the two trajectories. The mean and the standard
+# deviation of the mixture distribution are tabulated.
+
+with_heterogeneity = all("heterogeneity" in est for est in estimates.values())
+
+if with_heterogeneity:
+    output = StringIO()
+    output.write("dt, alpha, alpha_mixture_mean, alpha_mixture_std\n")
+    for label, ss in [('st', sampling_step_size["short_time"]),
+                      ('lt', sampling_step_size["long_time"])]:
+        for s in ss:
+            est = estimates["%s_s_%d" % (label, s)]
+            lipids = est["heterogeneity"]
+            grid = np.asarray(est["alpha_grid"])
+            for name, value in lipids.items():
+                extra_results["heterogeneity_%s_s=%d/%s" % (label, s, name)] = \
+                    np.asarray(value)
+            weights = np.asarray(lipids["alpha_weights"])
+            mean = np.dot(weights, grid)
+            std = np.sqrt(np.dot(weights, (grid-mean)**2))
+            output.write("%f, %f, %f, %f\n" % (est["dt"], est["alpha"], mean, std))
+    result['lipid_analysis/heterogeneity_l=%d.txt' % l] = output.getvalue()
+
+# ### Cross-check with the mean squared displacement
+
+# The time-averaged MSD of the full trajectories, for all lags, is an
+# independent estimate of $2 D_\alpha \Delta t^\alpha$, and its
+# local exponent is one of $\alpha$. They are tabulated next to the
+# maximum-likelihood estimates, and stored with the increment
+# autocovariance. For the plots, they are evaluated on logarithmically
+# spaced lags, up to a tenth of the trajectory length: the MSD at
+# longer lags is averaged over too few time origins.
+
+output = StringIO()
+output.write("dt, alpha, alpha_msd, 2 * D * dt^alpha, msd\n")
+msd_curves = []
+for label, ss in [('st', sampling_step_size["short_time"]),
+                  ('lt', sampling_step_size["long_time"])]:
+    msd_result = msds[label]
+    msd = np.asarray(msd_result["msd"])
+    extra_results["msd_%s/lag_time" % label] = \
+        msd_result["dt"]*np.arange(len(msd))
+    extra_results["msd_%s/msd" % label] = msd
+    extra_results["msd_%s/increment_autocovariance" % label] = \
+        np.asarray(msd_result["increment_autocovariance"])
+    msd_alphas = local_exponent(msd, ss)
+    for s, msd_alpha in zip(ss, msd_alphas):
+        est = estimates["%s_s_%d" % (label, s)]
+        output.write("%f, %f, %f, %f, %f\n" % (
+            est["dt"], est["alpha"], msd_alpha, est["d"], msd[s]))
+    lags = np.unique(np.geomspace(1, len(msd)//10, 100).astype(int))
+    msd_curves.append((msd_result["dt"]*lags, local_exponent(msd, lags), msd[lags]))
+result['lipid_analysis/msd_l=%d.txt' % l] = output.getvalue()
+
+npz = pack(
+    estimator=est["estimator"],
+    l=l,
+    trajectory=np.array(labels),
+    s=np.array(steps),
+    dt=dts,
+    alpha=alphas,
+    d=ds,
+    alpha_grid=np.asarray(est["alpha_grid"]),
+    log_likelihood=np.array(log_lhs),
+    **convergence_results,
+    **extra_results
+)
+result['lipid_analysis/results_l=%d.npz' % l] = np.array(npz) # bug in Seamless, workaround
 
 # All of this data is shown in one complex plot.
 
-plot = plot_parameters(dts, alphas, ds,
-                t_max = 100000.)
-plot = np.array(plot) # # bug in Seamless, workaround
-result['lipid_analysis/sampling_timestep_l=%d.png' % l] = plot
+renderer.submit('lipid_analysis/sampling_timestep_l=%d.png' % l,
+                render_parameters, dts, alphas, ds, t_max = 100000.,
+                msd_curves=msd_curves)
 
 #@image lipid_analysis/sampling_timestep_l=%d.png
 
-plot = plot_D(dts, alphas, ds,
-       t_max = 100000.)
-plot = np.array(plot) # # bug in Seamless, workaround       
-result['lipid_analysis/D_vs_sampling_timestep_l=%d.png' % l] = plot
+renderer.submit('lipid_analysis/D_vs_sampling_timestep_l=%d.png' % l,
+                render_D, dts, alphas, ds, t_max = 100000.,
+                msd_curves=msd_curves)
 
 #@image lipid_analysis/D_vs_sampling_timestep_l=%d.png
+
+for fname, plot in renderer.collect().items():
+    plot = np.array(plot) # bug in Seamless, workaround
+    result[fname] = plot
+
+# ### Run-time profile
+
+# If instrumentation is enabled, the counters and stage timings of
+# all estimates for this $L$ are summed and stored as JSON next to
+# the results.
+
+if profiling:
+    profiles = [item["profile"]
+                for item in list(estimates.values()) + list(convergences.values())
+                + list(msds.values())
+                if "profile" in item]
+    result['lipid_analysis/profile_l=%d.json' % l] = dump_json(merge_profiles(profiles))
@@ -0,0 +1,44 @@
+# ## %T %n: Center-of-mass diffusion of lipids: convergence for one (trajectory, $L$, $s$)
+
+# ### Prelude
+
+import sys
+
+# Import modules from this ActivePaper
+
+from .fbm import sigma_p
+from .inference import convergence
+from .lipid_analysis_common_code import read_and_normalize, alpha_grid
+from .instrumentation import enable, reset, profile
+from .toeplitz import limit_threads
+
+# Instrumentation is switched on from `parameters.yaml`.
+
+enable(profiling)
+reset()
+
+# The build script reserves a single core for this transformer
+# (`meta["ncores"]`) and runs others on the remaining cores, so the
+# computation itself must use a single thread.
+
+limit_threads(1)
+
+# ### Convergence
+
+# We illustrate the convergence of the inference procedure for one
+# sampling timestep of one trajectory. The plot is made by
+# `lipid_analysis.py`, from the arrays computed here.
+
+print("Convergence analysis, L = %d, sampling step: %d" % (l, s), file=sys.stderr)
+trajectory = trajectory_times, trajectory_positions
+dt, d, tr = read_and_normalize(trajectory, l, s)
+peak_and_limits, cumulative_peak_and_limits = \
+    convergence(tr, sigma_p, alpha_grid)
+
+result = {
+    "dt": float(dt),
+    "peak_and_limits": peak_and_limits,
+    "cumulative_peak_and_limits": cumulative_peak_and_limits,
+}
+if profiling:
+    result["profile"] = profile()
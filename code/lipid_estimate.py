@@ -0,0 +1,108 @@
+# ## %T %n: Center-of-mass diffusion of lipids: one (trajectory, $L$, $s$) estimate
+
+# ### Prelude
+
+import os
+import sys
+
+# Import common scientific libraries
+
+import numpy as np
+
+# Import modules from this ActivePaper
+
+from .lipid_analysis_common_code import estimate, estimate_profile, alpha_grid
+from .instrumentation import enable, reset, profile
+from .toeplitz import limit_threads
+from .likelihood_cache import LikelihoodCache
+
+# Instrumentation is switched on from `parameters.yaml`.
+
+enable(profiling)
+reset()
+
+# The build script reserves a single core for this transformer
+# (`meta["ncores"]`) and runs others on the remaining cores, so the
+# computation itself must use a single thread.
+
+limit_threads(1)
+
+# The options that affect the result come from `parameters.yaml`,
+# through `lipid_options.py`.
+
+estimator = lipid_options["estimator"]
+likelihood_method = lipid_options["likelihood_method"]
+pcg_tolerance = lipid_options["pcg_tolerance"]
+n_bootstrap = lipid_options["n_bootstrap"]
+lipid_heterogeneity = lipid_options["lipid_heterogeneity"]
+
+# The optional on-disk likelihood cache does not change any result, it
+# only avoids recomputing log-likelihood values for unchanged data
+# when `alpha_grid` is changed. Therefore, it is not configured by an
+# input of the transformer, which would make Seamless recompute all
+# estimates whenever the cache settings change, but by the environment
+# variables `LIKELIHOOD_CACHE_DIR` and `LIKELIHOOD_CACHE_MB` (default:
+# 1024) of the process that runs the transformer.
+
+cache = None
+if os.environ.get("LIKELIHOOD_CACHE_DIR"):
+    cache = LikelihoodCache(
+        os.environ["LIKELIHOOD_CACHE_DIR"],
+        max_bytes=int(os.environ.get("LIKELIHOOD_CACHE_MB", 1024))*1024*1024
+    )
+
+# ### Parameter estimation
+
+# For one trajectory, subsampled with sampling step size $s$ into
+# $L$-step pieces, estimate the parameters $\alpha$ and
+# $2 D_\alpha \Delta t^{alpha}$, and keep the log-likelihood curve
+# on `alpha_grid`. The estimates for all $s$ are collected, stored
+# and plotted by `lipid_analysis.py`.
+
+print("Estimate parameters, L = %d, sampling step: %d" % (l, s), file=sys.stderr)
+trajectory = trajectory_times, trajectory_positions
+
+# With `estimator` set to `profile`, $\alpha$ and
+# $2 D_\alpha \Delta t^{alpha}$ are estimated jointly instead, and
+# the profile estimate of $2 D_\alpha \Delta t^{alpha}$ on
+# `alpha_grid` is kept as well.
+#
+# With `n_bootstrap` > 0, bootstrap confidence intervals and jackknife
+# standard errors are computed for both parameters. With
+# `lipid_heterogeneity`, the distribution of $\alpha$ over the
+# lipids, and the $\alpha$ of each lipid, are estimated as well.
+# With `likelihood_method` set to `pcg`, the largest relative residual
+# of the conjugate gradients is kept, to check the convergence of the
+# solver.
+
+if estimator == "profile":
+    dt, alpha, d, log_lh, d_profile, intervals, lipids, residual = \
+        estimate_profile(trajectory, l, s, n_resamples=n_bootstrap,
+                         method=likelihood_method, tolerance=pcg_tolerance,
+                         heterogeneity=lipid_heterogeneity)
+else:
+    assert estimator == "two_stage", estimator
+    dt, alpha, d, log_lh, intervals, lipids, residual = \
+        estimate(trajectory, l, s, cache=cache, n_resamples=n_bootstrap,
+                 method=likelihood_method, tolerance=pcg_tolerance,
+                 heterogeneity=lipid_heterogeneity)
+
+result = {
+    "estimator": estimator,
+    "dt": float(dt),
+    "alpha": float(alpha),
+    "d": float(d),
+    "alpha_grid": alpha_grid,
+    "log_likelihood": log_lh,
+}
+if estimator == "profile":
+    result["d_profile"] = d_profile
+if intervals is not None:
+    result["intervals"] = {name: np.asarray(value, np.float64).tolist()
+                           for name, value in intervals.items()}
+if lipids is not None:
+    result["heterogeneity"] = lipids
+if residual is not None:
+    result["pcg_residual"] = float(residual)
+if profiling:
+    result["profile"] = profile()
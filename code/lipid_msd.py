@@ -0,0 +1,34 @@
+# ## %T %n: Center-of-mass diffusion of lipids: MSD and increment autocovariance of one trajectory
+
+# ### Prelude
+
+import sys
+
+# Import modules from this ActivePaper
+
+from .msd import lipid_msd
+from .instrumentation import enable, reset, profile
+
+# Instrumentation is switched on from `parameters.yaml`.
+
+enable(profiling)
+reset()
+
+# ### Mean squared displacement
+
+# For the full trajectory, compute the time-averaged MSD and the
+# autocovariance of the increments for all lags, averaged over all
+# lipids and over $x$ and $y$. This does not depend on $L$ or $s$, and
+# is done once per trajectory. `lipid_analysis.py` compares it to the
+# maximum-likelihood estimates.
+
+print("MSD and increment autocovariance, all lags", file=sys.stderr)
+dt, msd, acov = lipid_msd(trajectory_times, trajectory_positions)
+
+result = {
+    "dt": dt,
+    "msd": msd,
+    "increment_autocovariance": acov,
+}
+if profiling:
+    result["profile"] = profile()
@@ -0,0 +1,15 @@
+# ## %T %n: Options of the lipid estimates
+
+# The lipid estimate transformers receive only the options that affect
+# their results, collected here from `parameters.yaml`. A parameter
+# that is not used, such as `pcg_tolerance` with another likelihood
+# method, is replaced by `None`, so that changing it leaves the result
+# of this transformer, and thus all cached lipid estimates, unchanged.
+
+result = {
+    "estimator": lipid_estimator,
+    "likelihood_method": likelihood_method,
+    "pcg_tolerance": pcg_tolerance if likelihood_method == "pcg" else None,
+    "n_bootstrap": n_bootstrap,
+    "lipid_heterogeneity": lipid_heterogeneity,
+}
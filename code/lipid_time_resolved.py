@@ -0,0 +1,100 @@
+# ## %T %n: Center-of-mass diffusion of lipids: time-resolved estimates for one (trajectory, $L$, $s$)
+
+# ### Prelude
+
+import sys
+from io import StringIO
+
+# Import common scientific libraries
+
+import numpy as np
+
+# Import modules from this ActivePaper
+
+from .lipid_analysis_common_code import estimate_windows, alpha_grid
+from .instrumentation import enable, reset, profile, dump_json
+from .toeplitz import limit_threads
+from .result_store import pack
+from .plotting import Renderer, new_figure, figure_to_png
+
+# Instrumentation is switched on from `parameters.yaml`.
+
+enable(profiling)
+reset()
+
+# The build script reserves a single core for this transformer
+# (`meta["ncores"]`) and runs others on the remaining cores, so the
+# computation itself must use a single thread.
+
+limit_threads(1)
+
+renderer = Renderer(enabled=plots)
+
+# ### Plot
+
+# $\alpha$ and $D_\alpha$ are shown as a function of the time at the
+# start of each window. As in `lipid_analysis.py`, $D_\alpha$ is
+# derived from $2 D_\alpha \Delta t^\alpha$ with the estimated
+# $\alpha$ of the window.
+
+def render_time_resolved(times, alphas, ds, dt, title):
+    fig = new_figure()
+    axs = fig.subplots(2, 1, sharex=True, sharey=False)
+    axs[0].plot(times, alphas, marker="o", markersize=4, linestyle='-')
+    axs[0].set_ylabel(r"$\alpha_{ML}$")
+    axs[0].set_title(title)
+    axs[1].plot(times, 0.5*ds/(dt**alphas), marker="s", markersize=4,
+                linestyle='-')
+    axs[1].set_ylabel(r"$D_\alpha$ [nm$^2$/ps$^\alpha$]")
+    axs[1].set_xlabel(r"$t$ [ps]")
+    return figure_to_png(fig)
+
+# ### Time-resolved estimates
+
+# For one trajectory and sampling step size $s$, slide a window of
+# $L s$ frames along the trajectory, in steps of `stride` frames
+# (`time_resolved` in `parameters.yaml`), and estimate $\alpha$ and
+# $2 D_\alpha \Delta t^{alpha}$ in each window, with the likelihood
+# method of the other lipid estimates. With `pcg`, the largest relative
+# residual of the conjugate gradients is stored as well.
+
+print("Time-resolved estimates, L = %d, sampling step: %d" % (l, s),
+      file=sys.stderr)
+trajectory = trajectory_times, trajectory_positions
+dt, times, alphas, ds, log_lhs, residual = estimate_windows(
+    trajectory, l, s, stride=stride, method=lipid_options["likelihood_method"],
+    tolerance=lipid_options["pcg_tolerance"])
+
+result = {}
+name = "lipid_analysis/time_resolved_%s_l=%d_s=%d" % (label, l, s)
+
+output = StringIO()
+output.write("t, alpha, 2 * D * dt^alpha\n")
+for t, alpha, d in zip(times, alphas, ds):
+    output.write("%f, %f, %f\n" % (t, alpha, d))
+result[name + ".txt"] = output.getvalue()
+
+arrays = dict(
+    l=l,
+    s=s,
+    dt=dt,
+    time=times,
+    alpha=alphas,
+    d=ds,
+    alpha_grid=alpha_grid,
+    log_likelihood=log_lhs,
+)
+if residual is not None:
+    arrays["pcg_residual"] = residual
+npz = pack(**arrays)
+result[name + ".npz"] = np.array(npz) # bug in Seamless, workaround
+
+renderer.submit(name + ".png", render_time_resolved, times, alphas, ds, dt,
+                title=r"lipid trajectories, $\Delta t = %.2f$ ps" % dt)
+
+for fname, plot in renderer.collect().items():
+    plot = np.array(plot) # bug in Seamless, workaround
+    result[fname] = plot
+
+if profiling:
+    result[name + "_profile.json"] = dump_json(profile())
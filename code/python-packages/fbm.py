@@ -2,6 +2,10 @@
 
 # ### Prelude
 
+# Import from Python standard library
+
+from math import gamma
+
 # Import common scientific libraries
 
 import numpy as np
@@ -46,14 +50,57 @@ def sigma_i_off_diagonal(alpha, k):
 
 def sigma_i(alpha):
     def fn(l):
-        m = np.eye(l, dtype=np.float64)
-        for k in range(1, l):
-            d = np.diag(sigma_i_off_diagonal(alpha, k)*np.ones((l-k,)), k=k)
-            m += d
-            m += d.T
-        return m
+        return toeplitz_matrix(sigma_i_acov(alpha)(l))
+    return fn
+
+# Since the increments are stationary, their covariance matrix is a
+# Toeplitz matrix, defined completely by its first row, the
+# autocovariance of the increments for lags $0 \ldots l-1$. Working
+# with the autocovariance rather than with the full matrix reduces
+# the cost of setting up an $l$-step process from $O(l^2)$ to $O(l)$.
+
+def sigma_i_acov(alpha):
+    def fn(l):
+        k = np.arange(l, dtype=np.float64)
+        return 0.5*((k+1)**alpha - 2.*k**alpha + np.fabs(k-1)**alpha)
+    return fn
+
+# The increments of fBM are also known as fractional Gaussian noise
+# (fGn). Their spectral density,
+# $f(\lambda) = \sum_k r_k e^{-i k \lambda}$, is
+# $$f(\lambda) = 2 \Gamma(\alpha+1) \sin(\pi \alpha/2)
+#   (1 - \cos \lambda) \sum_{k=-\infty}^{\infty}
+#   |\lambda + 2 \pi k|^{-\alpha-1},$$
+# where the sum over $k$ accounts for aliasing by the discrete
+# sampling. The sum is computed explicitly for $|k| \leq K$, and the
+# remaining tail is approximated by an integral (the midpoint rule),
+# which makes the relative error of order $10^{-5}$ for $K = 10$.
+# The spectral density is evaluated at the nonzero Fourier frequencies
+# $\lambda_j = 2 \pi j/l$, $j = 1 \ldots \lfloor l/2 \rfloor$, of
+# an $l$-step process.
+
+def sigma_i_spectrum(alpha, aliasing_terms=10):
+    def fn(l):
+        lam = 2.*np.pi*np.arange(1, l//2+1, dtype=np.float64)/l
+        aliases = np.fabs(lam)**(-alpha-1.)
+        for k in range(1, aliasing_terms+1):
+            aliases += (2.*np.pi*k+lam)**(-alpha-1.) \
+                     + (2.*np.pi*k-lam)**(-alpha-1.)
+        tail = 2.*np.pi*(aliasing_terms+0.5)
+        aliases += ((tail+lam)**(-alpha) + (tail-lam)**(-alpha)) \
+                   /(2.*np.pi*alpha)
+        return 2.*gamma(alpha+1.)*np.sin(0.5*np.pi*alpha) \
+               *(1.-np.cos(lam))*aliases
     return fn
 
+# Conversely, the full matrix is obtained from the autocovariance
+# by indexing with the lag $|i-j|$, without any loop over lags.
+
+def toeplitz_matrix(acov):
+    l = len(acov)
+    i = np.arange(l)
+    return acov[np.abs(i[:, np.newaxis]-i[np.newaxis, :])]
+
 # These two covariance matrices are equivalent in that they
 # can be computed from each other:
 
@@ -100,6 +147,19 @@ def mod_sigma_i(alpha):
         return fbm_sigma_i(l) + d + d.T
     return fn
 
+# The modified increments are still stationary, with an autocovariance
+# that differs from plain fBM only at lags 1 and 2.
+
+def mod_sigma_i_acov(alpha):
+    fbm_sigma_i_acov = sigma_i_acov(alpha)
+    def fn(l):
+        cv1 = sigma_i_off_diagonal(alpha, 1)
+        cv2 = sigma_i_off_diagonal(alpha, 2)
+        acov = fbm_sigma_i_acov(l)
+        acov[1:3] = 0.5*(cv1+cv2)
+        return acov
+    return fn
+
 # The corresponding change to the process covariance matrix affects nearly
 # all elements.
 
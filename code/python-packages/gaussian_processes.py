@@ -9,6 +9,7 @@ import numpy as np
 # Import modules from ActivePapers
 
 # from unit_tests import test # missing
+from .instrumentation import timed
 
 # ### Various utility functions
 
@@ -41,6 +42,7 @@ def sigma_conversion_test():
 # Generate n trajectories of length l, given a covariance matrix sigma
 # of size l x l.
 
+@timed("trajectory_generation")
 def make_trajectories(sigma, n):
     from .reproducible_random_numbers import multivariate_normal
     l = sigma.shape[0]
@@ -55,3 +57,32 @@ def trajectory_generation_test():
     t = make_trajectories(s, 100)
     assert t.shape == (100, 10)
 '''
+
+# For long stationary processes, such as the increments of fBM, the
+# generic method above becomes too expensive, since it requires the
+# decomposition of an $l \times l$ matrix. Given the autocovariance
+# `acov` for lags $0 \ldots l-1$, the circulant embedding method
+# (Davies & Harte, 1987) generates $n$ trajectories of length $l$ in
+# $O(n \, l \log l)$ operations. The Toeplitz covariance matrix is
+# embedded in a circulant matrix of size $2(l-1)$, whose eigenvalues
+# are obtained by a Fourier transform. Each complex Fourier transform
+# yields two independent trajectories, in its real and imaginary parts.
+# The method requires the circulant embedding to be non-negative
+# definite, which is the case for fBM increments for all $\alpha$.
+
+@timed("trajectory_generation")
+def make_stationary_trajectories(acov, n):
+    from .reproducible_random_numbers import standard_normal
+    l = len(acov)
+    if l == 1:
+        return np.sqrt(acov[0])*standard_normal((n, 1))
+    c = np.concatenate([acov, acov[-2:0:-1]])
+    m = len(c)
+    eigenvalues = np.fft.fft(c).real
+    if eigenvalues.min() < -1.e-10*eigenvalues.max():
+        raise ValueError("Circulant embedding is not non-negative definite")
+    scale = np.sqrt(np.clip(eigenvalues, 0., None)/m)
+    n_fft = (n+1)//2
+    z = standard_normal((n_fft, m)) + 1j*standard_normal((n_fft, m))
+    y = np.fft.fft(scale*z, axis=1)[:, :l]
+    return np.concatenate([y.real, y.imag])[:n]
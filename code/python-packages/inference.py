@@ -4,13 +4,21 @@
 
 # Import from Python standard library
 
+import hashlib
+import threading
 import itertools as it
+from collections import OrderedDict
 
 # Import common scientific libraries
 
 import numpy as np
 import numpy.linalg as la
-import matplotlib.pyplot as plt
+
+# Import modules from this ActivePaper
+
+from .instrumentation import count, timed
+from .toeplitz import durbin_levinson, innovation_quadratic_forms, \
+    log_det as toeplitz_log_det, solve_pcg
 
 # ### Inference
 
@@ -32,32 +40,386 @@ def merge_grids(*grids):
 # Compute the logarithmic likelihood of a set of trajectories
 # for multiple values of a parameter of the model for the covariance matrix.
 
+@timed("likelihood")
 def log_likelihood(trajectories, sigma_fn, parameter_grid):
     log_lh = np.zeros((len(parameter_grid),), np.float64)
     for i, p in enumerate(parameter_grid):
         s = sigma_fn(p)(len(trajectories[0]))
+        count("covariance_builds")
         sign_det, log_det = la.slogdet(s)
+        count("factorizations")
         assert sign_det > 0
         for t in trajectories:
             log_lh[i] -= 0.5*(np.dot(t, la.solve(s, t)) + log_det)
+        count("solves", len(trajectories))
     return log_lh
 
 # The generalization to covariance matrices that that depend on
 # several parameters is straightforward thanks to Python's itertools
 # module.
 
+@timed("likelihood")
 def log_likelihood_nd(trajectories, sigma_fn, *parameter_grids):
     log_lh = np.zeros(tuple([len(pg) for pg in parameter_grids]), np.float64)
     param_iter = it.product(*parameter_grids)
     index_iter = it.product(*[range(len(k)) for k in parameter_grids])
     for i, p in zip(index_iter, param_iter):
         s = sigma_fn(*p)(len(trajectories[0]))
+        count("covariance_builds")
         sign_det, log_det = la.slogdet(s)
+        count("factorizations")
         assert sign_det > 0
         for t in trajectories:
             log_lh[i] -= 0.5*(np.dot(t, la.solve(s, t)) + log_det)
+        count("solves", len(trajectories))
     return log_lh
 
+# ### Profile likelihood for a scale parameter
+
+# If the covariance matrix is $D \Sigma_p$, with a scale factor $D$
+# in addition to the parameter $p$, the likelihood can be computed for
+# all values of $D$ from two quantities: the quadratic forms
+# $t^T \Sigma_p^{-1} t$ for each trajectory $t$, and
+# $\log \det \Sigma_p$. They are computed here on a grid of $p$
+# values, solving for all trajectories at once.
+
+@timed("likelihood")
+def quadratic_forms(trajectories, sigma_fn, parameter_grid):
+    trajectories = np.asarray(trajectories)
+    q = np.zeros((len(trajectories), len(parameter_grid)), np.float64)
+    log_det = np.zeros((len(parameter_grid),), np.float64)
+    for i, p in enumerate(parameter_grid):
+        s = sigma_fn(p)(trajectories.shape[1])
+        count("covariance_builds")
+        sign_det, log_det[i] = la.slogdet(s)
+        count("factorizations")
+        assert sign_det > 0
+        q[:, i] = (trajectories.T*la.solve(s, trajectories.T)).sum(axis=0)
+        count("solves", len(trajectories))
+    return q, log_det
+
+# For a process with stationary increments, such as fBM, the same
+# quantities can be computed from the increments, whose covariance
+# matrix is a Toeplitz matrix defined by the increment autocovariance.
+# The change of variables from positions to increments has unit
+# Jacobian, so the likelihoods are identical. The Toeplitz structure
+# is exploited by the kernels in `toeplitz`, which cost $O(l^2)$ per
+# parameter value and trajectory instead of $O(l^3)$. Here,
+# `acov_fn(p)(l)` must return the increment autocovariance for lags
+# $0 \ldots l-1$, e.g. `fbm.sigma_i_acov`, and the trajectories
+# are positions, starting from 0 at time 0 (not included).
+
+@timed("likelihood")
+def quadratic_forms_toeplitz(trajectories, acov_fn, parameter_grid):
+    trajectories = np.asarray(trajectories, np.float64)
+    increments = np.diff(trajectories, axis=1, prepend=0.)
+    q = np.zeros((len(trajectories), len(parameter_grid)), np.float64)
+    log_det = np.zeros((len(parameter_grid),), np.float64)
+    for i, p in enumerate(parameter_grid):
+        acov = acov_fn(p)(trajectories.shape[1])
+        count("covariance_builds")
+        phi, v = durbin_levinson(acov)
+        count("factorizations")
+        assert (v > 0).all()
+        log_det[i] = np.log(v).sum()
+        q[:, i] = innovation_quadratic_forms(phi, v, increments)
+        count("solves", len(trajectories))
+    return q, log_det
+
+# For very long trajectories, the quadratic forms are computed with
+# the preconditioned conjugate gradient solver in `toeplitz`, at
+# $O(l \log l)$ per iteration and trajectory, and the
+# log-determinant with the Levinson recursion, which costs $O(l^2)$
+# per parameter value but is independent of the number of
+# trajectories. The largest relative residual over the parameter grid
+# is returned as a third result, and the iterations are counted.
+
+@timed("likelihood")
+def quadratic_forms_pcg(trajectories, acov_fn, parameter_grid,
+                        tolerance=1.e-10, max_iter=None):
+    trajectories = np.asarray(trajectories, np.float64)
+    increments = np.diff(trajectories, axis=1, prepend=0.).T
+    q = np.zeros((len(trajectories), len(parameter_grid)), np.float64)
+    log_det = np.zeros((len(parameter_grid),), np.float64)
+    max_residual = 0.
+    for i, p in enumerate(parameter_grid):
+        acov = acov_fn(p)(trajectories.shape[1])
+        count("covariance_builds")
+        log_det[i] = toeplitz_log_det(acov)
+        count("factorizations")
+        x, residual, iterations = solve_pcg(acov, increments, tolerance, max_iter)
+        count("solves", len(trajectories))
+        count("cg_iterations", iterations)
+        q[:, i] = (increments*x).sum(axis=0)
+        max_residual = max(max_residual, residual)
+    return q, log_det, max_residual
+
+# For still longer trajectories, the exact likelihood can be replaced
+# by the Whittle approximation, which treats the discrete Fourier
+# components of the increments as independent, with variances given by
+# the spectral density $f(\lambda_j)$. With the periodogram
+# $I_j = |\sum_t x_t e^{-i \lambda_j t}|^2/l$, the quadratic form
+# becomes $\sum_j I_j/f(\lambda_j)$ and the log-determinant
+# $\sum_j \log f(\lambda_j)$, both summed over the Fourier
+# frequencies $\lambda_j = 2 \pi j/l$, $j = 1 \ldots l-1$. The
+# frequency $\lambda_0 = 0$ is left out, because the spectral density
+# of fBM increments vanishes or diverges there; the sums are scaled by
+# $l/(l-1)$ to make up for it. The periodograms of all trajectories are
+# computed once, by a single real FFT, and each parameter value then
+# costs $O(l)$ for the spectral density and one matrix-vector product
+# for the quadratic forms. Here, `spectrum_fn(p)(l)` must return the
+# spectral density at $\lambda_j$ for $j = 1 \ldots \lfloor l/2
+# \rfloor$, e.g. `fbm.sigma_i_spectrum`; the other half of the
+# frequencies follows by symmetry.
+#
+# The approximation is good for long trajectories only; see
+# `calibrate-whittle.py` for a comparison with `log_likelihood`.
+
+@timed("likelihood")
+def quadratic_forms_whittle(trajectories, spectrum_fn, parameter_grid):
+    trajectories = np.asarray(trajectories, np.float64)
+    l = trajectories.shape[1]
+    increments = np.diff(trajectories, axis=1, prepend=0.)
+    periodograms = np.abs(np.fft.rfft(increments, axis=1)[:, 1:])**2/l
+    multiplicity = np.full((l//2,), 2., np.float64)
+    if l % 2 == 0:
+        multiplicity[-1] = 1.
+    scale = l/(l-1.)
+    q = np.zeros((len(trajectories), len(parameter_grid)), np.float64)
+    log_det = np.zeros((len(parameter_grid),), np.float64)
+    for i, p in enumerate(parameter_grid):
+        spectrum = spectrum_fn(p)(l)
+        count("covariance_builds")
+        log_det[i] = scale*np.dot(multiplicity, np.log(spectrum))
+        q[:, i] = scale*np.dot(periodograms, multiplicity/spectrum)
+    return q, log_det
+
+# For $n$ trajectories of $l$ steps, the maximum-likelihood estimate of
+# $D$ for a given $p$ is closed-form,
+# $\hat{D}(p) = \sum_t t^T \Sigma_p^{-1} t / (n l)$. Inserting it
+# into the log-likelihood yields the profile log-likelihood of $p$,
+# whose maximum is the joint maximum-likelihood estimate of $(p, D)$.
+# This requires no normalization of the trajectories, and no grid
+# over $D$. Both the profile log-likelihood and $\hat{D}(p)$ are
+# returned.
+
+def profile_log_likelihood(trajectories, sigma_fn, parameter_grid):
+    q, log_det = quadratic_forms(trajectories, sigma_fn, parameter_grid)
+    return profile_from_quadratic_forms(q, log_det, len(trajectories[0]))
+
+def profile_from_quadratic_forms(q, log_det, l):
+    n = len(q)
+    d = q.sum(axis=0)/(n*l)
+    log_lh = -0.5*n*(l*(np.log(d)+1.) + log_det)
+    return log_lh, d
+
+# ### Cached covariance factors
+
+# Analyses that evaluate many data sets with the same model, length
+# $l$ and parameter grid (e.g. the windows of a time-resolved
+# estimate, or the requests to `likelihood_service`) can keep the
+# inverse covariance matrices, flattened into one $(G, l^2)$ array,
+# and the log-determinants, instead of building and factorizing them
+# for every data set. The log-likelihood of $n$ trajectories $t$ then
+# depends on the data only through their scatter matrix
+# $S = \sum_t t t^T$: it is
+# $-\frac{1}{2} (\mathrm{tr}(\Sigma_p^{-1} S) + n \log \det \Sigma_p)$,
+# and the traces for all grid points are a single matrix-vector
+# product.
+#
+# Entries are identified by the name of the covariance matrix function,
+# $l$ and a hash of the grid. They take $8 G (l^2 + 1)$ bytes each. The
+# least recently used entries are dropped when the total exceeds
+# `max_bytes`, and an entry that would exceed `max_bytes` on its own is
+# refused with a `MemoryError` before it is built. Concurrent requests
+# for an entry that is not yet available wait for a single computation.
+
+def grid_key(parameter_grid):
+    return hashlib.sha256(
+        np.ascontiguousarray(parameter_grid, np.float64).tobytes()).hexdigest()
+
+def factor_bytes(l, parameter_grid):
+    return 8*len(parameter_grid)*(l*l + 1)
+
+class FactorCache:
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+
+    def _build(self, sigma_fn, l, parameter_grid):
+        inverses = np.empty((len(parameter_grid), l*l), np.float64)
+        log_det = np.empty((len(parameter_grid),), np.float64)
+        for i, p in enumerate(parameter_grid):
+            s = sigma_fn(p)(l)
+            count("covariance_builds")
+            sign_det, log_det[i] = la.slogdet(s)
+            assert sign_det > 0
+            inverses[i] = la.inv(s).ravel()
+            count("factorizations")
+        return inverses, log_det
+
+    def factors(self, sigma_fn, l, parameter_grid):
+        key = (sigma_fn.__name__, l, grid_key(parameter_grid))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                count("cache_hits")
+                return entry
+        nbytes = factor_bytes(l, parameter_grid)
+        if nbytes > self.max_bytes:
+            raise MemoryError(
+                "Covariance factors for l = %d and %d parameter values need "
+                "%.1f MB, more than the limit of %.1f MB"
+                % (l, len(parameter_grid), nbytes/1024**2,
+                   self.max_bytes/1024**2))
+        with self._lock:
+            building = self._building.setdefault(key, threading.Lock())
+        with building:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                count("cache_hits")
+                return entry
+            count("cache_misses")
+            entry = self._build(sigma_fn, l, parameter_grid)
+            with self._lock:
+                self._entries[key] = entry
+                self._building.pop(key, None)
+                self.nbytes += entry[0].nbytes + entry[1].nbytes
+                while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                    _, (inverses, log_det) = self._entries.popitem(last=False)
+                    self.nbytes -= inverses.nbytes + log_det.nbytes
+        return entry
+
+    def log_likelihood(self, sigma_fn, scatter, n, parameter_grid):
+        inverses, log_det = self.factors(sigma_fn, len(scatter), parameter_grid)
+        count("solves", n)
+        return -0.5*(np.dot(inverses, scatter.ravel()) + n*log_det)
+
+    def status(self):
+        with self._lock:
+            return {"entries": [[name, l] for name, l, _ in self._entries],
+                    "bytes": self.nbytes, "max_bytes": self.max_bytes}
+
+# ### Heterogeneity
+
+# The log-likelihood of a group of trajectories, e.g. of the $x$ and
+# $y$ coordinates of one molecule, is the sum of the log-likelihoods
+# of its members. Here, the scale factor $D$ is profiled out for each
+# group separately, so that differences in $D$ between groups do not
+# show up as differences in $p$. The result is an $(N, G)$ matrix for
+# $N$ groups of `group_size` consecutive trajectories.
+
+def group_profile_log_likelihoods(q, log_det, l, group_size):
+    n = len(q)//group_size
+    group_q = q[:n*group_size].reshape(n, group_size, -1).sum(axis=1)
+    d = group_q/(group_size*l)
+    return -0.5*group_size*(l*(np.log(d)+1.) + log_det)
+
+# The distribution of $p$ over the groups is estimated as a mixture
+# with one component for each value on the parameter grid, whose
+# weights maximize the marginal likelihood of all groups (the
+# nonparametric maximum-likelihood estimate of the distribution). It
+# is fitted by the EM algorithm, in which each iteration only
+# reweights the fixed likelihood matrix: the posterior probability of
+# each grid value for each group is proportional to its weight times
+# its likelihood, and the new weights are the posteriors averaged over
+# the groups. The iteration stops when the marginal log-likelihood
+# increases by less than `tolerance` (relative), or after `max_iter`
+# iterations. The weights, the posteriors $(N, G)$, the marginal
+# log-likelihood and the number of iterations are returned.
+
+def mixture_em(log_lh, max_iter=10000, tolerance=1.e-8):
+    offset = log_lh.max(axis=1)
+    lh = np.exp(log_lh - offset[:, np.newaxis])
+    weights = np.full((log_lh.shape[1],), 1./log_lh.shape[1])
+    previous = -np.inf
+    for iteration in range(1, max_iter+1):
+        marginal = np.dot(lh, weights)
+        log_marginal = np.log(marginal).sum() + offset.sum()
+        weights = weights*np.dot(1./marginal, lh)/len(lh)
+        if log_marginal - previous < tolerance*abs(log_marginal):
+            break
+        previous = log_marginal
+    marginal = np.dot(lh, weights)
+    posterior = lh*weights/marginal[:, np.newaxis]
+    log_marginal = np.log(marginal).sum() + offset.sum()
+    return weights, posterior, log_marginal, iteration
+
+# ### Resampling
+
+# Bootstrap and jackknife estimates are obtained without computing
+# any further likelihoods, from the quadratic forms of the individual
+# trajectories. A resample is described by a vector of weights, one
+# per trajectory, which counts how often the trajectory occurs in the
+# resample. The weighted sums for many resamples are then a single
+# matrix product. For the bootstrap, the weights are drawn from a
+# multinomial distribution; for the jackknife, each resample leaves
+# out one trajectory. The weights are generated in blocks of
+# resamples, which bounds the memory use for large numbers of
+# trajectories.
+#
+# The bootstrap weights are drawn from a random number generator of
+# their own, initialized with `seed` (an integer or a sequence of
+# integers), so that the resamples, and thus the intervals, do not
+# depend on anything else that was computed in the same process.
+
+def bootstrap_weights(n, n_resamples, block_size=256, seed=0):
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_resamples, block_size):
+        size = min(block_size, n_resamples-start)
+        yield rng.multinomial(n, np.ones((n,))/n, size=size).astype(np.float64)
+
+def jackknife_weights(n, block_size=256):
+    for start in range(0, n, block_size):
+        size = min(block_size, n-start)
+        weights = np.ones((size, n), np.float64)
+        weights[np.arange(size), start+np.arange(size)] = 0.
+        yield weights
+
+# For each resample, return the maximum-likelihood parameter value and
+# an estimate of the scale factor $D$. With `profile=True`, $D$ is
+# estimated jointly (see `profile_log_likelihood`). Otherwise, the
+# trajectories are assumed to be normalized to $D=1$, and the estimate
+# of $D$ is the weighted mean of `d_per_trajectory`, if given.
+
+def resampled_estimates(q, log_det, l, parameter_grid, weight_blocks,
+                        profile=False, d_per_trajectory=None):
+    parameters = []
+    ds = []
+    for weights in weight_blocks:
+        m = weights.sum(axis=1)[:, np.newaxis]
+        wq = np.dot(weights, q)
+        if profile:
+            d = wq/(m*l)
+            log_lh = -0.5*m*(l*(np.log(d)+1.) + log_det)
+        else:
+            log_lh = -0.5*(wq + m*log_det)
+        ipeak = np.argmax(log_lh, axis=1)
+        parameters.append(parameter_grid[ipeak])
+        if profile:
+            ds.append(d[np.arange(len(ipeak)), ipeak])
+        elif d_per_trajectory is not None:
+            ds.append(np.dot(weights, d_per_trajectory)/m[:, 0])
+    if not ds:
+        return np.concatenate(parameters), None
+    return np.concatenate(parameters), np.concatenate(ds)
+
+# Percentile confidence intervals from bootstrap estimates, and
+# standard errors from jackknife estimates.
+
+def percentile_interval(estimates, level=0.95):
+    return tuple(np.percentile(estimates, [50.*(1.-level), 50.*(1.+level)]))
+
+def jackknife_standard_error(estimates):
+    n = len(estimates)
+    return np.sqrt((n-1.)/n*((estimates-estimates.mean())**2).sum())
+
 # For a simple graphical representation of a logarithmic probability
 # distribution, extract three characteristic values:
 #
@@ -76,17 +438,21 @@ def spread(parameter_grid, log_p):
 # Compute the maximum-likelihood estimate for a parameter of the
 # covariance matrix function.
 
+@timed("max_lh_estimate")
 def max_lh_estimate(trajectories, sigma_fn, parameter_grid):
     log_lh = log_likelihood(trajectories, sigma_fn, parameter_grid)
     return parameter_grid[np.argmax(log_lh)]
 
-# ### Plotting
+# ### Convergence
 
-# Make a plot showing the convergence of the inference procedure
-# as more and more trajectories are added.
+# Compute the data for a plot showing the convergence of the inference
+# procedure as more and more trajectories are added: the peak and
+# half-maximum limits of the likelihood for each single trajectory,
+# and of the cumulative likelihood of the first $n$ trajectories.
+# The plot itself is made by `plotting.render_convergence`.
 
-def plot_convergence(trajectories, sigma_fn, parameter_grid,
-                     parameter_label, parameter_reference=None):
+@timed("plot_convergence")
+def convergence(trajectories, sigma_fn, parameter_grid):
 
     sum_log_lh = 0
     peak_and_limits = []
@@ -99,27 +465,103 @@ def plot_convergence(trajectories, sigma_fn, parameter_grid,
 
     peak_and_limits = np.array(peak_and_limits)
     cumulative_peak_and_limits = np.array(cumulative_peak_and_limits)
+    return peak_and_limits, cumulative_peak_and_limits
 
-    fig, axes = plt.subplots(1, 2, figsize = (12, 5))
-    bars = peak_and_limits[:50]
-    n = 1+np.arange(len(bars))
-    peak = bars[:, 0]
-    err_lower = peak - bars[:, 1]
-    err_upper = bars[:, 2] - peak
-    axes[0].errorbar(n, bars[:, 0], xerr=0,
-                     yerr=np.array([err_lower, err_upper]),
-                     fmt='.')
-    for index, points in [(0, cumulative_peak_and_limits[:len(bars)]),
-                          (1, cumulative_peak_and_limits)]:
-        n = 1+np.arange(len(points))
-        axes[index].plot(n, points[:, 0], color='red', linewidth=3)
-        axes[index].plot(n, points[:, 1], color='red')
-        axes[index].plot(n, points[:, 2], color='red')
-        if parameter_reference is not None:
-            axes[index].plot([0, n[-1]], 2*[parameter_reference], 'g--', linewidth=3)
-        if cumulative_peak_and_limits.max() > 1.:
-            axes[index].set_ylim((0., 2.))
-        else:
-            axes[index].set_ylim((0., 1.))
-        axes[index].set_xlabel("Number of trajectories")
-        axes[index].set_ylabel(parameter_label)
+# ### Adaptive number of trajectories
+
+# For synthetic data, the number of trajectories is a choice, and the
+# cumulative likelihood often stops changing long before all of them
+# have been used. In the adaptive mode, `make_batch(n)` generates $n$
+# trajectories, which are generated and evaluated in batches of
+# `batch_size`, up to `max_trajectories`. The loop stops as soon as
+# the half-maximum interval of the cumulative likelihood is narrower
+# than `width_tolerance`, or when the maximum-likelihood estimate has
+# changed by less than `mle_tolerance` over each of the last
+# `mle_batches` batches. Either criterion is disabled by `None`. The
+# likelihoods of all trajectories in a batch are computed together,
+# from their quadratic forms.
+#
+# The maximum of the likelihood on the grid often stays at the same
+# grid point for a few batches, even if the estimate has not
+# converged. Therefore the estimate is compared between batches by
+# `interpolated_peak`, the vertex of the parabola through the grid
+# maximum and its two neighbours, and it must be stable for several
+# batches in a row. The interpolation is only accurate to a fraction
+# of the grid spacing, so `mle_tolerance` must be larger than the
+# spacing of `parameter_grid` around the estimate.
+
+def interpolated_peak(parameter_grid, log_p):
+    ipeak = np.argmax(log_p)
+    if ipeak == 0 or ipeak == len(log_p)-1:
+        return parameter_grid[ipeak]
+    x0, x1, x2 = parameter_grid[ipeak-1:ipeak+2]
+    y0, y1, y2 = log_p[ipeak-1:ipeak+2]
+    denom = (x0-x1)*(x0-x2)*(x1-x2)
+    a = (x2*(y1-y0) + x1*(y0-y2) + x0*(y2-y1))/denom
+    b = (x2**2*(y0-y1) + x1**2*(y2-y0) + x0**2*(y1-y2))/denom
+    if a >= 0:
+        return parameter_grid[ipeak]
+    return min(max(-b/(2*a), x0), x2)
+
+def adaptive_log_likelihoods(make_batch, sigma_fn, parameter_grid,
+                             max_trajectories, batch_size,
+                             width_tolerance=None, mle_tolerance=None,
+                             mle_batches=3):
+    sum_log_lh = 0.
+    previous_peak = None
+    stable = 0
+    n = 0
+    while n < max_trajectories:
+        batch = make_batch(min(batch_size, max_trajectories-n))
+        q, log_det = quadratic_forms(batch, sigma_fn, parameter_grid)
+        log_lh = -0.5*(q + log_det)
+        n += len(batch)
+        sum_log_lh = sum_log_lh + log_lh.sum(axis=0)
+        yield log_lh
+        _, low, high = spread(parameter_grid, sum_log_lh)
+        if width_tolerance is not None and high-low < width_tolerance:
+            return
+        peak = interpolated_peak(parameter_grid, sum_log_lh)
+        if previous_peak is not None and mle_tolerance is not None:
+            if abs(peak-previous_peak) < mle_tolerance:
+                stable += 1
+            else:
+                stable = 0
+            if stable >= mle_batches:
+                return
+        previous_peak = peak
+
+# The adaptive versions of `convergence` and `max_lh_estimate`. The
+# number of trajectories actually used is the length of the
+# convergence arrays, and is returned with the estimate.
+
+@timed("plot_convergence")
+def adaptive_convergence(make_batch, sigma_fn, parameter_grid,
+                         max_trajectories, batch_size, **tolerances):
+
+    sum_log_lh = 0
+    peak_and_limits = []
+    cumulative_peak_and_limits = []
+    for batch_log_lh in adaptive_log_likelihoods(
+            make_batch, sigma_fn, parameter_grid, max_trajectories,
+            batch_size, **tolerances):
+        for log_lh in batch_log_lh:
+            sum_log_lh += log_lh
+            peak_and_limits.append(spread(parameter_grid, log_lh))
+            cumulative_peak_and_limits.append(spread(parameter_grid, sum_log_lh))
+
+    peak_and_limits = np.array(peak_and_limits)
+    cumulative_peak_and_limits = np.array(cumulative_peak_and_limits)
+    return peak_and_limits, cumulative_peak_and_limits
+
+@timed("max_lh_estimate")
+def adaptive_max_lh_estimate(make_batch, sigma_fn, parameter_grid,
+                             max_trajectories, batch_size, **tolerances):
+    sum_log_lh = 0.
+    n = 0
+    for batch_log_lh in adaptive_log_likelihoods(
+            make_batch, sigma_fn, parameter_grid, max_trajectories,
+            batch_size, **tolerances):
+        sum_log_lh = sum_log_lh + batch_log_lh.sum(axis=0)
+        n += len(batch_log_lh)
+    return parameter_grid[np.argmax(sum_log_lh)], n
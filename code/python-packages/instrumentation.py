@@ -0,0 +1,141 @@
+# ## %T %n: Run-time instrumentation of the inference code
+
+# ### Prelude
+
+# Import from Python standard library
+
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# ### Switching instrumentation on and off
+
+# Instrumentation is off by default. When it is off, `count` returns
+# after a single test of a module-level flag, and `timer` hands out a
+# shared no-op context manager, so that the instrumented hot paths
+# run at practically the same speed as uninstrumented code.
+#
+# Counters and timers are also updated from background threads (the
+# reader of `lipid_analysis_common_code.prefetched` and the thread
+# pool of `plotting.Renderer`), so all updates are made under a lock.
+
+enabled = False
+
+_counters = defaultdict(int)
+_timers = defaultdict(float)
+_calls = defaultdict(int)
+_lock = threading.Lock()
+
+def enable(flag=True):
+    global enabled
+    enabled = bool(flag)
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        _calls.clear()
+
+# ### Counters
+
+# Counters are identified by name. The inference code uses the
+# following ones:
+#
+#  - `covariance_builds`: covariance matrices constructed by a model
+#  - `factorizations`: matrix factorizations (determinants, decompositions)
+#  - `solves`: linear systems solved, counting each right-hand side
+#  - `cg_iterations`: iterations of the conjugate gradient solver
+#  - `cache_hits`, `cache_misses`: lookups in result and factor caches
+#  - `msd_trajectories`: single-coordinate trajectories in MSD averages
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+# ### Stage timers
+
+# Stages are identified by name, and may be nested. Each stage records
+# the number of times it was entered and the accumulated wall-clock
+# time. The standard stages are `read`, `normalize`, `likelihood`,
+# `resampling`, `heterogeneity`, `msd`, `plot` and
+# `trajectory_generation`, plus the top-level drivers
+# `estimate_windows`, `plot_convergence` and `max_lh_estimate`.
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+_no_timer = _NoTimer()
+
+@contextmanager
+def _timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _timers[stage] += elapsed
+            _calls[stage] += 1
+
+def timer(stage):
+    if not enabled:
+        return _no_timer
+    return _timer(stage)
+
+# Decorator form, for timing whole functions as a stage.
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ### Reporting
+
+# The profile is a plain dictionary that can be stored as JSON next
+# to the transformer results.
+
+def profile():
+    with _lock:
+        return {
+            "counters": dict(sorted(_counters.items())),
+            "stages": {
+                stage: {"calls": _calls[stage], "seconds": _timers[stage]}
+                for stage in sorted(_timers)
+            },
+        }
+
+# Profiles recorded separately, e.g. by the transformers for each
+# (trajectory, $L$, $s$) estimate, can be summed into a single profile.
+
+def merge_profiles(profiles):
+    counters = defaultdict(int)
+    stages = defaultdict(lambda: {"calls": 0, "seconds": 0.})
+    for prof in profiles:
+        for name, n in prof["counters"].items():
+            counters[name] += n
+        for stage, timing in prof["stages"].items():
+            stages[stage]["calls"] += timing["calls"]
+            stages[stage]["seconds"] += timing["seconds"]
+    return {
+        "counters": dict(sorted(counters.items())),
+        "stages": dict(sorted(stages.items())),
+    }
+
+def dump_json(prof=None):
+    if prof is None:
+        prof = profile()
+    return json.dumps(prof, indent=2, sort_keys=True) + "\n"
@@ -0,0 +1,172 @@
+# ## %T %n: Persistent cache of log-likelihood values
+
+# ### Prelude
+
+# Import from Python standard library
+
+import os
+import time
+import types
+import hashlib
+import zipfile
+
+# Import common scientific libraries
+
+import numpy as np
+
+# Import modules from this ActivePaper
+
+from .inference import log_likelihood
+from .instrumentation import count
+
+# ### Cache keys
+
+# A log-likelihood value is determined by the trajectory data, the
+# model (the covariance function) and the parameter value. The data
+# is identified by a hash of its contents, shape and type. The model
+# is identified by the name of the covariance function together with
+# a hash of its code, so that a modified model does not reuse old
+# values. The hash covers the code of the function, of the functions
+# it refers to through its closure (e.g. the $\alpha$-dependent closure
+# returned by `fbm.sigma_p`) or its module globals (e.g.
+# `fbm.mod_diff_p`, called by `fbm.mod_sigma_p`), recursively, and the
+# values of simple constants among these references. Parameter values
+# are identified exactly, as floating-point numbers.
+
+def data_key(trajectories):
+    trajectories = np.ascontiguousarray(trajectories)
+    h = hashlib.sha256()
+    h.update(str((trajectories.shape, trajectories.dtype.str)).encode())
+    h.update(trajectories.tobytes())
+    return h.hexdigest()
+
+_constant_types = (bool, int, float, complex, str, bytes, tuple)
+
+def _hash_value(name, value, h, seen):
+    if isinstance(value, types.FunctionType):
+        _hash_function(value, h, seen)
+    elif isinstance(value, _constant_types):
+        h.update(("%s=%r" % (name, value)).encode())
+
+def _hash_code(code, namespace, h, seen):
+    if code in seen:  # recursive functions
+        return
+    seen.add(code)
+    h.update(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):  # nested function
+            _hash_code(const, namespace, h, seen)
+        else:
+            h.update(repr(const).encode())
+    for name in code.co_names:
+        if name in namespace:
+            _hash_value(name, namespace[name], h, seen)
+
+def _hash_function(fn, h, seen):
+    _hash_code(fn.__code__, fn.__globals__, h, seen)
+    names = fn.__code__.co_freevars
+    for name, cell in zip(names, fn.__closure__ or ()):
+        try:
+            value = cell.cell_contents
+        except ValueError:  # empty cell
+            continue
+        _hash_value(name, value, h, seen)
+
+def model_key(sigma_fn):
+    h = hashlib.sha256()
+    _hash_function(sigma_fn, h, set())
+    return "%s.%s-%s" % (sigma_fn.__module__, sigma_fn.__qualname__,
+                         h.hexdigest()[:16])
+
+# ### On-disk storage
+
+# All values for one (data, model) combination are stored together in
+# one .npz file, named after the hash of both keys, with two arrays:
+# the parameter values and the log-likelihoods. When a grid is
+# extended or shifted, only the new points are computed and added to
+# the file.
+#
+# The total size of the cache directory is bounded by `max_bytes`. When
+# it is exceeded, the least recently used files are removed. Files are
+# replaced atomically, so that several processes can share a cache
+# directory; in the worst case, concurrently computed values are lost
+# and computed again later. A file that cannot be read (e.g. truncated)
+# counts as empty, and is replaced by the next write. Temporary files
+# left behind by killed writers are removed by `evict` once they are
+# older than `tmp_max_age` seconds.
+
+tmp_max_age = 3600
+
+class LikelihoodCache:
+
+    def __init__(self, directory, max_bytes=1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, trajectories, sigma_fn):
+        key = data_key(trajectories) + model_key(sigma_fn)
+        return os.path.join(self.directory,
+                            hashlib.sha256(key.encode()).hexdigest() + ".npz")
+
+    def _read(self, filename):
+        try:
+            with np.load(filename, allow_pickle=False) as npz:
+                values = dict(zip(npz["parameters"].tolist(),
+                                  npz["log_likelihood"].tolist()))
+            os.utime(filename)  # for least-recently-used eviction
+        except (IOError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return {}
+        return values
+
+    def _write(self, filename, values):
+        parameters = np.array(sorted(values), np.float64)
+        log_lh = np.array([values[p] for p in parameters.tolist()], np.float64)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            np.savez(f, parameters=parameters, log_likelihood=log_lh)
+        os.replace(tmp_filename, filename)
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            if not filename.endswith((".npz", ".tmp")):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+                if filename.endswith(".tmp"):
+                    if now - stat.st_mtime > tmp_max_age:
+                        os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    # A drop-in replacement for `inference.log_likelihood`, which
+    # computes only the grid points that are not in the cache.
+
+    def log_likelihood(self, trajectories, sigma_fn, parameter_grid):
+        filename = self._filename(trajectories, sigma_fn)
+        values = self._read(filename)
+        grid = np.asarray(parameter_grid, np.float64).tolist()
+        missing = sorted(set(p for p in grid if p not in values))
+        count("cache_hits", len(grid) - len(missing))
+        count("cache_misses", len(missing))
+        if missing:
+            log_lh = log_likelihood(trajectories, sigma_fn, np.array(missing))
+            values.update(self._read(filename))
+            values.update(zip(missing, log_lh.tolist()))
+            self._write(filename, values)
+            self.evict()
+        return np.array([values[p] for p in grid], np.float64)
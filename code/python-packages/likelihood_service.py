@@ -0,0 +1,233 @@
+# ## %T %n: Resident likelihood service with warm covariance factors
+
+# ### Prelude
+
+# Import from Python standard library
+
+import io
+import json
+import socket
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Import common scientific libraries
+
+import numpy as np
+
+# Import modules from this ActivePaper
+
+from .fbm import sigma_p, mod_sigma_p
+from .inference import FactorCache
+
+# ### Warm covariance factors
+
+# Every call to `inference.log_likelihood` builds and factorizes the
+# covariance matrix for each parameter value again, although analyses
+# use the same few models, lengths and grids over and over. The
+# service is a resident process that keeps them instead, in an
+# `inference.FactorCache`. Clients can send either the trajectories or
+# just their scatter matrix. The models are selected by name.
+
+models = {
+    "sigma_p": sigma_p,
+    "mod_sigma_p": mod_sigma_p,
+}
+
+# ### Wire format
+
+# Requests and responses are .npz archives, which transfer arrays
+# without any loss of precision or conversion cost.
+
+def pack_arrays(**arrays):
+    f = io.BytesIO()
+    np.savez(f, **arrays)
+    return f.getvalue()
+
+def unpack_arrays(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+# ### The service
+
+# The service answers HTTP requests on a local address:
+#
+#  - `POST /log_likelihood?model=sigma_p`, with the arrays `grid` and
+#    either `trajectories` ($n \times l$) or `scatter` ($l \times l$)
+#    and `n`. The response contains the arrays `log_likelihood` and
+#    `mle`, the parameter value of maximal likelihood.
+#  - `GET /status`, which describes the cached factors, as JSON.
+#
+# Invalid requests, including those whose factors would not fit in
+# the memory limit, are answered with status 400, and unexpected
+# errors with status 500, both with a plain-text message.
+#
+# Each request is handled in its own thread. Connections are kept
+# alive, so that a client pays the connection set-up only once, and
+# Nagle's algorithm is disabled on both ends, which would otherwise
+# delay every small request or response by tens of milliseconds.
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, message):
+        self._reply(code, message.encode(), "text/plain")
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/status":
+            return self._error(404, "Not found")
+        body = json.dumps(self.server.factor_cache.status()).encode()
+        self._reply(200, body, "application/json")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        try:
+            body = self._read_body()
+        except ValueError as exc:
+            # The end of the request is unknown, so the connection cannot
+            # be used for another one.
+            self.close_connection = True
+            return self._error(400, "Invalid request: %s" % exc)
+        if url.path != "/log_likelihood":
+            return self._error(404, "Not found")
+        model = parse_qs(url.query).get("model", ["sigma_p"])[0]
+        if model not in models:
+            return self._error(400, "Unknown model: %r" % model)
+        try:
+            grid, scatter, n = self._parse(body)
+        except (KeyError, ValueError, TypeError, OSError) as exc:
+            return self._error(400, "Invalid request: %s" % exc)
+        try:
+            log_lh = self.server.factor_cache.log_likelihood(
+                models[model], scatter, n, grid)
+            body = pack_arrays(log_likelihood=log_lh, mle=grid[np.argmax(log_lh)])
+        except MemoryError as exc:
+            return self._error(400, "Request too large: %s" % exc)
+        except Exception as exc:
+            return self._error(500, "Internal error: %s: %s"
+                               % (type(exc).__name__, exc))
+        self._reply(200, body, "application/octet-stream")
+
+    # The request is checked before anything is computed, so that an
+    # invalid request neither fails halfway nor adds factors for a
+    # bogus length to the cache. The body must have a valid
+    # Content-Length; chunked requests are not supported.
+
+    def _read_body(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise ValueError("missing Content-Length")
+        try:
+            length = int(length)
+        except ValueError:
+            raise ValueError("invalid Content-Length: %r" % length) from None
+        if length < 0:
+            raise ValueError("invalid Content-Length: %d" % length)
+        body = self.rfile.read(length)
+        if len(body) != length:
+            raise ValueError("incomplete body: %d of %d bytes"
+                             % (len(body), length))
+        return body
+
+    @staticmethod
+    def _parse(body):
+        arrays = unpack_arrays(body)
+        grid = np.asarray(arrays["grid"], np.float64)
+        if grid.ndim != 1 or len(grid) == 0:
+            raise ValueError("grid must be a non-empty 1-D array")
+        if "scatter" in arrays:
+            scatter = np.asarray(arrays["scatter"], np.float64)
+            if scatter.ndim != 2 or scatter.shape[0] != scatter.shape[1] \
+               or len(scatter) == 0:
+                raise ValueError("scatter must be an l x l array, got shape %s"
+                                 % (scatter.shape,))
+            n = int(arrays["n"])
+            if n < 1:
+                raise ValueError("n must be positive")
+        else:
+            trajectories = np.asarray(arrays["trajectories"], np.float64)
+            if trajectories.ndim != 2 or 0 in trajectories.shape:
+                raise ValueError("trajectories must be a non-empty n x l array, "
+                                 "got shape %s" % (trajectories.shape,))
+            scatter = np.dot(trajectories.T, trajectories)
+            n = len(trajectories)
+        if not (np.isfinite(grid).all() and np.isfinite(scatter).all()):
+            raise ValueError("grid and data must be finite")
+        return grid, scatter, n
+
+def make_server(host="127.0.0.1", port=8765, max_bytes=1024**3):
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.factor_cache = FactorCache(max_bytes)
+    return server
+
+# ### Client
+
+# The client offers the same functions as `inference`, with the
+# covariance matrix function given by name or as one of the functions
+# in `models`. Each thread uses its own connection.
+
+class LikelihoodClient:
+
+    def __init__(self, host="127.0.0.1", port=8765, timeout=60.):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = http.client.HTTPConnection(self.host, self.port,
+                                                    timeout=self.timeout)
+            connection.connect()
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._local.connection = connection
+        return connection
+
+    def _request(self, method, path, body=None):
+        connection = self._connection()
+        try:
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+        if response.status != 200:
+            raise RuntimeError("Likelihood service: %s" % data.decode())
+        return data
+
+    def _post(self, sigma_fn, **arrays):
+        model = sigma_fn if isinstance(sigma_fn, str) else sigma_fn.__name__
+        return unpack_arrays(self._request(
+            "POST", "/log_likelihood?model=%s" % model, pack_arrays(**arrays)))
+
+    def log_likelihood(self, trajectories, sigma_fn, parameter_grid):
+        return self._post(sigma_fn, trajectories=np.asarray(trajectories),
+                          grid=np.asarray(parameter_grid))["log_likelihood"]
+
+    def log_likelihood_scatter(self, scatter, n, sigma_fn, parameter_grid):
+        return self._post(sigma_fn, scatter=np.asarray(scatter), n=np.array(n),
+                          grid=np.asarray(parameter_grid))["log_likelihood"]
+
+    def max_lh_estimate(self, trajectories, sigma_fn, parameter_grid):
+        return float(self._post(sigma_fn, trajectories=np.asarray(trajectories),
+                                grid=np.asarray(parameter_grid))["mle"])
+
+    def status(self):
+        return json.loads(self._request("GET", "/status"))
@@ -2,28 +2,32 @@
 
 # The analysis of the lipid trajectories is repeated for different
 # values of the parameter $L$, which is the number of steps in each
-# trajectory subsample. Each analysis is a separate calclet, because
-# that makes it possible to run it independently. This module contains
-# code and parameters common to all these calclets.
+# trajectory subsample, and for different sampling step sizes $s$.
+# Each (trajectory, $L$, $s$) estimate is a separate transformer,
+# because that makes it possible to run it independently and to cache
+# it individually. This module contains code and parameters common to
+# all these transformers.
 
 # ### Prelude
 
-# Make matplotlib produce PDF files for figures
+# Import from Python standard library
 
-import matplotlib
-matplotlib.use('PDF')
-del matplotlib
+import queue
+import threading
 
 # Import common scientific libraries
 
 import numpy as np
-import matplotlib.pyplot as plt
-from activepapers.contents import data, open_documentation
 
 # Import modules from this ActivePaper
 
-from fbm import sigma_p
-from inference import merge_grids, max_lh_estimate, plot_convergence
+from .fbm import sigma_p, sigma_i_acov, sigma_i_spectrum
+from .inference import merge_grids, log_likelihood, quadratic_forms, \
+    quadratic_forms_toeplitz, quadratic_forms_pcg, quadratic_forms_whittle, \
+    profile_from_quadratic_forms, bootstrap_weights, jackknife_weights, \
+    resampled_estimates, percentile_interval, jackknife_standard_error, \
+    group_profile_log_likelihoods, mixture_em, FactorCache
+from .instrumentation import timer, timed
 
 # ### I/O and preprocessing
 
@@ -36,12 +40,16 @@ from inference import merge_grids, max_lh_estimate, plot_convergence
 # "molecule number" and "xyz" array axes, returning a 2d array with $2
 # N$ single-coordinate trajectories for a system containing $N$
 # lipids. We also retrieve the sampling timestep from the trajectory.
-
-def read_trajectory(trajectory, max_steps, sample):
-    time = trajectory['particles/universe/position/time'] \
-                     [0:2*sample:sample]
-    positions = trajectory['particles/universe/position/value'] \
-                          [0:sample*(max_steps+1):sample, :, :2]
+#
+# The time and position trajectories can be the arrays from the MD
+# files, or the pair returned by `trajectory_store.open_store`, which
+# makes large sampling steps cheap to read. The data is read from
+# frame 0, or from frame `start` for time-resolved estimates.
+
+def read_trajectory(time_trajectory, position_trajectory, max_steps, sample,
+                    start=0):
+    time = time_trajectory[start:start+2*sample:sample]
+    positions = position_trajectory[start:start+sample*(max_steps+1):sample, :, :2]
     data = positions[1:] - positions[0]
     data.shape = (data.shape[0], 2*data.shape[1])
     return time[1]-time[0], data.T
@@ -59,14 +67,17 @@ def estimate_d_and_normalize(ts):
     d = cov.diagonal().mean()
     return d, ts/np.sqrt(d)
 
-# ### Data
-
-# We have two trajectories for the same system: a short-time trajectory
-# of 300 ps, sampled every 0.03 ps, and a long-time trajectory of 600 ns,
-# sampled every 18 ps.
+# Read and normalize the data for one (trajectory, $L$, $s$) estimate.
 
-short_time = data['short_time_trajectory']
-long_time = data['long_time_trajectory']
+def read_and_normalize(trajectory, l, s, start=0):
+    with timer("read"):
+        dt, tr = read_trajectory(*trajectory, l, s, start)
+    # Make sure we actually got $L$ steps - it might be less.
+    # NOTE: this will fail if the provided trajectory is too short!
+    assert tr.shape[1] == l, (tr.shape, l)
+    with timer("normalize"):
+        d, tr = estimate_d_and_normalize(tr)
+    return dt, d, tr
 
 # ### Probability densities as a function of $\alpha$
 
@@ -82,222 +93,300 @@ alpha_focus = 0.55
 alpha_grid = merge_grids(np.linspace(0.01, 2.-0.01, 200),
                          np.linspace(alpha_focus-0.3, alpha_focus+0.3, 200))
 
+# The likelihoods can be computed in three equivalent ways: `dense`
+# factorizes the covariance matrix of the positions, whereas
+# `levinson` uses the Toeplitz structure of the covariance matrix of
+# the increments, which scales better with $L$. For $L$ in the
+# thousands, `pcg` solves iteratively, to a relative residual of
+# `tolerance`. Beyond that, `whittle` replaces the exact likelihood by
+# its spectral (Whittle) approximation, which is accurate only for
+# large $L$. The method is chosen by `likelihood_method` in
+# `parameters.yaml`. All return the quadratic forms of all
+# trajectories and the log-determinants on `alpha_grid`, or on
+# another `grid` of $\alpha$ values. The same `grid` argument is
+# accepted by the estimation functions below. The third result is the
+# largest relative residual of the conjugate gradients for `pcg`, and
+# `None` for the exact methods.
+
+def trajectory_quadratic_forms(tr, method, tolerance=1.e-10, grid=alpha_grid):
+    if method == "dense":
+        return quadratic_forms(tr, sigma_p, grid) + (None,)
+    if method == "levinson":
+        return quadratic_forms_toeplitz(tr, sigma_i_acov, grid) + (None,)
+    if method == "pcg":
+        return quadratic_forms_pcg(tr, sigma_i_acov, grid, tolerance=tolerance)
+    if method == "whittle":
+        return quadratic_forms_whittle(tr, sigma_i_spectrum, grid) + (None,)
+    raise ValueError("Unknown likelihood method: %r" % method)
+
 # ### Estimation of $\alpha$
 
 # We compute estimates for $2 D_\alpha \Delta t^{alpha}$, normalize the
 # trajectories to $2 D_\alpha \Delta t^{alpha} \to 1$, and then compute
-# a maximum-likelihood estimate of $\alpha$. This is done for several
-# input rajectories and several sampling step sizes.
-
-def estimate_parameters(trajectories, l, table_ds):
-
-    with open_documentation(table_ds, 'w') as output:
-
-        output.write("dt, alpha, 2 * D * dt^alpha\n")
-
-        dts = []
-        alphas = []
-        ds = []
-        for trajectory, ss in trajectories:
-            for s in ss:
-                dt, tr = read_trajectory(trajectory, l, s)
-                # Make sure we actually got $L$ steps - it might be less.
-                assert tr.shape[1] == l
-                d, tr = estimate_d_and_normalize(tr)
-                alpha = max_lh_estimate(tr, sigma_p, alpha_grid)
-                dts.append(dt)
-                alphas.append(alpha)
-                ds.append(d)
-                output.write("%f, %f, %f\n" % (dts[-1], alphas[-1], ds[-1]))
-
-    dts = np.array(dts)
-    alphas = np.array(alphas)
-    ds = np.array(ds)
-
-    return dts, alphas, ds
-
-# For comparison, we show fBM with the three parameter fits from
-# [Stachura & Kneller 2015](http://dx.doi.org/10.1063/1.4936129)
-# in our plots. These are the values taken from this paper:
-
-earlier_fits = [('MSD', 'red', 0.516, 0.0555),
-                ('WDFT', 'brown', 0.452, 0.0466),
-                ('MEE', 'darkcyan', 0.466, 0.0394)]
-
-# The $D_\alpha$ values are in nm$^2$/ns$^\alpha$, contrary to what
-# the table caption in the paper says. We need them in
-# nm$^2$/ps$^\alpha$, so we do a conversion. We also need to
-# correct by a factor 2 for the fact that the literature values
-# are for two-dimensional diffusion (in the lipid plane), whereas
-# here we look at the $x$ and $y$ coordinates separately.
-
-earlier_fits = \
-   [(label, color, alpha_fit, 0.5*d_alpha_fit/1000.**alpha_fit)
-    for label, color, alpha_fit, d_alpha_fit in earlier_fits]
-
-# Another interesting comparison is ballistic motion for short
-# times, i.e. times smaller than the mean collision times between
-# molecules. Ballistic motion is described by fBM in the limit
-# $\alpha \to 2$. Its diffusion constant is given by
-# $D_2 = <v^2>/2 = k T / 2 m$. 
-
-kT = 2.66 # kJ/mol at T = 320 K
-m = 936.  # g/mol
-d_2 = 0.5*kT/m
-
-
-def plot_parameters(dts, alphas, ds, t_max, pdf_ds):
-
-# First, some final computations:
-#  - $\alpha$ and $D$ averaged over the asymptoti regime, which 
-#    correponds to $\Delta t > 10$
-#  - the characteristic diffusion time $\tau$, computed from $D$,
-#    $\alpha$, and the diffusion constant of ballistic motion.
-
-    alpha_mean = alphas.repeat(dts > 10.).mean()
-    d_mean = (0.5*ds.repeat(dts > 10.)/(dts.repeat(dts > 10.)**alpha_mean)).mean()
-    tau = (d_mean/d_2)**(1./(2.-alpha_mean))
-
-# We prepare the plot...
-
-    fig, axs = plt.subplots(2, 1, sharex=True, sharey=False)
-    dash_style = [10, 3, 3, 3]
-
-# and first plot the estimate for $\alpha$...
-
-    axs[0].set_xscale('log')
-    axs[0].plot(dts, alphas,
-             marker="o", markersize=10,
-             linestyle='--')
-    axs[0].set_ylabel(r"$\alpha_{ML}$")
-
-# next, the asymptotic fBM...
-
-    dt_values = np.array([10., t_max])
-    axs[0].plot(dt_values, alpha_mean*np.ones(dt_values.shape),
-                label=r"$\alpha=%.2f$" % alpha_mean,
-                color='black', linestyle='--', linewidth=2) \
-          [0].set_dashes(dash_style)
-
-# followed by the ballistic motion for short times...
-
-    dt_values = np.array([0.01, 0.1])
-    axs[0].plot(dt_values, 2.*np.ones(dt_values.shape), label="ballistic",
-                color='darkred', linestyle='--', linewidth=2) \
-          [0].set_dashes(dash_style)
-
-# and the three fits from the literature.
-
-    dt_values = np.array([1000., t_max])
-    for label, color, alpha_fit, d_alpha_fit in earlier_fits:
-        axs[0].plot(dt_values, np.ones(dt_values.shape)*alpha_fit,
-                    label=label, color=color, linestyle='--', linewidth=2) \
-              [0].set_dashes(dash_style)
-
-# We also need to fix some details of the presentation.
-
-    axs[0].legend(loc='upper right')
-    axs[0].set_ylim(0.4, 2.05)
-
-
-# In a second panel, we plot $2 D_\alpha \Delta t^{\alpha}$,
-# which is in fact the MSD ...
-
-    axs[1].set_xlabel(r"$\Delta t$ [ps]")
-    axs[1].set_xscale('log')
-    axs[1].set_yscale('log')
-
-    axs[1].plot(dts, ds,
-                marker="s", markersize=10,
-                linestyle='--')
-    axs[1].set_ylabel(r"$2 D_\alpha \Delta t^{\alpha}$ [nm$^2$]")
-
-# plus the asymptotic fBM...
-
-    dt_values = np.array([0.2*tau, t_max])
-    msd_values = 2.*d_mean*dt_values**alpha_mean
-    axs[1].plot(dt_values, msd_values,
-                label=r"$\alpha=%.2f$" % alpha_mean,
-                color='black', linestyle='--', linewidth=2) \
-          [0].set_dashes(dash_style)
-
-# the ballistic regime...
-
-    dt_values = np.array([0.01, 5.*tau])
-    axs[1].plot(dt_values, 2.*d_2*dt_values**2, label="ballistic",
-                color='darkred', linestyle='--', linewidth=2) \
-          [0].set_dashes(dash_style)
-
-# a vertial line indicating $\tau$...
-
-    axs[1].plot([tau, tau], [1.e-6, 1.e-1],
-                color='black', linewidth=2, linestyle='dotted')
-    axs[1].text(1.2*tau, 1.e-6, r"$\tau=%.2f$ ps" % tau, fontsize=18)
-
-# and finally, the fits from the literature...
-
-    dt_values = np.array([10., t_max])
-    for label, color, alpha_fit, d_alpha_fit in earlier_fits:
-        msd_values = 2.*d_alpha_fit*dt_values**alpha_fit
-        axs[1].plot(dt_values, msd_values,
-                    label=label, color=color, linestyle='--', linewidth=2) \
-              [0].set_dashes(dash_style)
-
-# followed by presentation details.
-
-    axs[1].legend(loc='lower right')
-
-    plt.savefig(open_documentation(pdf_ds, 'w'))
-
-
-# Another plot shows $D_\alpha$ directly, rather than the combination
-# $2 D_\alpha \Delta t^{\alpha}$. Its computation involves the
-# estimated $\alpha$, leading to a larger uncertainty than for $2
-# D_\alpha \Delta t^{\alpha}$, which is the more fundamental quantity
-# from a computational point of view. Note also that the units of
-# $D_\alpha$ depend on $\alpha$ and thus vary across the plot!
-
-def plot_D(dts, alphas, ds, t_max, pdf_ds):
-
-# We need to re-do the computation of the averages.
-
-    alpha_mean = alphas.repeat(dts > 10.).mean()
-    d_mean = (0.5*ds.repeat(dts > 10.)/(dts.repeat(dts > 10.)**alpha_mean)).mean()
-    tau = (d_mean/d_2)**(1./(2.-alpha_mean))
-
-# We start the plot with the valued of $D_\alpha$
-
-    dash_style = [10, 3, 3, 3]
-    plt.figure()
-    plt.plot(dts, 0.5*ds/(dts**alphas),
-             marker="o", markersize=10,
-             linestyle='--')
-    plt.xscale('log')
-    plt.xlabel(r"$\Delta t$ [ps]")
-    plt.ylabel(r"$D_\alpha$ [nm$^2$/ps$^\alpha$]")
-
-# Again we add the asymptotic and short-time regimes plus the
-# fits from the literature.
-
-    dt_values = np.array([10., t_max])
-    plt.plot(dt_values, d_mean*np.ones(dt_values.shape),
-             label=r"$D_{%.2f} = %.5f$" % (alpha_mean, d_mean),
-             color='black',
-             linestyle='--', linewidth=2) \
-       [0].set_dashes(dash_style)
-
-    dt_values = np.array([0.01, 0.05])
-    plt.plot(dt_values, d_2*np.ones(dt_values.shape),
-             label="ballistic", color='darkred',
-             linestyle='--', linewidth=2) \
-       [0].set_dashes(dash_style)
-
-    dt_values = np.array([1000., t_max])
-    for label, color, alpha_fit, d_alpha_fit in earlier_fits:
-        plt.plot(dt_values, np.ones(dt_values.shape)*d_alpha_fit,
-                 label=label, color=color, linestyle='--', linewidth=2) \
-        [0].set_dashes(dash_style)
-
-    plt.legend(loc="upper right")
-
-    plt.savefig(open_documentation(pdf_ds, 'w'))
+# a maximum-likelihood estimate of $\alpha$. The full log-likelihood
+# curve on `alpha_grid` is returned as well. This is done for one
+# input trajectory and one sampling step size.
+#
+# If a `likelihood_cache.LikelihoodCache` is provided, the
+# log-likelihood values are taken from it where possible, so that
+# changing `alpha_grid` only computes the new grid points.
+#
+# With `n_resamples > 0`, confidence intervals are computed as well
+# (see below), and with `heterogeneity=True`, the distribution of
+# $\alpha$ over the lipids (see below). The likelihood is then
+# computed from the quadratic forms of the individual trajectories,
+# and the cache is not used. Neither is it used for likelihood methods
+# other than `dense`. The intervals and the heterogeneity results are
+# `None` if they were not requested. The bootstrap resamples are drawn
+# with `seed`, which is $(L, s)$ by default, so that each estimate is
+# reproducible on its own. The last result is the residual of
+# `trajectory_quadratic_forms`, so that the accuracy of `pcg` estimates
+# is stored with them.
+
+def estimate(trajectory, l, s, cache=None, n_resamples=0, method="dense",
+             tolerance=1.e-10, grid=alpha_grid, heterogeneity=False):
+    dt, d, tr = read_and_normalize(trajectory, l, s)
+    return estimate_normalized(dt, d, tr, l, cache, n_resamples, method,
+                               tolerance, grid, heterogeneity, seed=(l, s))
+
+# The same, for data that has already been read and normalized by
+# `read_and_normalize`.
+
+def estimate_normalized(dt, d, tr, l, cache=None, n_resamples=0,
+                        method="dense", tolerance=1.e-10, grid=alpha_grid,
+                        heterogeneity=False, seed=0):
+    intervals = None
+    lipids = None
+    residual = None
+    with timer("max_lh_estimate"):
+        if n_resamples or heterogeneity or method != "dense":
+            q, log_det, residual = trajectory_quadratic_forms(tr, method,
+                                                              tolerance, grid)
+            log_lh = -0.5*(q.sum(axis=0) + len(tr)*log_det)
+        elif cache is not None:
+            log_lh = cache.log_likelihood(tr, sigma_p, grid)
+        else:
+            log_lh = log_likelihood(tr, sigma_p, grid)
+        alpha = grid[np.argmax(log_lh)]
+    if n_resamples:
+        increments = tr[:, 1:] - tr[:, :-1]
+        d_per_trajectory = d*(increments**2).mean(axis=1)
+        intervals = resampling_intervals(q, log_det, l, n_resamples,
+                                         d_per_trajectory=d_per_trajectory,
+                                         grid=grid, seed=seed)
+    if heterogeneity:
+        lipids = lipid_heterogeneity(q, log_det, l, grid)
+    return dt, alpha, d, log_lh, intervals, lipids, residual
+
+# Alternatively, $\alpha$ and $2 D_\alpha \Delta t^{alpha}$ are
+# estimated jointly, by maximizing the profile likelihood of $\alpha$
+# on the raw trajectories. This is selected by setting
+# `lipid_estimator` to `profile` in `parameters.yaml`. In addition to
+# the results of `estimate`, the estimate of
+# $2 D_\alpha \Delta t^{alpha}$ for each $\alpha$ on `alpha_grid`
+# is returned.
+
+def estimate_profile(trajectory, l, s, n_resamples=0, method="dense",
+                     tolerance=1.e-10, grid=alpha_grid, heterogeneity=False):
+    dt, tr = read_raw(trajectory, l, s)
+    return estimate_profile_raw(dt, tr, l, n_resamples, method, tolerance,
+                                grid, heterogeneity, seed=(l, s))
+
+# The same, for data that has already been read by `read_raw`.
+
+def read_raw(trajectory, l, s, start=0):
+    with timer("read"):
+        dt, tr = read_trajectory(*trajectory, l, s, start)
+    assert tr.shape[1] == l, (tr.shape, l)
+    return dt, tr
+
+def estimate_profile_raw(dt, tr, l, n_resamples=0, method="dense",
+                         tolerance=1.e-10, grid=alpha_grid,
+                         heterogeneity=False, seed=0):
+    intervals = None
+    lipids = None
+    with timer("max_lh_estimate"):
+        q, log_det, residual = trajectory_quadratic_forms(tr, method,
+                                                          tolerance, grid)
+        log_lh, d_profile = profile_from_quadratic_forms(q, log_det, l)
+        ipeak = np.argmax(log_lh)
+    if n_resamples:
+        intervals = resampling_intervals(q, log_det, l, n_resamples,
+                                         profile=True, grid=grid, seed=seed)
+    if heterogeneity:
+        lipids = lipid_heterogeneity(q, log_det, l, grid)
+    return dt, grid[ipeak], d_profile[ipeak], log_lh, d_profile, intervals, \
+        lipids, residual
+
+# ### Uncertainties
+
+# The uncertainties of $\alpha$ and $2 D_\alpha \Delta t^{alpha}$ are
+# estimated by resampling the $2 N$ single-coordinate trajectories:
+# 95% percentile intervals from `n_resamples` bootstrap resamples, and
+# standard errors from the jackknife. For the two-stage estimator, the
+# bootstrap estimate of $2 D_\alpha \Delta t^{alpha}$ is the mean of
+# the increment variances of the resampled trajectories, and
+# $\alpha$ is estimated with the normalization of the full data set.
+
+def resampling_intervals(q, log_det, l, n_resamples, profile=False,
+                         d_per_trajectory=None, grid=alpha_grid, seed=0):
+    with timer("resampling"):
+        n = len(q)
+        bootstrap_alphas, bootstrap_ds = resampled_estimates(
+            q, log_det, l, grid, bootstrap_weights(n, n_resamples, seed=seed),
+            profile=profile, d_per_trajectory=d_per_trajectory)
+        jackknife_alphas, jackknife_ds = resampled_estimates(
+            q, log_det, l, grid, jackknife_weights(n),
+            profile=profile, d_per_trajectory=d_per_trajectory)
+    return {
+        "alpha_interval": percentile_interval(bootstrap_alphas),
+        "d_interval": percentile_interval(bootstrap_ds),
+        "alpha_standard_error": jackknife_standard_error(jackknife_alphas),
+        "d_standard_error": jackknife_standard_error(jackknife_ds),
+    }
+
+# ### Heterogeneity
+
+# A single $\alpha$ for all lipids hides any differences between
+# them. The likelihoods of the individual lipids, i.e. of the $x$ and
+# $y$ trajectories of each lipid together, are available from the
+# quadratic forms as an $(N, G)$ matrix, with $D$ profiled out for
+# each lipid. From it, the distribution of $\alpha$ over the lipids
+# is estimated as a mixture on `alpha_grid`, fitted by EM. The results
+# are the mixture weights on the grid, and for each lipid its
+# maximum-likelihood $\alpha$, its most probable $\alpha$ under the
+# mixture (the assignment of the lipid to a mixture component), and
+# its posterior mean $\alpha$.
+
+def lipid_heterogeneity(q, log_det, l, grid=alpha_grid):
+    with timer("heterogeneity"):
+        log_lh = group_profile_log_likelihoods(q, log_det, l, 2)
+        weights, posterior, log_marginal, iterations = mixture_em(log_lh)
+    return {
+        "alpha_weights": weights,
+        "lipid_alpha_ml": grid[np.argmax(log_lh, axis=1)],
+        "lipid_alpha_assigned": grid[np.argmax(posterior, axis=1)],
+        "lipid_alpha_mean": np.dot(posterior, grid),
+        "mixture_log_likelihood": log_marginal,
+        "em_iterations": iterations,
+    }
+
+# ### Overlapping reading and inference
+
+# When several data sets are analyzed in a row (several sampling step
+# sizes of one trajectory in `fbm-inference.py`, or the windows of a
+# time-resolved estimate below), reading the positions from disk and
+# inference are overlapped: `prefetched` yields `(item, load(item))`
+# for each item, while a background thread already loads the next
+# items. The reader runs ahead by at most `prefetch` data sets, which
+# bounds the memory used by data waiting in the queue. With
+# `prefetch=0`, everything runs sequentially in the calling thread.
+# The `read` and `normalize` stage timers are then accumulated by the
+# reader thread, and they overlap with the `max_lh_estimate` stage.
+
+def prefetched(items, load, prefetch):
+    if prefetch <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+    buffer = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def reader():
+        for item in items:
+            try:
+                entry = (item, load(item), None)
+            except BaseException as exc:
+                put((item, None, exc))
+                return
+            if not put(entry):
+                return
+        put(None)
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            entry = buffer.get()
+            if entry is None:
+                break
+            item, data, exc = entry
+            if exc is not None:
+                raise exc
+            yield item, data
+    finally:
+        stop.set()
+        thread.join()
+
+# ### Time-resolved estimates
+
+# The estimates above use the first $L s$ frames of a trajectory, so
+# that any drift along the trajectory (equilibration, phase changes)
+# goes unnoticed. Time-resolved estimates slide a window of $L s$
+# frames along the trajectory, in steps of `stride` frames ($L s$ by
+# default, i.e. non-overlapping windows), and estimate $\alpha$ and
+# $2 D_\alpha \Delta t^{alpha}$ for each window with the two-stage
+# estimator.
+#
+# With the `dense` likelihood method, all windows have the same $L$
+# and `grid`, so that the inverse covariance matrices and
+# log-determinants are computed only once, by an
+# `inference.FactorCache` (which may be shared between calls). The
+# log-likelihood of a window then only needs the scatter matrix of its
+# normalized trajectories. These factors take $8 G L^2$ bytes, which
+# is too much for $L$ in the thousands; the other likelihood methods
+# are therefore applied to each window as it is, at a cost of
+# $O(G L^2)$ or less per window, like the matrix-vector product of the
+# dense method. The windows are read by `prefetched` in a background
+# thread, so that a full time profile costs about one pass over the
+# data. The results are the time at the start of each window,
+# $\alpha$, $2 D_\alpha \Delta t^{alpha}$ and the log-likelihood curve
+# for each window, and the largest residual of `pcg` over all windows
+# (`None` for the other methods).
+
+def window_starts(frames, l, s, stride=None):
+    if stride is None:
+        stride = l*s
+    return list(range(0, frames - l*s, stride))
+
+@timed("estimate_windows")
+def estimate_windows(trajectory, l, s, stride=None, method="dense",
+                     tolerance=1.e-10, factors=None, prefetch=2, grid=alpha_grid):
+    time_trajectory, position_trajectory = trajectory
+    if factors is None and method == "dense":
+        factors = FactorCache()
+    frames = position_trajectory.shape[0]
+    starts = window_starts(frames, l, s, stride)
+    if not starts:
+        raise ValueError("Trajectory of %d frames is too short for L = %d, s = %d"
+                         % (frames, l, s))
+    times = []
+    alphas = []
+    ds = []
+    log_lhs = []
+    residual = None
+    def load(start):
+        return read_and_normalize(trajectory, l, s, start)
+    for start, (dt, d, tr) in prefetched(starts, load, prefetch):
+        with timer("max_lh_estimate"):
+            if method == "dense":
+                log_lh = factors.log_likelihood(sigma_p, np.dot(tr.T, tr),
+                                                len(tr), grid)
+            else:
+                q, log_det, window_residual = trajectory_quadratic_forms(
+                    tr, method, tolerance, grid)
+                log_lh = -0.5*(q.sum(axis=0) + len(tr)*log_det)
+                if window_residual is not None:
+                    residual = max(residual or 0., window_residual)
+        times.append(time_trajectory[start])
+        alphas.append(grid[np.argmax(log_lh)])
+        ds.append(d)
+        log_lhs.append(log_lh)
+    return dt, np.array(times), np.array(alphas), np.array(ds), \
+        np.array(log_lhs), residual
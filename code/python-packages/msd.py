@@ -0,0 +1,98 @@
+# ## %T %n: Mean squared displacement and increment autocovariance for all lags
+
+# ### Prelude
+
+# Import common scientific libraries
+
+import numpy as np
+
+# Import modules from this ActivePaper
+
+from .instrumentation import timer, count
+
+# ### Time-averaged statistics of single-coordinate trajectories
+
+# The maximum-likelihood estimates use short pieces of $L$ steps. As
+# an independent check, the time-averaged mean squared displacement
+# and the autocovariance of the increments can be computed from the
+# full trajectories, for all lags at once. For a trajectory
+# $x_0 \ldots x_{T-1}$, the MSD at lag $m$ is
+# $\frac{1}{T-m} \sum_{t} (x_{t+m} - x_t)^2
+#  = S_1(m) - 2 S_2(m)$,
+# where $S_1(m) = \frac{1}{T-m} \sum_{t=0}^{T-m-1} (x_t^2 + x_{t+m}^2)$
+# is a running sum, and $S_2(m) = \frac{1}{T-m} \sum_t x_t x_{t+m}$
+# is the autocorrelation, which is computed with a zero-padded FFT.
+# This costs $O(T \log T)$ operations per trajectory instead of
+# $O(T^2)$. Each row of `x` is one trajectory.
+
+def _autocorrelation(x):
+    t = x.shape[1]
+    n = 1 << (2*t - 1).bit_length()
+    f = np.fft.rfft(x, n=n, axis=1)
+    return np.fft.irfft(f.real**2 + f.imag**2, n=n, axis=1)[:, :t]
+
+def msd_fft(x):
+    x = np.asarray(x, np.float64)
+    t = x.shape[1]
+    squares = x**2
+    total = 2.*squares.sum(axis=1, keepdims=True)
+    head = np.cumsum(squares, axis=1)
+    tail = np.cumsum(squares[:, ::-1], axis=1)
+    removed = np.zeros_like(squares)
+    removed[:, 1:] = head[:, :-1] + tail[:, :-1]
+    counts = np.arange(t, 0, -1, dtype=np.float64)
+    msd = (total - removed - 2.*_autocorrelation(x))/counts
+    msd[:, 0] = 0.
+    return msd
+
+# For fBM, the increments are stationary with mean zero, and their
+# autocovariance at lag $k$ is
+# $\frac{d}{2} (|k+1|^\alpha - 2|k|^\alpha + |k-1|^\alpha)$,
+# with $d = 2 D_\alpha \Delta t^\alpha$ as everywhere else in the
+# code. It is estimated as the time average of
+# $\Delta x_t \Delta x_{t+k}$.
+
+def increment_autocovariance(x):
+    increments = np.diff(np.asarray(x, np.float64), axis=1)
+    counts = np.arange(increments.shape[1], 0, -1, dtype=np.float64)
+    return _autocorrelation(increments)/counts
+
+# ### Averages over all lipids
+
+# The lipid trajectories are read in blocks of `block` lipids, so that
+# memory-mapped position arrays are never read in full. For each
+# block, the $x$ and $y$ coordinates are shifted to 0 at $t=0$, like
+# in `read_trajectory`; this does not change the statistics, but it
+# avoids a loss of precision in the FFT. The result is the average
+# over all lipids and over $x$ and $y$ of the single-coordinate MSD,
+# for lags $0 \ldots T-1$, and of the increment autocovariance, for
+# lags $0 \ldots T-2$. The MSD at lag $s$ is then directly comparable
+# to the estimate of $2 D_\alpha \Delta t^\alpha$ for sampling step
+# size $s$.
+
+def lipid_msd(time_trajectory, position_trajectory, block=16):
+    frames, lipids = position_trajectory.shape[:2]
+    msd = np.zeros((frames,), np.float64)
+    acov = np.zeros((frames-1,), np.float64)
+    for first in range(0, lipids, block):
+        with timer("read"):
+            positions = np.array(position_trajectory[:, first:first+block, :2],
+                                 np.float64)
+        with timer("msd"):
+            positions -= positions[0]
+            x = positions.reshape(frames, -1).T
+            msd += msd_fft(x).sum(axis=0)
+            acov += increment_autocovariance(x).sum(axis=0)
+            count("msd_trajectories", len(x))
+    dt = float(time_trajectory[1] - time_trajectory[0])
+    return dt, msd/(2*lipids), acov/(2*lipids)
+
+# The MSD also gives a local estimate of $\alpha$, the slope
+# $\frac{d \log \mathrm{MSD}}{d \log t}$, here evaluated for the lags
+# `steps`, from the lags immediately before and after.
+
+def local_exponent(msd, steps):
+    steps = np.asarray(steps)
+    lower = np.maximum(steps - 1, 1)
+    upper = np.minimum(steps + 1, len(msd) - 1)
+    return np.log(msd[upper]/msd[lower])/np.log(upper/lower)
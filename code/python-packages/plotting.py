@@ -0,0 +1,119 @@
+# ## %T %n: Headless plot rendering, decoupled from the computations
+
+# ### Prelude
+
+# Import from Python standard library
+
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+# Import common scientific libraries
+
+import numpy as np
+
+# Import modules from this ActivePaper
+
+from .instrumentation import timed
+
+# ### Figures
+
+# All figures are rendered with the Agg backend, through matplotlib's
+# object-oriented interface. No figure is ever registered with
+# `pyplot`, so there is no global figure state: a figure is released
+# as soon as its PNG has been produced, and memory does not grow with
+# the number of plots made in a loop.
+#
+# Matplotlib is imported only when the first figure is made, so that
+# transformers that run without plots never pay for its start-up.
+
+def new_figure(**kwargs):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def figure_to_png(fig):
+    png = BytesIO()
+    fig.savefig(png, format="png")
+    return png.getvalue()
+
+# ### Asynchronous rendering
+
+# A renderer accepts rendering jobs, each of which is a function that
+# returns the PNG data for one file, together with its (plain array)
+# arguments. The jobs run in a pool of worker threads, so that the
+# numerical computations never wait for plotting. Rendering jobs
+# only receive plain arrays, never any objects of the computation.
+#
+# Matplotlib is not fully thread-safe, but separate figures created
+# with `new_figure` share no state that the Agg renderer modifies.
+# The default of a single worker keeps all plotting in one
+# background thread.
+#
+# A disabled renderer (`enabled=False`) drops all jobs. This is the
+# "no plots" mode, in which only the numerical results are produced.
+
+class Renderer:
+
+    def __init__(self, enabled=True, workers=1):
+        self.enabled = enabled
+        self._jobs = {}
+        self._pool = None
+        if enabled:
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, filename, render_fn, *args, **kwargs):
+        if not self.enabled:
+            return
+        self._jobs[filename] = self._pool.submit(timed("plot")(render_fn),
+                                                 *args, **kwargs)
+
+    # Wait for all jobs and return a dictionary of PNG data by file name.
+
+    def collect(self):
+        results = {}
+        for filename, job in self._jobs.items():
+            results[filename] = job.result()
+        self._jobs.clear()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return results
+
+# ### Convergence plots
+
+# Render a plot showing the convergence of the inference procedure
+# as more and more trajectories are added, from the arrays computed
+# by `inference.convergence`.
+
+def render_convergence(peak_and_limits, cumulative_peak_and_limits,
+                       parameter_label, parameter_reference=None,
+                       title=None):
+    fig = new_figure(figsize = (12, 5))
+    axes = fig.subplots(1, 2)
+    bars = peak_and_limits[:50]
+    n = 1+np.arange(len(bars))
+    peak = bars[:, 0]
+    err_lower = peak - bars[:, 1]
+    err_upper = bars[:, 2] - peak
+    axes[0].errorbar(n, bars[:, 0], xerr=0,
+                     yerr=np.array([err_lower, err_upper]),
+                     fmt='.')
+    for index, points in [(0, cumulative_peak_and_limits[:len(bars)]),
+                          (1, cumulative_peak_and_limits)]:
+        n = 1+np.arange(len(points))
+        axes[index].plot(n, points[:, 0], color='red', linewidth=3)
+        axes[index].plot(n, points[:, 1], color='red')
+        axes[index].plot(n, points[:, 2], color='red')
+        if parameter_reference is not None:
+            axes[index].plot([0, n[-1]], 2*[parameter_reference], 'g--', linewidth=3)
+        if cumulative_peak_and_limits.max() > 1.:
+            axes[index].set_ylim((0., 2.))
+        else:
+            axes[index].set_ylim((0., 1.))
+        axes[index].set_xlabel("Number of trajectories")
+        axes[index].set_ylabel(parameter_label)
+    if title is not None:
+        fig.suptitle(title, fontsize=20)
+    return figure_to_png(fig)
@@ -0,0 +1,47 @@
+# ## %T %n: Structured storage of numerical results
+
+# ### Prelude
+
+# Import from Python standard library
+
+from io import BytesIO
+
+# Import common scientific libraries
+
+import numpy as np
+
+# ### The .npz result format
+
+# The numerical results of each analysis (time steps, estimates,
+# full log-likelihood curves, convergence arrays) are stored
+# together in a single NumPy .npz archive, with one named array per
+# quantity. Unlike the plots and text tables, these results can be
+# re-plotted, re-summarized or compared between runs without any
+# recomputation, and they load without parsing.
+#
+# The archive is not compressed: the results are small, and
+# uncompressed arrays load fastest. Strings are stored as unicode
+# arrays, so that no pickling is needed to read them back.
+
+def pack(**arrays):
+    buffer = BytesIO()
+    np.savez(buffer, **{name: np.asarray(value)
+                        for name, value in arrays.items()})
+    return buffer.getvalue()
+
+def unpack(buffer):
+    with np.load(BytesIO(bytes(buffer)), allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+def load(filename):
+    with np.load(filename, allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+# Convergence data for several data sets is stored under prefixed
+# names, e.g. `l=10/peak_and_limits`.
+
+def convergence_arrays(prefix, peak_and_limits, cumulative_peak_and_limits):
+    return {
+        prefix + "/peak_and_limits": peak_and_limits,
+        prefix + "/cumulative_peak_and_limits": cumulative_peak_and_limits,
+    }
@@ -0,0 +1,291 @@
+# ## %T %n: Likelihood kernels for stationary processes (Toeplitz covariance)
+
+# ### Prelude
+
+# Import from Python standard library
+
+import os
+import sys
+import importlib.util
+
+# Import common scientific libraries
+
+import numpy as np
+
+# Numba is optional. If it is installed, the kernels below are
+# compiled; otherwise, equivalent NumPy code is used. The environment
+# variable `INFERENCE_KERNELS=numpy` forces the NumPy code, e.g. for
+# benchmarking. Importing Numba takes a noticeable time, so it is
+# imported only when a compiled kernel is first used.
+
+numba_available = importlib.util.find_spec("numba") is not None
+
+# ### The Durbin-Levinson recursion
+
+# The covariance matrix of a stationary process is a Toeplitz matrix,
+# defined by the autocovariance $r_k$ for lags $k = 0 \ldots l-1$. The
+# Durbin-Levinson recursion computes, for each $t$, the coefficients
+# $\phi_{t,j}$ of the best linear prediction of $x_t$ from
+# $x_{t-1} \ldots x_0$, and the variance $v_t$ of the prediction error
+# (the innovation). Row $t$ of `phi` contains $\phi_{t,1} \ldots
+# \phi_{t,t}$, the coefficients for $x_{t-1} \ldots x_0$. This costs
+# $O(l^2)$ operations instead of the $O(l^3)$ of a matrix
+# factorization.
+
+def _durbin_levinson_numpy(r):
+    l = len(r)
+    phi = np.zeros((l, l), np.float64)
+    v = np.empty((l,), np.float64)
+    v[0] = r[0]
+    for t in range(1, l):
+        previous = phi[t-1, :t-1]
+        k = (r[t] - np.dot(previous, r[t-1:0:-1]))/v[t-1]
+        phi[t, :t-1] = previous - k*previous[::-1]
+        phi[t, t-1] = k
+        v[t] = v[t-1]*(1.-k*k)
+    return phi, v
+
+# The innovations $e_t = x_t - \sum_j \phi_{t,j} x_{t-j}$ are
+# uncorrelated, with variances $v_t$. Therefore the quadratic form
+# $x^T \Sigma^{-1} x$ is $\sum_t e_t^2/v_t$, and
+# $\log \det \Sigma = \sum_t \log v_t$. In matrix form, the
+# innovations are $e = A x$, where $A$ is unit lower triangular with
+# $A_{t,t-j} = -\phi_{t,j}$, so that the innovations of all
+# trajectories (rows of `x`) are a single matrix product.
+
+def _quadratic_forms_numpy(phi, v, x):
+    l = len(v)
+    t, j = np.tril_indices(l, -1)
+    a = np.eye(l)
+    a[t, j] = -phi[t, t-1-j]
+    e = np.dot(x, a.T)
+    return (e*e/v).sum(axis=1)
+
+# The same algorithms, written as explicit loops for compilation by
+# Numba. The quadratic forms of different trajectories are computed
+# in parallel.
+
+def _durbin_levinson_loops(r):
+    l = len(r)
+    phi = np.zeros((l, l), np.float64)
+    v = np.empty((l,), np.float64)
+    v[0] = r[0]
+    for t in range(1, l):
+        acc = r[t]
+        for j in range(t-1):
+            acc -= phi[t-1, j]*r[t-1-j]
+        k = acc/v[t-1]
+        for j in range(t-1):
+            phi[t, j] = phi[t-1, j] - k*phi[t-1, t-2-j]
+        phi[t, t-1] = k
+        v[t] = v[t-1]*(1.-k*k)
+    return phi, v
+
+def _quadratic_forms_loops(phi, v, x):
+    n, l = x.shape
+    q = np.empty((n,), np.float64)
+    for i in _prange(n):
+        acc = x[i, 0]**2/v[0]
+        for t in range(1, l):
+            e = x[i, t]
+            for j in range(t):
+                e -= phi[t, j]*x[i, t-1-j]
+            acc += e*e/v[t]
+        q[i] = acc
+    return q
+
+# For long series, storing all prediction coefficients would need
+# $O(l^2)$ memory. If only $\log \det \Sigma$ is required, the
+# recursion keeps only the current coefficients.
+
+def _log_det_numpy(r):
+    l = len(r)
+    phi = np.zeros((l,), np.float64)
+    v = r[0]
+    log_det = np.log(v)
+    for t in range(1, l):
+        previous = phi[:t-1]
+        k = (r[t] - np.dot(previous, r[t-1:0:-1]))/v
+        phi[:t-1] = previous - k*previous[::-1]
+        phi[t-1] = k
+        v *= 1.-k*k
+        log_det += np.log(v)
+    return log_det
+
+def _log_det_loops(r):
+    l = len(r)
+    phi = np.zeros((l,), np.float64)
+    new_phi = np.zeros((l,), np.float64)
+    v = r[0]
+    log_det = np.log(v)
+    for t in range(1, l):
+        acc = r[t]
+        for j in range(t-1):
+            acc -= phi[j]*r[t-1-j]
+        k = acc/v
+        for j in range(t-1):
+            new_phi[j] = phi[j] - k*phi[t-2-j]
+        for j in range(t-1):
+            phi[j] = new_phi[j]
+        phi[t-1] = k
+        v *= 1.-k*k
+        log_det += np.log(v)
+    return log_det
+
+_prange = range
+
+_compiled = {}
+
+def _compiled_kernels():
+    global _prange
+    if not _compiled:
+        import numba
+        _prange = numba.prange
+        _compiled["durbin_levinson"] = numba.njit(cache=True)(
+            _durbin_levinson_loops)
+        _compiled["quadratic_forms"] = numba.njit(cache=True, parallel=True)(
+            _quadratic_forms_loops)
+        _compiled["log_det"] = numba.njit(cache=True)(_log_det_loops)
+    return _compiled
+
+# ### Backend selection
+
+backends = ["numpy"]
+if numba_available:
+    backends.append("numba")
+
+backend = backends[-1]
+if os.environ.get("INFERENCE_KERNELS") in backends:
+    backend = os.environ["INFERENCE_KERNELS"]
+
+def set_backend(name):
+    global backend
+    if name not in backends:
+        raise ValueError("Kernel backend %r is not available (available: %s)"
+                         % (name, ", ".join(backends)))
+    backend = name
+
+def durbin_levinson(r):
+    r = np.ascontiguousarray(r, np.float64)
+    if backend == "numba":
+        return _compiled_kernels()["durbin_levinson"](r)
+    return _durbin_levinson_numpy(r)
+
+def innovation_quadratic_forms(phi, v, x):
+    x = np.ascontiguousarray(x, np.float64)
+    if backend == "numba":
+        kernels = _compiled_kernels()
+        if threads is not None:
+            import numba
+            numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+        return kernels["quadratic_forms"](phi, v, x)
+    return _quadratic_forms_numpy(phi, v, x)
+
+def log_det(r):
+    r = np.ascontiguousarray(r, np.float64)
+    if backend == "numba":
+        return _compiled_kernels()["log_det"](r)
+    return _log_det_numpy(r)
+
+# ### Threads
+
+# The compiled quadratic forms run in parallel over the trajectories,
+# and the dense linear algebra of NumPy runs in a multithreaded BLAS.
+# Both use all cores by default. When one analysis runs per core (the
+# scheduler of the build script, or the workers of `fbm-inference.py`),
+# this oversubscribes the machine, so that the analyses must be
+# limited to their share of the cores with `limit_threads(n)`.
+#
+# Numba is limited directly (for the calling thread, which is where
+# the kernels are called). The BLAS is limited with threadpoolctl, if
+# it is installed. The environment variables `thread_variables` are
+# set as well: they are read by BLAS libraries and Numba when they are
+# loaded, which is what limits them in new processes, and in the
+# current process if they have not been loaded yet.
+
+thread_variables = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "MKL_NUM_THREADS", "NUMBA_NUM_THREADS"]
+
+threads = None
+_blas_limits = None
+
+def limit_threads(n):
+    global threads, _blas_limits
+    threads = max(1, int(n))
+    for name in thread_variables:
+        if name == "NUMBA_NUM_THREADS" and "numba" in sys.modules:
+            continue  # cannot be changed once Numba's threads have started
+        os.environ[name] = str(threads)
+    if importlib.util.find_spec("threadpoolctl") is not None:
+        from threadpoolctl import threadpool_limits
+        _blas_limits = threadpool_limits(limits=threads)
+
+# ### Iterative solution for long series
+
+# For series of thousands of steps, even $O(l^2)$ per trajectory is
+# too expensive. A Toeplitz matrix can be embedded in a circulant
+# matrix of size $2l$, which makes matrix-vector products an $O(l \log
+# l)$ FFT convolution. Linear systems are then solved by the conjugate
+# gradient method, for all right-hand sides (columns of `b`) at once.
+#
+# The conjugate gradients are preconditioned with T. Chan's optimal
+# circulant approximation of the Toeplitz matrix, which is inverted by
+# FFT as well. For the autocovariances of fBM increments, the number of
+# iterations then grows only slowly with $l$.
+#
+# The iteration stops when the residual $\|b - \Sigma x\|$ of every
+# column is below `tolerance` relative to $\|b\|$, or after `max_iter`
+# iterations. The largest relative residual and the number of
+# iterations are returned with the solution.
+
+def _embedding_matvec(r):
+    l = len(r)
+    c_hat = np.fft.rfft(np.concatenate([r, [0.], r[:0:-1]]))
+    def matvec(x):
+        y = np.fft.irfft(c_hat[:, np.newaxis]*np.fft.rfft(x, 2*l, axis=0),
+                         2*l, axis=0)
+        return y[:l]
+    return matvec
+
+def _chan_preconditioner(r):
+    l = len(r)
+    k = np.arange(l)
+    c = ((l-k)*r + k*np.concatenate([[0.], r[:0:-1]]))/l
+    eigenvalues = np.fft.rfft(c).real
+    eigenvalues = np.maximum(eigenvalues, 1.e-12*eigenvalues.max())
+    def solve(y):
+        return np.fft.irfft(np.fft.rfft(y, axis=0)/eigenvalues[:, np.newaxis],
+                            l, axis=0)
+    return solve
+
+def solve_pcg(r, b, tolerance=1.e-10, max_iter=None):
+    r = np.asarray(r, np.float64)
+    b = np.asarray(b, np.float64)
+    if max_iter is None:
+        max_iter = len(r)
+    matvec = _embedding_matvec(r)
+    precondition = _chan_preconditioner(r)
+    b_norm = np.sqrt((b*b).sum(axis=0))
+    b_norm[b_norm == 0.] = 1.
+    x = np.zeros_like(b)
+    residual = b.copy()
+    z = precondition(residual)
+    p = z.copy()
+    rz = (residual*z).sum(axis=0)
+    relative_residual = 1.
+    iteration = 0
+    for iteration in range(1, max_iter+1):
+        ap = matvec(p)
+        pap = (p*ap).sum(axis=0)
+        step = np.divide(rz, pap, out=np.zeros_like(rz), where=pap != 0.)
+        x += step*p
+        residual -= step*ap
+        relative_residual = (np.sqrt((residual*residual).sum(axis=0))/b_norm).max()
+        if relative_residual < tolerance:
+            break
+        z = precondition(residual)
+        rz_new = (residual*z).sum(axis=0)
+        beta = np.divide(rz_new, rz, out=np.zeros_like(rz), where=rz != 0.)
+        p = z + beta*p
+        rz = rz_new
+    return x, relative_residual, iteration
@@ -0,0 +1,108 @@
+# ## %T %n: Lipid-major trajectory storage with decimated levels
+
+# ### Prelude
+
+# Import from Python standard library
+
+import os
+import json
+
+# Import common scientific libraries
+
+import numpy as np
+
+# ### Storage layout
+
+# The MD trajectories are stored frame-major, as an array of shape
+# (frames, lipids, 3). Subsampling them with a large sampling step
+# $s$ touches one small slice per frame, spread over the whole file.
+# A trajectory store instead contains, for each of a set of
+# decimation levels $k$, a lipid-major array of shape
+# (2 lipids, ceil(frames/k)), with the $x$ and $y$ coordinates of
+# every $k$-th frame. Row `2*lipid+coordinate` is a contiguous time
+# series. The $z$ coordinate is not stored, since it is never used in
+# the analysis.
+#
+# A store is a directory containing `store.json` (the shape and the
+# levels), `time.npy` (the full time axis) and one `level_<k>.npy`
+# per level. Level 1 is always present.
+
+def level_filename(directory, level):
+    return os.path.join(directory, "level_%d.npy" % level)
+
+# Build a store from a frame-major position array (typically a
+# memory-mapped value.npy), reading it in blocks of frames. Every
+# block is read only once and scattered into all levels.
+
+def build(directory, time, positions, levels, block_frames=4096):
+    levels = sorted(set(levels) | {1})
+    frames, lipids, _ = positions.shape
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "time.npy"), np.asarray(time))
+    targets = {}
+    for level in levels:
+        targets[level] = np.lib.format.open_memmap(
+            level_filename(directory, level), mode="w+",
+            dtype=positions.dtype, shape=(2*lipids, -(-frames//level))
+        )
+    for start in range(0, frames, block_frames):
+        stop = min(start + block_frames, frames)
+        block = np.asarray(positions[start:stop, :, :2])
+        block = block.reshape(stop-start, 2*lipids).T
+        for level, target in targets.items():
+            first = -(-start//level)*level
+            target[:, first//level:-(-stop//level)] = \
+                block[:, first-start::level]
+    for target in targets.values():
+        target.flush()
+    with open(os.path.join(directory, "store.json"), "w") as f:
+        json.dump({"frames": frames, "lipids": lipids, "levels": levels}, f)
+
+# ### Adapter for `read_trajectory`
+
+# `open_store` returns a (time, positions) pair that can be passed to
+# `read_trajectory` in place of the original arrays. The positions
+# object supports exactly the indexing done by `read_trajectory`:
+# a strided slice over frames, and slices over lipids and coordinates.
+# It reads from the coarsest level whose step divides both the start
+# and the step of the frame slice, so that the data read from disk is
+# proportional to the data actually used, and is read sequentially
+# for each lipid coordinate.
+
+class StoredPositions:
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "store.json")) as f:
+            info = json.load(f)
+        self.frames = info["frames"]
+        self.lipids = info["lipids"]
+        self.levels = sorted(info["levels"], reverse=True)
+        self._directory = directory
+        self._arrays = {}
+
+    @property
+    def shape(self):
+        return (self.frames, self.lipids, 2)
+
+    def _level(self, level):
+        if level not in self._arrays:
+            self._arrays[level] = np.load(level_filename(self._directory, level),
+                                          mmap_mode="r")
+        return self._arrays[level]
+
+    def __getitem__(self, key):
+        frame_slice, lipid_slice, coordinate_slice = key
+        start, stop, step = frame_slice.indices(self.frames)
+        if step < 1:
+            raise ValueError("Only forward frame slices are supported")
+        level = next(k for k in self.levels
+                     if step % k == 0 and start % k == 0)
+        n = len(range(start, stop, step))
+        first, stride = start//level, step//level
+        data = self._level(level)[:, first:first+n*stride:stride]
+        data = data.reshape(self.lipids, 2, -1).transpose(2, 0, 1)
+        return np.array(data[:, lipid_slice, coordinate_slice])
+
+def open_store(directory):
+    time = np.load(os.path.join(directory, "time.npy"), mmap_mode="r")
+    return time, StoredPositions(directory)
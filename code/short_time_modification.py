@@ -2,56 +2,44 @@
 
 # ### Prelude
 
+import sys
 import numpy as np
-from io import StringIO, BytesIO
-
-# Import common scientific libraries
-
-import matplotlib.pyplot as plt
+from io import StringIO
 
 # Import modules from this ActivePaper
 
 from .fbm import sigma_p, mod_sigma_p, sigma_i, mod_sigma_i
+from .instrumentation import enable, reset, dump_json
+from .toeplitz import limit_threads
+from .plotting import Renderer, new_figure, figure_to_png, render_convergence
+from .result_store import pack, convergence_arrays
+
+# Instrumentation is switched on from `parameters.yaml`.
+
+enable(profiling)
+reset()
+
+# The build script reserves a single core for this transformer
+# (`meta["ncores"]`) and runs others on the remaining cores, so the
+# computation itself must use a single thread.
+
+limit_threads(1)
+
+# Plots are rendered in the background, or not at all if `plots`
+# is false in `parameters.yaml`.
+
+renderer = Renderer(enabled=plots)
 
 # ### Illustration of the short-time behavior and its impact on
 #     parameter inference with the plain fBM model
 
-fig, axes = plt.subplots(1, 3, figsize = (15, 6))
-fig.subplots_adjust(wspace=0.4)
-
-ms = 10.
-alfs = 20.
-for ax in axes:
-    ax.tick_params(axis='both', which='major', labelsize=18)
-
-# Plot the increment correlations, which differ only in two points.
-
-axes[0].plot(sigma_i(alpha_in)(11)[0],
-             linestyle='', marker='<', markersize=ms,
-             markerfacecolor='blue', markeredgecolor='black',
-             label=r'fBM $\alpha=%.1f$' % alpha_in)
-axes[0].plot(mod_sigma_i(alpha_in)(11)[0],
-             linestyle='', marker='>', markersize=ms,
-             markerfacecolor='red',  markeredgecolor='black',
-             label=r'modified fBM $\alpha=%.1f$' % alpha_in)
-axes[0].set_xlim((-1, 11))
-axes[0].legend(loc='upper right')
-axes[0].set_xlabel(r"$\tau/\delta t$", fontsize=alfs)
-axes[0].set_ylabel(r"$<\Delta X(t) \Delta X(t+\tau))> / (D \cdot \delta t^\alpha)$",
-                   fontsize=alfs)
-
-# Plot the MSDs, which differ over a much longer time range.
-
-axes[1].loglog(sigma_p(alpha_in)(1000).diagonal(),
-               color='blue',
-               label=r'fBM $\alpha=%.1f$' % alpha_in)
-axes[1].loglog(mod_sigma_p(alpha_in)(1000).diagonal(),
-               color='red',
-               label=r'modified fBM $\alpha=%.1f$' % alpha_in)
-axes[1].legend(loc='upper left')
-axes[1].set_xlabel(r"$t/\delta t$", fontsize=alfs)
-axes[1].set_ylabel(r"$<X^2(t)> / (D \cdot \delta t^\alpha)$",
-                   fontsize=alfs)
+# The increment correlations differ only in two points.
+
+increment_correlations = sigma_i(alpha_in)(11)[0], mod_sigma_i(alpha_in)(11)[0]
+
+# The MSDs differ over a much longer time range.
+
+msds = sigma_p(alpha_in)(1000).diagonal(), mod_sigma_p(alpha_in)(1000).diagonal()
 
 # Compute the maximum-likelihood estimates for $\alpha$.
 # The trajectories are generated from the modified model, subsampled
@@ -59,10 +47,22 @@ axes[1].set_ylabel(r"$<X^2(t)> / (D \cdot \delta t^\alpha)$",
 # For each value of $s$, we generate 500 trajectories of 100 steps each.
 # With an increasing sampling time step, the estimate for
 # $\alpha$ converges to the known input value `alpha_in`.
+#
+# In the adaptive mode (see `parameters.yaml`), trajectories are only
+# generated until the estimate has converged, and the number used is
+# added to the table.
 
 from .gaussian_processes import make_trajectories
 from .fbm import sigma_p, mod_sigma_p, subsample_sigma
-from .inference import merge_grids, max_lh_estimate, plot_convergence
+from .inference import merge_grids, max_lh_estimate, convergence, \
+    adaptive_max_lh_estimate, adaptive_convergence
+
+adaptive = adaptive_trajectories["enabled"]
+tolerances = {
+    "width_tolerance": adaptive_trajectories["width_tolerance"],
+    "mle_tolerance": adaptive_trajectories["mle_tolerance"],
+    "mle_batches": adaptive_trajectories["mle_batches"],
+}
 
 l = trajectory_lengths[-1]
 ss = [1, 2, 3, 5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
@@ -71,33 +71,82 @@ result = {}
 
 sigma_big = mod_sigma_p(alpha_in)(max(ss)*l)
 alphas = []
+n_used = []
 fname = 'short_time_modification/subsampling_convergence_l=%d.txt' % l
 log = StringIO()
-log.write("  s, alpha\n")
+log.write("  s, alpha, n\n" if adaptive else "  s, alpha\n")
 for s in ss:
     sigma = subsample_sigma(sigma_big[:s*l, :s*l], s)
-    t = make_trajectories(sigma, n_traj_ml_estimate)
-    assert t.shape[1] == l
-    alphas.append(max_lh_estimate(t, sigma_p, alpha_grid))
-    log.write("%3d, %f\n" % (s, alphas[-1]))
+    assert sigma.shape[0] == l
+    if adaptive:
+        alpha, n = adaptive_max_lh_estimate(
+            lambda n: make_trajectories(sigma, n), sigma_p, alpha_grid,
+            n_traj_ml_estimate, adaptive_trajectories["batch_size"],
+            **tolerances)
+        alphas.append(alpha)
+        n_used.append(n)
+        log.write("%3d, %f, %d\n" % (s, alphas[-1], n_used[-1]))
+    else:
+        t = make_trajectories(sigma, n_traj_ml_estimate)
+        assert t.shape[1] == l
+        alphas.append(max_lh_estimate(t, sigma_p, alpha_grid))
+        n_used.append(len(t))
+        log.write("%3d, %f\n" % (s, alphas[-1]))
 result[fname] = log.getvalue()
 
-# Plot the $\alpha$ values.
-
-axes[2].plot(ss, alphas,
-             markerfacecolor='red', markeredgecolor='red',
-             marker="o", markersize=ms,
-             linestyle='--', color='blue')
-axes[2].set_xlim((0, max(ss)+2))
-axes[2].set_xlabel(r"$s$", fontsize=alfs)
-axes[2].set_ylabel(r"$\alpha_{ML}$", fontsize=alfs)
-
-# Combine the three plots into one figure.
-
-png = BytesIO()
-plt.savefig(png)
-# result['short_time_modification/overview.png'] = png.getvalue() # bug in Seamless
-result['short_time_modification/overview.png'] = np.array(png.getvalue()) # workaround
+# Plot the increment correlations, the MSDs and the $\alpha$ values,
+# and combine the three plots into one figure.
+
+def render_overview(alpha_in, increment_correlations, msds, ss, alphas):
+
+    fig = new_figure(figsize = (15, 6))
+    axes = fig.subplots(1, 3)
+    fig.subplots_adjust(wspace=0.4)
+
+    ms = 10.
+    alfs = 20.
+    for ax in axes:
+        ax.tick_params(axis='both', which='major', labelsize=18)
+
+    fbm_correlation, mod_fbm_correlation = increment_correlations
+    axes[0].plot(fbm_correlation,
+                 linestyle='', marker='<', markersize=ms,
+                 markerfacecolor='blue', markeredgecolor='black',
+                 label=r'fBM $\alpha=%.1f$' % alpha_in)
+    axes[0].plot(mod_fbm_correlation,
+                 linestyle='', marker='>', markersize=ms,
+                 markerfacecolor='red',  markeredgecolor='black',
+                 label=r'modified fBM $\alpha=%.1f$' % alpha_in)
+    axes[0].set_xlim((-1, 11))
+    axes[0].legend(loc='upper right')
+    axes[0].set_xlabel(r"$\tau/\delta t$", fontsize=alfs)
+    axes[0].set_ylabel(r"$<\Delta X(t) \Delta X(t+\tau))> / (D \cdot \delta t^\alpha)$",
+                       fontsize=alfs)
+
+    fbm_msd, mod_fbm_msd = msds
+    axes[1].loglog(fbm_msd,
+                   color='blue',
+                   label=r'fBM $\alpha=%.1f$' % alpha_in)
+    axes[1].loglog(mod_fbm_msd,
+                   color='red',
+                   label=r'modified fBM $\alpha=%.1f$' % alpha_in)
+    axes[1].legend(loc='upper left')
+    axes[1].set_xlabel(r"$t/\delta t$", fontsize=alfs)
+    axes[1].set_ylabel(r"$<X^2(t)> / (D \cdot \delta t^\alpha)$",
+                       fontsize=alfs)
+
+    axes[2].plot(ss, alphas,
+                 markerfacecolor='red', markeredgecolor='red',
+                 marker="o", markersize=ms,
+                 linestyle='--', color='blue')
+    axes[2].set_xlim((0, max(ss)+2))
+    axes[2].set_xlabel(r"$s$", fontsize=alfs)
+    axes[2].set_ylabel(r"$\alpha_{ML}$", fontsize=alfs)
+
+    return figure_to_png(fig)
+
+renderer.submit('short_time_modification/overview.png', render_overview,
+                alpha_in, increment_correlations, msds, ss, np.array(alphas))
 
 #@image short_time_modification/overview.png
 
@@ -108,17 +157,44 @@ result['short_time_modification/overview.png'] = np.array(png.getvalue()) # work
 # properly with $500$ trajectories. Here we show the convergence
 # profiles for $s=1$ and $s=10$.
 
+arrays = {}
 for s in [1, 10]:
     l = trajectory_lengths[-1]
-    trs = make_trajectories(mod_sigma_p(alpha_in)(l), n_traj_convergence)
-    plot_convergence(trs, sigma_p, alpha_grid, r"$\alpha$", alpha_in)
-    plt.suptitle(r"fBM with modified short-time behavior, $L = %d$, $s = %d$" % (l, s),
-                 fontsize=20)
+    sigma = mod_sigma_p(alpha_in)(l)
+    if adaptive:
+        peak_and_limits, cumulative_peak_and_limits = \
+            adaptive_convergence(lambda n: make_trajectories(sigma, n),
+                                 sigma_p, alpha_grid, n_traj_convergence,
+                                 adaptive_trajectories["batch_size"],
+                                 **tolerances)
+        print("Convergence, s = %d: %d of %d trajectories used"
+              % (s, len(peak_and_limits), n_traj_convergence), file=sys.stderr)
+    else:
+        trs = make_trajectories(sigma, n_traj_convergence)
+        peak_and_limits, cumulative_peak_and_limits = \
+            convergence(trs, sigma_p, alpha_grid)
+    arrays.update(convergence_arrays("s=%d" % s, peak_and_limits,
+                                     cumulative_peak_and_limits))
+    arrays["s=%d/n_trajectories" % s] = len(peak_and_limits)
     fname = 'short_time_modification/convergence_mod_fbm_s=%d.png' % s
-    png = BytesIO()
-    plt.savefig(png)
-    #result[fname] = png.getvalue() # bug in Seamless
-    result[fname] = np.array(png.getvalue()) # workaround
+    renderer.submit(fname, render_convergence,
+                    peak_and_limits, cumulative_peak_and_limits,
+                    r"$\alpha$", alpha_in,
+                    title=r"fBM with modified short-time behavior, $L = %d$, $s = %d$" % (l, s))
+
+# The numerical results are stored in an .npz archive (see `result_store`).
+
+npz = pack(alpha_in=alpha_in, alpha_grid=alpha_grid, l=l,
+           s=np.array(ss), alpha=np.array(alphas),
+           n_trajectories=np.array(n_used), **arrays)
+result['short_time_modification/results.npz'] = np.array(npz) # workaround
+
+for fname, png in renderer.collect().items():
+    #result[fname] = png # bug in Seamless
+    result[fname] = np.array(png) # workaround
+
+if profiling:
+    result['short_time_modification/profile.json'] = dump_json()
 
 #@image short_time_modification/convergence_mod_fbm_s=1.png
 
@@ -0,0 +1,151 @@
+"""
+Build a .tgz archive of the Seamless database (seamless-db/), to
+re-distribute the results of a (modified) workflow.
+
+Buffers that are in the data checksum list (data-checksums.list) are not
+included, since they are re-created from data/ by seamless-populate-db.sh.
+
+The archive is compressed in parallel: the files are divided into
+batches, each of which is compressed into a separate gzip member. The
+concatenated members form a single valid .tgz, that can be extracted
+with "tar xzf" as before.
+
+A manifest of all buffers in the database is written next to the archive.
+With --since, only the buffers that are not in a previous manifest are
+archived (the small database index files are always included). Such an
+incremental archive is extracted on top of the previous one.
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import os
+import sys
+import zlib
+import tarfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+read_size = 16 * 1024 * 1024
+batch_size = 64 * 1024 * 1024
+
+def read_checksum_list(filename):
+    with open(filename) as f:
+        return set(f.read().split())
+
+def read_manifest(filename):
+    with open(filename) as f:
+        return set(line.strip() for line in f if line.strip())
+
+# Collect the directories and files to be archived, as paths relative to
+#  the parent of the database directory (i.e. starting with "seamless-db/").
+
+def collect(db_dir, exclude_buffers):
+    parent, dbname = os.path.split(os.path.abspath(db_dir))
+    directories, files, buffers = [], [], []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(parent, dbname)):
+        dirnames.sort()
+        reldir = os.path.relpath(dirpath, parent)
+        directories.append(reldir)
+        is_buffer_dir = (reldir == os.path.join(dbname, "buffers"))
+        for filename in sorted(filenames):
+            if is_buffer_dir:
+                if filename in exclude_buffers:
+                    continue
+                buffers.append(filename)
+            files.append(os.path.join(reldir, filename))
+    return parent, directories, files, buffers
+
+def tar_header(parent, relpath):
+    stat = os.stat(os.path.join(parent, relpath))
+    info = tarfile.TarInfo(relpath)
+    info.mtime = int(stat.st_mtime)
+    info.mode = stat.st_mode & 0o7777
+    if os.path.isdir(os.path.join(parent, relpath)):
+        info.type = tarfile.DIRTYPE
+        info.name += "/"
+    else:
+        info.size = stat.st_size
+    return info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"), info.size
+
+# Compress one batch of tar entries into a gzip member.
+
+def compress_batch(parent, relpaths, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip format
+    chunks = []
+    for relpath in relpaths:
+        header, size = tar_header(parent, relpath)
+        chunks.append(compressor.compress(header))
+        if not size:
+            continue
+        with open(os.path.join(parent, relpath), "rb") as f:
+            while True:
+                data = f.read(read_size)
+                if not data:
+                    break
+                chunks.append(compressor.compress(data))
+        padding = -size % tarfile.BLOCKSIZE
+        chunks.append(compressor.compress(tarfile.NUL * padding))
+    chunks.append(compressor.flush())
+    return b"".join(chunks)
+
+def make_batches(parent, relpaths):
+    batches, batch, batch_bytes = [], [], 0
+    for relpath in relpaths:
+        batch.append(relpath)
+        batch_bytes += os.path.getsize(os.path.join(parent, relpath))
+        if batch_bytes >= batch_size:
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+# The compressed batches are written in order. At most 2 batches per
+#  worker are pending at any time, to bound memory use.
+
+def write_archive(outfile, parent, relpaths, workers, level):
+    batches = make_batches(parent, relpaths)
+    end_of_archive = zlib.compressobj(level, zlib.DEFLATED, 31)
+    tmpfile = outfile + ".part"
+    with open(tmpfile, "wb") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for batch in batches:
+            pending.append(executor.submit(compress_batch, parent, batch, level))
+            if len(pending) >= 2 * workers:
+                out.write(pending.pop(0).result())
+        for job in pending:
+            out.write(job.result())
+        out.write(end_of_archive.compress(tarfile.NUL * 2 * tarfile.BLOCKSIZE))
+        out.write(end_of_archive.flush())
+    os.replace(tmpfile, outfile)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("checksum_file", help="Data checksum list, e.g. data-checksums.list")
+    parser.add_argument("outfile", help="Archive to create, e.g. seamless-db.tgz")
+    parser.add_argument("--db-dir", default="seamless-db")
+    parser.add_argument("--since", help="Manifest of a previous archive")
+    parser.add_argument("--manifest", help="Manifest to write (default: OUTFILE.manifest)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--level", type=int, default=6, help="gzip compression level")
+    args = parser.parse_args()
+
+    exclude_buffers = read_checksum_list(args.checksum_file)
+    previous_buffers = read_manifest(args.since) if args.since else set()
+    parent, directories, files, buffers = collect(
+        args.db_dir, exclude_buffers | previous_buffers
+    )
+    print("Archive %d buffers (%d in previous manifest)" % (
+        len(buffers), len(previous_buffers)), file=sys.stderr)
+    write_archive(args.outfile, parent, directories + files, args.workers, args.level)
+
+    manifest = args.manifest or args.outfile + ".manifest"
+    with open(manifest, "w") as f:
+        for checksum in sorted(previous_buffers | set(buffers)):
+            f.write(checksum + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,7 @@
 #!/bin/bash
 
+# Kept for compatibility: see create-db-archive.py
+# Usage: ./create-db-archive.sh data-checksums.list seamless-db.tgz [--since previous.tgz.manifest]
+
 set -u -e
-checksum_file=$1
-outfile=$2
-rm -rf TEMP
-mkdir TEMP
-cp -rl seamless-db TEMP/seamless-db
-for i in `cat ${checksum_file}`; do
-  rm -f TEMP/seamless-db/buffers/$i
-done
-cd TEMP
-rm -f *.yaml
-tar czf TEMP.tgz seamless-db/
-cd ..
-mv -f TEMP/TEMP.tgz $outfile
-rm -rf TEMP
+python3 "$(dirname "$0")"/create-db-archive.py "$@"
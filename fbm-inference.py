@@ -0,0 +1,319 @@
+"""
+Estimate the fBM parameters alpha and 2 D dt^alpha from position
+trajectories on disk, without Seamless or a database.
+
+Each INPUT is one of:
+
+  - a position array file (.npy), of shape (frames, particles, 3), read
+    memory-mapped; the times are taken from --time, or are multiples of --dt
+  - an MD trajectory directory, containing
+    particles/universe/position/value.npy and .../time.npy
+  - a trajectory store made by build-trajectory-store.py
+
+For every input, L value (--lengths) and sampling step size (--steps),
+the trajectories are read and analyzed exactly as in the lipid analysis
+of the workflow, with the same estimators and likelihood methods (see
+parameters.yaml). Combinations for which the trajectory is too short are
+skipped with a warning. The jobs run in --workers processes, each
+limited to --threads threads for Numba and BLAS, so that the workers
+together do not use more threads than there are cores. Each job
+analyzes one input and one L for several s; the positions for the next
+s are read in the background while the current one is being analyzed
+(--prefetch).
+
+The results are written to OUTPUT as JSON lines, one per (input, L, s),
+as soon as the job that analyzes them has finished (a job writes the
+results for all its s at once): input, l, s, dt, alpha, d (= 2 D dt^alpha),
+estimator, method and, with --bootstrap, the intervals and standard
+errors, and with --heterogeneity, the distribution of alpha over the
+particles and the alpha of each particle (see lipid_heterogeneity in
+code/python-packages/lipid_analysis_common_code.py). With --curves, the
+alpha grid and log-likelihood curve are included as well. With --resume,
+(input, L, s) combinations already present in OUTPUT are not repeated,
+so that an interrupted batch can be continued.
+
+With --windows, the estimates are also made along the trajectory, in
+windows of L*s frames that slide by --stride frames (default: L*s), and
+the window start times, alphas and 2 D dt^alpha values are included as
+"windows". With --method dense, the covariance factors for each L are
+computed only once per worker process (they need 8*G*L^2 bytes for a
+grid of G alpha values; use another method for large L).
+
+The alpha grid is that of the lipid analysis, unless --grid is given as
+one or more START:STOP:N specifications, which are merged.
+
+Example:
+
+  python3 fbm-inference.py data/long_time_trajectory sim*/positions.npy \\
+      --dt 0.1 --lengths 10 100 --steps 1 10 100 --method levinson \\
+      --workers 8 --output results.jsonl
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import sys
+import os
+import json
+import argparse
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "code"))
+common = importlib.import_module("python-packages.lipid_analysis_common_code")
+inference = importlib.import_module("python-packages.inference")
+trajectory_store = importlib.import_module("python-packages.trajectory_store")
+likelihood_cache = importlib.import_module("python-packages.likelihood_cache")
+toeplitz = importlib.import_module("python-packages.toeplitz")
+
+methods = ["dense", "levinson", "pcg", "whittle"]
+
+def open_input(path, time_file=None, dt=1.):
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, "store.json")):
+            return trajectory_store.open_store(path)
+        position_dir = os.path.join(path, "particles", "universe", "position")
+        return (np.load(os.path.join(position_dir, "time.npy"), mmap_mode="r"),
+                np.load(os.path.join(position_dir, "value.npy"), mmap_mode="r"))
+    positions = np.load(path, mmap_mode="r")
+    if positions.ndim != 3:
+        raise ValueError("%s: expected positions of shape (frames, particles, dims), "
+                         "got shape %s" % (path, positions.shape))
+    if time_file is not None:
+        time = np.load(time_file, mmap_mode="r")
+    else:
+        time = dt*np.arange(positions.shape[0], dtype=np.float64)
+    return time, positions
+
+def parse_grid(specs):
+    grids = []
+    for spec in specs:
+        start, stop, n = spec.split(":")
+        grids.append(np.linspace(float(start), float(stop), int(n)))
+    return inference.merge_grids(*grids)
+
+def job_key(path, l, s):
+    return (path, l, s)
+
+# With --resume, the results already in OUTPUT are read, and the file is
+# truncated after the last complete result, so that the new results are
+# not appended to the incomplete last line of an interrupted run.
+
+def read_done(output):
+    done = set()
+    if not os.path.exists(output):
+        return done
+    end = 0
+    with open(output, "rb") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                if line.strip():
+                    break  # incomplete last line of an interrupted run
+                end += len(line)
+                continue
+            if not line.endswith(b"\n"):
+                break
+            done.add(job_key(entry["input"], entry["l"], entry["s"]))
+            end += len(line)
+    with open(output, "r+b") as f:
+        f.truncate(end)
+    return done
+
+# Per-process state: the open inputs, the cache and the options. They
+# are set up once by the initializer of each worker process.
+
+_state = {}
+
+def init_worker(options):
+    toeplitz.limit_threads(options["threads"])
+    _state.clear()
+    _state.update(options)
+    _state["inputs"] = {}
+    _state["cache"] = None
+    _state["factors"] = inference.FactorCache()
+    if options["cache_dir"] is not None:
+        _state["cache"] = likelihood_cache.LikelihoodCache(
+            options["cache_dir"], max_bytes=options["cache_mb"]*1024*1024)
+
+def get_input(path):
+    inputs = _state["inputs"]
+    if path not in inputs:
+        inputs[path] = open_input(path, _state["time"], _state["dt"])
+    return inputs[path]
+
+def load(trajectory, l, s):
+    if _state["estimator"] == "profile":
+        return common.read_raw(trajectory, l, s)
+    return common.read_and_normalize(trajectory, l, s)
+
+def estimate(l, s, data):
+    grid = _state["grid"]
+    if _state["estimator"] == "profile":
+        dt, tr = data
+        return common.estimate_profile_raw(
+            dt, tr, l, n_resamples=_state["bootstrap"],
+            method=_state["method"], tolerance=_state["tolerance"], grid=grid,
+            heterogeneity=_state["heterogeneity"], seed=(l, s))
+    dt, d, tr = data
+    dt, alpha, d, log_lh, intervals, lipids, residual = common.estimate_normalized(
+        dt, d, tr, l, cache=_state["cache"], n_resamples=_state["bootstrap"],
+        method=_state["method"], tolerance=_state["tolerance"], grid=grid,
+        heterogeneity=_state["heterogeneity"], seed=(l, s))
+    return dt, alpha, d, log_lh, None, intervals, lipids, residual
+
+def run_job(path, l, steps):
+    trajectory = get_input(path)
+    blocks = common.prefetched(steps, lambda s: load(trajectory, l, s),
+                               _state["prefetch"])
+    return [job_entry(path, trajectory, l, s, data) for s, data in blocks]
+
+def job_entry(path, trajectory, l, s, data):
+    grid = _state["grid"]
+    entry = {"input": path, "l": l, "s": s,
+             "estimator": _state["estimator"], "method": _state["method"]}
+    dt, alpha, d, log_lh, d_profile, intervals, lipids, residual = \
+        estimate(l, s, data)
+    entry.update(dt=float(dt), alpha=float(alpha), d=float(d))
+    if residual is not None:
+        entry["pcg_residual"] = float(residual)
+    if intervals is not None:
+        for name, value in intervals.items():
+            entry[name] = np.asarray(value, np.float64).tolist()
+    if lipids is not None:
+        entry["heterogeneity"] = {name: np.asarray(value).tolist()
+                                  for name, value in lipids.items()}
+        entry["alpha_grid"] = grid.tolist()
+    if _state["windows"]:
+        _, times, alphas, ds, _, residual = common.estimate_windows(
+            trajectory, l, s, stride=_state["stride"], method=_state["method"],
+            tolerance=_state["tolerance"], factors=_state["factors"], grid=grid)
+        entry["windows"] = {"time": np.asarray(times, np.float64).tolist(),
+                            "alpha": alphas.tolist(), "d": ds.tolist()}
+        if residual is not None:
+            entry["windows"]["pcg_residual"] = float(residual)
+    if _state["curves"]:
+        entry["alpha_grid"] = grid.tolist()
+        entry["log_likelihood"] = np.asarray(log_lh).tolist()
+        if d_profile is not None:
+            entry["d_profile"] = np.asarray(d_profile).tolist()
+    return entry
+
+# The sampling step sizes of one (input, L) are split over as many jobs
+# as needed to keep all workers busy.
+
+def make_jobs(inputs, lengths, steps, options, done, workers):
+    groups = []
+    for path in inputs:
+        time, positions = open_input(path, options["time"], options["dt"])
+        frames = positions.shape[0]
+        for l in lengths:
+            ss = []
+            for s in steps:
+                if job_key(path, l, s) in done:
+                    continue
+                if s*l + 1 > frames:
+                    print("Skipping %s, L = %d, s = %d: only %d frames"
+                          % (path, l, s, frames), file=sys.stderr)
+                    continue
+                ss.append(s)
+            if ss:
+                groups.append((path, l, ss))
+    chunks = -(-workers // max(len(groups), 1))
+    jobs = []
+    for path, l, ss in groups:
+        for i in range(min(chunks, len(ss))):
+            jobs.append((path, l, ss[i::chunks]))
+    return jobs
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("inputs", nargs="+", metavar="INPUT")
+    parser.add_argument("--output", required=True, help="Result file (JSON lines)")
+    parser.add_argument("--lengths", type=int, nargs="+", required=True,
+                        help="Trajectory lengths L")
+    parser.add_argument("--steps", type=int, nargs="+", default=[1],
+                        help="Sampling step sizes s")
+    parser.add_argument("--time", help="Time array (.npy) for position array inputs")
+    parser.add_argument("--dt", type=float, default=1.,
+                        help="Time step for position array inputs without --time")
+    parser.add_argument("--grid", nargs="+", metavar="START:STOP:N",
+                        help="Alpha grid (default: the grid of the lipid analysis)")
+    parser.add_argument("--estimator", choices=["two_stage", "profile"],
+                        default="two_stage")
+    parser.add_argument("--method", choices=methods, default="dense",
+                        help="Likelihood method")
+    parser.add_argument("--tolerance", type=float, default=1.e-10,
+                        help="Relative residual for --method pcg")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Number of bootstrap resamples for confidence intervals")
+    parser.add_argument("--heterogeneity", action="store_true",
+                        help="Estimate the distribution of alpha over the particles")
+    parser.add_argument("--windows", action="store_true",
+                        help="Estimate alpha and D along the trajectory as well")
+    parser.add_argument("--stride", type=int,
+                        help="Frames between windows for --windows (default: L*s)")
+    parser.add_argument("--cache-dir", help="Directory of the log-likelihood cache")
+    parser.add_argument("--cache-mb", type=int, default=1024)
+    parser.add_argument("--curves", action="store_true",
+                        help="Include the log-likelihood curves in the output")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads", type=int,
+                        help="Threads per worker for Numba and BLAS "
+                             "(default: the number of cores divided by --workers)")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="Number of data sets read ahead in each job (0: none)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the jobs that are already in OUTPUT")
+    args = parser.parse_args()
+
+    grid = common.alpha_grid if args.grid is None else parse_grid(args.grid)
+    options = {
+        "time": args.time, "dt": args.dt, "grid": grid,
+        "estimator": args.estimator, "method": args.method,
+        "tolerance": args.tolerance, "bootstrap": args.bootstrap,
+        "cache_dir": args.cache_dir, "cache_mb": args.cache_mb,
+        "curves": args.curves, "heterogeneity": args.heterogeneity,
+        "windows": args.windows, "stride": args.stride,
+        "prefetch": args.prefetch,
+        "threads": args.threads or max(1, os.cpu_count() // max(args.workers, 1)),
+    }
+    done = read_done(args.output) if args.resume else set()
+    jobs = make_jobs(args.inputs, args.lengths, args.steps, options, done,
+                     max(args.workers, 1))
+    print("%d jobs to run, %d results already done" % (len(jobs), len(done)),
+          file=sys.stderr)
+
+    mode = "a" if args.resume else "w"
+    with open(args.output, mode) as output:
+        def write(entry):
+            output.write(json.dumps(entry) + "\n")
+            output.flush()
+            print("%s, L = %d, s = %d: alpha = %.4f" % (
+                entry["input"], entry["l"], entry["s"], entry["alpha"]),
+                file=sys.stderr)
+        if args.workers <= 1:
+            init_worker(options)
+            for job in jobs:
+                for entry in run_job(*job):
+                    write(entry)
+        else:
+            # The workers are started as new processes, with the thread
+            # limits in their environment, so that they apply from the start.
+            toeplitz.limit_threads(options["threads"])
+            with ProcessPoolExecutor(args.workers, initializer=init_worker,
+                                     initargs=(options,),
+                                     mp_context=multiprocessing.get_context("spawn")
+                                     ) as executor:
+                futures = [executor.submit(run_job, *job) for job in jobs]
+                for future in as_completed(futures):
+                    for entry in future.result():
+                        write(entry)
+
+if __name__ == "__main__":
+    main()
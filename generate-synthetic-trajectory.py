@@ -0,0 +1,126 @@
+"""
+Generate a synthetic lipid trajectory with the same array layout as the
+MD trajectories extracted from the ActivePapers, i.e.
+
+  <target_directory>/particles/universe/position/value.npy  (frames, lipids, 3)
+  <target_directory>/particles/universe/position/time.npy   (frames,)
+
+Each coordinate of each lipid follows fBM (or fBM with modified short-time
+behavior) with the given alpha and D, sampled every dt ps. D follows the
+same convention as the literature values in lipid_analysis.py: it is in
+nm^2/ps^alpha, and the mean-square displacement of a single coordinate is
+2 D t^alpha.
+
+The trajectories are generated in blocks of lipids, using the circulant
+embedding method, so that memory use is bounded by the block size and not
+by the number of lipids. With --mmap, value.npy is written through a memory
+map, which makes it possible to generate datasets much larger than memory.
+For a given seed and block size, the generated data does not depend on --mmap.
+
+Example (a dataset ten times as long as the long-time trajectory):
+
+  python3 generate-synthetic-trajectory.py data/synthetic_trajectory \\
+      --frames 333340 --lipids 128 --dt 18 --mmap
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import sys
+import os
+import argparse
+import importlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "code"))
+fbm = importlib.import_module("python-packages.fbm")
+gaussian_processes = importlib.import_module("python-packages.gaussian_processes")
+reproducible_random_numbers = importlib.import_module(
+    "python-packages.reproducible_random_numbers"
+)
+
+models = {
+    "fbm": fbm.sigma_i_acov,
+    "mod_fbm": fbm.mod_sigma_i_acov,
+}
+
+def generate(target_directory, *, model, alpha, D, frames, lipids, dt,
+             box, block_size, mmap, dtype, seed):
+    reproducible_random_numbers.seed(seed)
+    posdir = os.path.join(target_directory, "particles", "universe", "position")
+    os.makedirs(posdir, exist_ok=True)
+
+    time = dt * np.arange(frames, dtype=np.float64)
+    np.save(os.path.join(posdir, "time.npy"), time)
+
+    shape = (frames, lipids, 3)
+    value_file = os.path.join(posdir, "value.npy")
+    if mmap:
+        value = np.lib.format.open_memmap(
+            value_file, mode="w+", dtype=dtype, shape=shape
+        )
+    else:
+        value = np.empty(shape, dtype=dtype)
+
+    # The increment autocovariance for D=1 (in units of dt),
+    #  scaled to the requested D. In this code, "D" everywhere else
+    #  means 2 D dt^alpha, see lipid_analysis.py
+    acov = models[model](alpha)(frames - 1) * (2 * D * dt**alpha)
+    for start in range(0, lipids, block_size):
+        stop = min(start + block_size, lipids)
+        nblock = stop - start
+        print("Generate lipids %d-%d of %d" % (start, stop, lipids), file=sys.stderr)
+        increments = gaussian_processes.make_stationary_trajectories(
+            acov, 3 * nblock
+        )
+        origin = reproducible_random_numbers.uniform(0, box, (nblock, 3))
+        block = np.empty((frames, nblock, 3), dtype=np.float64)
+        block[0] = origin
+        block[1:] = increments.reshape(nblock, 3, frames - 1).transpose(2, 0, 1)
+        np.cumsum(block, axis=0, out=block)
+        value[:, start:stop, :] = block
+        del increments, block
+
+    if mmap:
+        value.flush()
+        del value
+    else:
+        np.save(value_file, value)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("target_directory")
+    parser.add_argument("--model", choices=sorted(models), default="fbm")
+    parser.add_argument("--alpha", type=float, default=0.55)
+    parser.add_argument(
+        "--D", type=float, default=0.0008,
+        help="Diffusion constant in nm^2/ps^alpha"
+    )
+    parser.add_argument("--frames", type=int, default=33334)
+    parser.add_argument("--lipids", type=int, default=128)
+    parser.add_argument("--dt", type=float, default=18.0, help="Time step in ps")
+    parser.add_argument(
+        "--box", type=float, default=10.0,
+        help="Initial positions are uniform within a box of this size (nm)"
+    )
+    parser.add_argument("--block-size", type=int, default=16,
+                        help="Number of lipids generated at once")
+    parser.add_argument("--mmap", action="store_true",
+                        help="Write value.npy through a memory map")
+    parser.add_argument("--dtype", choices=["float32", "float64"], default="float64")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.frames < 2:
+        parser.error("--frames must be at least 2")
+    generate(
+        args.target_directory,
+        model=args.model, alpha=args.alpha, D=args.D,
+        frames=args.frames, lipids=args.lipids, dt=args.dt, box=args.box,
+        block_size=args.block_size, mmap=args.mmap,
+        dtype=np.dtype(args.dtype), seed=args.seed,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Run a resident likelihood service on a local address.
+
+The service keeps the inverse covariance matrices and log-determinants
+for each (model, L, alpha grid) that it has been asked for, so that
+repeated analyses with the same lengths and grids no longer build and
+factorize any covariance matrices. It accepts trajectory blocks, or just
+their scatter matrices, and returns log-likelihood curves and
+maximum-likelihood estimates (see
+code/python-packages/likelihood_service.py for the protocol, and its
+LikelihoodClient class for a client with the same functions as
+inference.py).
+
+The service only listens on the loopback interface by default. It is
+not meant to be exposed to a network.
+
+Example:
+
+  python3 likelihood-service.py --port 8765 --max-mb 2048
+"""
+
+# Author: Sjoerd de Vries, CNRS
+# license: public domain
+
+import sys
+import os
+import argparse
+import importlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "code"))
+likelihood_service = importlib.import_module("python-packages.likelihood_service")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-mb", type=int, default=1024,
+                        help="Memory limit for the cached factors")
+    args = parser.parse_args()
+    server = likelihood_service.make_server(args.host, args.port,
+                                            args.max_mb*1024*1024)
+    print("Likelihood service on http://%s:%d" % server.server_address[:2],
+          file=sys.stderr)
+    sys.stderr.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
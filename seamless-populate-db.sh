@@ -11,10 +11,6 @@ docker logs seamless-database-container
 sleep 10
 docker stop seamless-database-container
 docker rm seamless-database-container
-rm -f data-checksums.list
-for f in $(find data/ -type f); do
-    checksum=$(seamless-checksum $f) # wrapper around "openssl dgst -sha3-256"
-    echo $f $checksum >> data-checksums.list
-    echo $f $checksum
-    ln $f seamless-db/buffers/$checksum -f
-done
\ No newline at end of file
+# Checksum all files in data/ (in parallel, skipping files that are unchanged
+#  since the last run), write data-checksums.list and hard-link them as buffers
+python3 checksum-data.py --data-dir data/ --buffer-dir seamless-db/buffers